@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from skybox import Skybox
+from camera import Camera
+from objectHandler import Sphere, Plane, Mesh, Instance, load_obj, make_transform
+from light import Light
+from scene import Scene
+from bvh import BVH
+from renderer import render_frame
+from profiler import Profile
+from cache import cache_directory
+import precision
+
+#headless benchmark of the renderer on synthetic scenes.
+#every case runs in its own python process so its peak memory is its own, and the results are written as JSON
+#so runs on different commits can be compared (see --baseline).
+
+def random_spheres(count, seed=0, reflection=0):
+    #count spheres scattered in front of the camera, same layout for the same seed
+    generator = np.random.default_rng(seed)
+    centers = generator.uniform((-8, -0.5, -20), (8, 4, -2), (count, 3))
+    radii = generator.uniform(0.2, 0.8, count)
+    colors = generator.integers(30, 256, (count, 3))
+    return [Sphere(tuple(center), radius, tuple(color), reflection) for center, radius, color in zip(centers, radii, colors)]
+
+def sphere_mesh_file(triangles):
+    #writes a latitude/longitude tessellated sphere with about that many triangles as an OBJ file and returns its name.
+    #it's only written once, after that load_obj gets it from its own cache
+    rows = max(2, int(round(np.sqrt(triangles / 4))))
+    columns = 2 * rows
+    filename = os.path.join(cache_directory, "benchmark", f"sphere-{rows}x{columns}.obj")
+    if os.path.exists(filename):
+        return filename
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    latitudes = np.linspace(0, np.pi, rows + 1)
+    longitudes = np.linspace(0, 2 * np.pi, columns, endpoint=False)
+    latitude, longitude = np.meshgrid(latitudes, longitudes, indexing='ij')
+    vertices = np.stack([np.sin(latitude) * np.cos(longitude), np.cos(latitude), np.sin(latitude) * np.sin(longitude)], axis=-1).reshape(-1, 3)
+
+    #two triangles per quad, the ones squashed into the poles are kept, they're degenerate but still valid input
+    row, column = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+    corner = row * columns + column
+    right = row * columns + (column + 1) % columns
+    faces = np.concatenate([
+        np.stack([corner, corner + columns, right], axis=-1).reshape(-1, 3),
+        np.stack([right, corner + columns, right + columns], axis=-1).reshape(-1, 3),
+    ]) + 1
+
+    with open(filename, 'w') as file:
+        file.write(''.join(f"v {x:.6f} {y:.6f} {z:.6f}\n" for x, y, z in vertices))
+        file.write(''.join(f"f {a} {b} {c}\n" for a, b, c in faces))
+    return filename
+
+def mesh_triangles(triangles, center=(0, 1.5, -3), scale=4, color=(200, 50, 50), reflection=0, smooth=False):
+    #the tessellated sphere as one indexed mesh. Smooth shading uses the exact sphere normals at the vertices
+    mesh = load_obj(sphere_mesh_file(triangles))
+    vertices = mesh['vertices'] * scale + center
+    if smooth:
+        return [Mesh(vertices, mesh['faces'], color, mesh['face_normals'], mesh['vertices'], mesh['faces'], reflection)]
+    return [Mesh(vertices, mesh['faces'], color, mesh['face_normals'], reflection=reflection)]
+
+def random_instances(count, triangles=1000, seed=0):
+    #count randomly placed, sized and rotated copies of one smooth tessellated sphere, they all share its mesh
+    mesh = load_obj(sphere_mesh_file(triangles))
+    shared = Mesh(mesh['vertices'], mesh['faces'], (200, 50, 50), mesh['face_normals'], mesh['vertices'], mesh['faces'])
+    generator = np.random.default_rng(seed)
+    positions = generator.uniform((-8, -0.5, -20), (8, 4, -2), (count, 3))
+    scales = generator.uniform(0.2, 0.8, (count, 3))
+    rotations = generator.uniform(0, 360, (count, 3))
+    colors = generator.integers(30, 256, (count, 3))
+    return [Instance(shared, make_transform(position, scale, rotation), tuple(color)) for position, scale, rotation, color in zip(positions, scales, rotations, colors)]
+
+def checkerboard_plane(reflection=0):
+    return [Plane(-1, ((20, 20, 50), (40, 40, 100)), reflection)]
+
+def sun():
+    return [Light((-2, 8, 2), (255, 255, 255), 1)]
+
+def case_camera(width, height):
+    return Camera((0, 2, 6), width, height, 90)
+
+def lamps(count, radius=3, seed=0):
+    #the sun plus count small lamps with a limited radius scattered over the floor
+    generator = np.random.default_rng(seed)
+    positions = generator.uniform((-10, -0.5, -20), (10, 1.5, 0), (count, 3))
+    colors = generator.integers(60, 256, (count, 3))
+    return sun() + [Light(tuple(position), tuple(color), 0.5, radius) for position, color in zip(positions, colors)]
+
+#name: (scene builder, reflection depth, lights builder). Builders return the object list.
+cases = {
+    'spheres-100': (lambda: random_spheres(100), 1, sun),
+    'spheres-1000': (lambda: random_spheres(1000), 1, sun),
+    'mesh-1k': (lambda: mesh_triangles(1000), 1, sun),
+    'mesh-20k': (lambda: mesh_triangles(20000), 1, sun),
+    'mesh-20k-smooth': (lambda: mesh_triangles(20000, smooth=True), 1, sun),
+    'instances-1000': (lambda: random_instances(1000), 1, sun),
+    'plane': (lambda: checkerboard_plane() + random_spheres(10), 1, sun),
+    'reflective': (lambda: checkerboard_plane(0.5) + random_spheres(50, reflection=0.8), 4, sun),
+    'lamps-16': (lambda: checkerboard_plane() + random_spheres(50), 1, lambda: lamps(16)),
+    'lamps-256': (lambda: checkerboard_plane() + random_spheres(50), 1, lambda: lamps(256)),
+}
+
+def run_case(name, width, height, workers, tile_size, profiling=False, antialiasing=None, packet_size=None, precision_name='float64'):
+    #renders one case and returns its results as a dict. With profiling the per stage profile is included,
+    #it slows the render down so rays per second aren't comparable with unprofiled runs.
+    #antialiasing is None or (grid, threshold) like in renderer.render_frame's job, packet_size is render_frame's.
+    #precision_name is the precision everything gets built and traced in, see precision.py
+    build, reflection_depth, build_lights = cases[name]
+    stages = {}
+
+    precision.set_precision(precision_name)
+    start_time = time.perf_counter()
+    skybox = Skybox("skybox.png")
+    scene = Scene(build())
+    stages['scene'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    bvh = BVH(scene)
+    stages['bvh'] = time.perf_counter() - start_time
+
+    camera = case_camera(width, height)
+    lights = build_lights()
+    job = (camera, scene, bvh, lights, skybox, reflection_depth, 0.01, antialiasing)
+
+    stats = {}
+    profile = Profile() if profiling else None
+    start_time = time.perf_counter()
+    render_frame(job, workers, tile_size, stats=stats, profile=profile, packet_size=packet_size)
+    stages['render'] = time.perf_counter() - start_time
+
+    rays = {
+        'primary': stats['primary_rays'],
+        'shadow': stats['shadow_rays'],
+        'reflection': sum(stats['reflection_rays']),
+        'antialiasing': stats['antialiasing_rays'],
+    }
+    rays['total'] = sum(rays.values())
+    #ru_maxrss is in KiB on linux (bytes on macOS)
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    results = {
+        'name': name,
+        'objects': len(scene),
+        'lights': len(lights),
+        'width': width,
+        'height': height,
+        'workers': workers,
+        'reflection_depth': reflection_depth,
+        'stages_seconds': stages,
+        'rays': rays,
+        'reflection_rays_per_depth': stats['reflection_rays'],
+        'antialiasing': antialiasing,
+        'antialiased_pixels': stats['antialiased_pixels'],
+        'packet_size': packet_size,
+        'precision': precision_name,
+        'packet_culling_ratio': stats['packet_bounds_culled'] / max(stats['packet_bounds_tested'], 1),
+        'rays_per_second': {kind: count / stages['render'] for kind, count in rays.items()},
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 2**20,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit / 2**20,
+        'profiled': profiling,
+    }
+    if profiling:
+        results['profile'] = profile.as_dict()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    #prints the total rays per second of every case against the baseline run, returns the names of the cases that got slower than tolerance allows
+    previous = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = previous.get(case['name'])
+        if old is None or (old['width'], old['height'], old['workers'], old.get('profiled', False), old.get('antialiasing'), old.get('packet_size'), old.get('precision', 'float64')) != (case['width'], case['height'], case['workers'], case['profiled'], case['antialiasing'], case['packet_size'], case['precision']):
+            continue
+        ratio = case['rays_per_second']['total'] / old['rays_per_second']['total']
+        print(f"{case['name']}: {ratio:.2f}x baseline")
+        if ratio < 1 - tolerance:
+            regressions.append(case['name'])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs='*', help=f"cases to run (default: all of {', '.join(cases)})")
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--height", type=int, default=120)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--tile-size", type=int, default=32)
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline before it counts as a regression")
+    parser.add_argument("--profile", action="store_true", help="include a per stage profile of every case (slows the render down)")
+    parser.add_argument("--antialiasing", type=int, default=0, metavar="GRID", help="adaptive antialiasing with GRID x GRID extra samples per edge pixel")
+    parser.add_argument("--antialiasing-threshold", type=int, default=16)
+    parser.add_argument("--packets", type=int, default=0, metavar="SIZE", help="trace the camera rays in SIZE x SIZE packets")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    antialiasing = [arguments.antialiasing, arguments.antialiasing_threshold] if arguments.antialiasing > 0 else None
+    if arguments.run_case:
+        #child process: run one case and hand the result back on stdout
+        print(json.dumps(run_case(arguments.run_case, arguments.width, arguments.height, arguments.workers, arguments.tile_size, arguments.profile, antialiasing, arguments.packets or None, arguments.precision)))
+        return
+
+    names = arguments.cases or list(cases)
+    unknown = [name for name in names if name not in cases]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'cases': [],
+    }
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), '--run-case', name, '--width', str(arguments.width), '--height', str(arguments.height),
+                   '--workers', str(arguments.workers), '--tile-size', str(arguments.tile_size),
+                   '--antialiasing', str(arguments.antialiasing), '--antialiasing-threshold', str(arguments.antialiasing_threshold), '--packets', str(arguments.packets), '--precision', arguments.precision] + (['--profile'] if arguments.profile else [])
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        #the last line is the result, anything before it is whatever got printed on the way
+        case = json.loads(output.strip().splitlines()[-1])
+        results['cases'].append(case)
+        print(f"{name}: {case['rays']['total']} rays in {case['stages_seconds']['render']:.2f} s, {case['rays_per_second']['total']:.0f} rays/s, peak {case['peak_rss_mb']:.0f} MB")
+
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"saved {arguments.output}")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = compare(results, json.load(file), arguments.tolerance)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
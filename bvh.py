@@ -0,0 +1,560 @@
+import time
+import numpy as np
+from precision import floats, box_padding
+from objectHandler import MeshFace, intersect_triangle, intersect_triangles, intersect_spheres
+from scene import Scene, TRIANGLE, SPHERE, PLANE, MESH, INSTANCE, type_names
+
+#SAH cost of traversing a node relative to testing one primitive
+traversal_cost = 1.0
+
+class BVH():
+    #bounding volume hierarchy over the scene's primitives (the objects, with meshes split into their faces).
+    #nodes are stored as flat arrays instead of node objects:
+    #   node_min/node_max: (M, 3) bounding boxes
+    #   node_left:  index of the left child for inner nodes, the right child is always node_left + 1
+    #   node_first/node_count: range of the leaf inside primitive_order, node_count is 0 for inner nodes
+    #objects without bounds (the infinite Plane) can't go in the tree so they're kept on the side and tested every time.
+    #scene is a Scene, a plain list of objects gets packed into one.
+    def __init__(self, scene, leaf_size=4, max_leaf_size=16, bins=16):
+        start_time = time.perf_counter()
+        if not isinstance(scene, Scene):
+            scene = Scene(scene)
+        self.scene = scene
+        self.objects = scene.objects
+        self.leaf_size = leaf_size
+        self.max_leaf_size = max_leaf_size
+        self.bins = bins
+
+        bounds_min, bounds_max = scene.get_bounds()
+        has_bounds = ~np.isnan(bounds_min).any(axis=1)
+        #unbounded primitives are always whole objects (planes), they're kept as indices into objects
+        self.unbounded = scene.primitive_objects[~has_bounds].tolist()
+
+        #primitive slot -> index into objects, and the face of it for meshes.
+        #the geometry stays in the scene's arrays, primitive_types and primitive_rows say where: the kernel that tests it and its row
+        self.primitive_objects = scene.primitive_objects[has_bounds]
+        self.primitive_faces = scene.primitive_faces[has_bounds]
+        self.primitive_types = scene.primitive_types[has_bounds]
+        self.primitive_rows = scene.primitive_rows[has_bounds]
+        self._build(bounds_min[has_bounds], bounds_max[has_bounds])
+        #the boxes get stored in the scene's precision, rounded outwards so they still hold what they bound.
+        #the per primitive ones are for culling whole packets of rays (see closest_hit_packet)
+        self.node_min, self.node_max = round_outwards(self.node_min, self.node_max, scene.dtype)
+        self.primitive_min, self.primitive_max = round_outwards(bounds_min[has_bounds], bounds_max[has_bounds], scene.dtype)
+        #slack on the far side of every box test, so rounding in the slab test doesn't lose rays that graze a box
+        self.box_padding = 1 + box_padding(scene.dtype)
+
+        self.build_time = time.perf_counter() - start_time
+        #traversal counters, handy to check that the cost per ray stays sub-linear on big meshes
+        self.rays_traced = 0
+        self.node_visits = 0
+        self.primitive_tests = 0
+
+    def _build(self, bounds_min, bounds_max):
+        count = len(bounds_min)
+        max_nodes = max(2 * count - 1, 1)
+        self.node_min = np.zeros((max_nodes, 3))
+        self.node_max = np.zeros((max_nodes, 3))
+        self.node_left = np.zeros(max_nodes, dtype=np.int64)
+        self.node_first = np.zeros(max_nodes, dtype=np.int64)
+        self.node_count = np.zeros(max_nodes, dtype=np.int64)
+        self.primitive_order = np.arange(count, dtype=np.int64)
+        self.leaf_count = 0
+        self.depth = 0
+
+        if count == 0:
+            self.node_total = 0
+            return
+
+        centroids = (bounds_min + bounds_max) / 2
+        used_nodes = 1
+        #(node, start, end, depth), start:end is the node's range in primitive_order
+        stack = [(0, 0, count, 1)]
+        while stack:
+            node, start, end, depth = stack.pop()
+            items = self.primitive_order[start:end]
+            self.node_min[node] = bounds_min[items].min(axis=0)
+            self.node_max[node] = bounds_max[items].max(axis=0)
+            self.depth = max(self.depth, depth)
+
+            left_mask = None
+            if end - start > self.leaf_size:
+                left_mask = self._find_split(items, self.node_min[node], self.node_max[node], centroids, bounds_min, bounds_max)
+
+            if left_mask is None:
+                self.node_first[node] = start
+                self.node_count[node] = end - start
+                self.leaf_count += 1
+                continue
+
+            #partition the node's range so the left child's primitives come first
+            left_items = items[left_mask]
+            self.primitive_order[start:end] = np.concatenate([left_items, items[~left_mask]])
+            middle = start + len(left_items)
+
+            left = used_nodes
+            used_nodes += 2
+            self.node_left[node] = left
+            stack.append((left, start, middle, depth + 1))
+            stack.append((left + 1, middle, end, depth + 1))
+
+        self.node_total = used_nodes
+
+    def _find_split(self, items, node_min, node_max, centroids, bounds_min, bounds_max):
+        #binned SAH: drop the centroids into a few bins along each axis and only evaluate splits between bins.
+        #returns a mask of the primitives that go left, or None if the node should stay a leaf.
+        count = len(items)
+        item_centroids = centroids[items]
+        centroid_min = item_centroids.min(axis=0)
+        centroid_extent = item_centroids.max(axis=0) - centroid_min
+        parent_area = surface_area(node_min, node_max)
+
+        #bin all three axes at once, bin b of axis a lives at row a * bins + b
+        bins = self.bins
+        #flat axes divide by 1 instead of 0, they get thrown out below anyway
+        bin_index = (item_centroids - centroid_min) / np.where(centroid_extent > 0, centroid_extent, 1) * bins
+        bin_index = np.minimum(bin_index.astype(np.int64), bins - 1)
+        flat_index = (bin_index + np.arange(3) * bins).ravel()
+
+        bin_counts = np.bincount(flat_index, minlength=3 * bins).reshape(3, bins)
+        bin_min = np.full((3 * bins, 3), np.inf)
+        bin_max = np.full((3 * bins, 3), -np.inf)
+        np.minimum.at(bin_min, flat_index, np.repeat(bounds_min[items], 3, axis=0))
+        np.maximum.at(bin_max, flat_index, np.repeat(bounds_max[items], 3, axis=0))
+        bin_min = bin_min.reshape(3, bins, 3)
+        bin_max = bin_max.reshape(3, bins, 3)
+
+        #sweep from both sides, split i puts bins [0, i) on the left and [i, bins) on the right
+        left_counts = np.cumsum(bin_counts, axis=1)[:, :-1]
+        right_counts = np.cumsum(bin_counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        with np.errstate(invalid='ignore'):
+            left_area = surface_area(np.minimum.accumulate(bin_min, axis=1)[:, :-1], np.maximum.accumulate(bin_max, axis=1)[:, :-1])
+            right_area = surface_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1][:, 1:], np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1][:, 1:])
+            costs = left_area * left_counts + right_area * right_counts
+        #a split has to put something on both sides, and flat axes (every centroid in the same spot) can't be split at all
+        costs[(left_counts == 0) | (right_counts == 0)] = np.inf
+        costs[centroid_extent <= 0] = np.inf
+
+        best = int(np.argmin(costs))
+        best_axis, best_split = divmod(best, bins - 1)
+        best_cost = costs[best_axis, best_split]
+        if best_cost == np.inf:
+            #every centroid is in the same spot, no split can separate them
+            return None
+
+        split_cost = traversal_cost + best_cost / max(parent_area, 1e-12)
+        if split_cost >= count and count <= self.max_leaf_size:
+            return None
+        return bin_index[:, best_axis] <= best_split
+
+    def report(self):
+        text = f"BVH: {len(self.primitive_objects)} primitives (+{len(self.unbounded)} unbounded), {self.node_total} nodes, {self.leaf_count} leaves, depth {self.depth}, built in {self.build_time * 1000:.1f} ms"
+        if self.rays_traced:
+            text += f", {self.node_visits / self.rays_traced:.1f} nodes and {self.primitive_tests / self.rays_traced:.1f} primitive tests per ray"
+        return text
+
+    #the queries take an optional profiler.Profile that gets the number of intersection tests per primitive type (tests.<type>)
+
+    def closest_hit(self, ray, profile=None, return_index=False):
+        #single ray closest hit, returns (object, intersection point, t) or (None, None, np.inf).
+        #with return_index the index into objects (-1 on a miss) and the face that got hit (like closest_hit_batch) come after those
+        origin = floats(ray.origin)
+        direction = floats(ray.direction)
+        closest_t = np.inf
+        closest_object = None
+        saved_intersection_point = None
+        closest_index = -1
+        closest_face = 0
+        self.rays_traced += 1
+
+        for index in self.unbounded:
+            if profile is not None:
+                profile.count(self._test_counter(index))
+            intersection_point, t = self.objects[index].intersect(ray)
+            if intersection_point is not None and 0 < t < closest_t:
+                closest_t = t
+                closest_object = self.objects[index]
+                saved_intersection_point = intersection_point
+                closest_index = index
+
+        inverse_direction = safe_inverse(direction)
+        stack = [(0, 0.0)] if self.node_total else []
+        while stack:
+            node, node_near = stack.pop()
+            #the box may have been entered before we found a closer hit, check again
+            if node_near >= closest_t:
+                continue
+            self.node_visits += 1
+
+            count = self.node_count[node]
+            if count > 0:
+                first = self.node_first[node]
+                self.primitive_tests += count
+                for slot in self.primitive_order[first:first + count]:
+                    if profile is not None:
+                        profile.count(self._test_counter(self.primitive_objects[slot]))
+                    hit_object, intersection_point, t = self._closest_hit_primitive(slot, ray, profile)
+                    if intersection_point is not None and 0 < t < closest_t:
+                        closest_t = t
+                        closest_object = hit_object
+                        saved_intersection_point = intersection_point
+                        closest_index = self.primitive_objects[slot]
+                        closest_face = hit_object.index if type(hit_object) is MeshFace else 0
+                continue
+
+            left = self.node_left[node]
+            left_near = self._box_entry(left, origin, inverse_direction, closest_t)
+            right_near = self._box_entry(left + 1, origin, inverse_direction, closest_t)
+            #push the farther child first so the nearer one gets popped (and can shrink closest_t) first
+            for child_near, child in sorted(((left_near, left), (right_near, left + 1)), reverse=True):
+                if child_near < closest_t:
+                    stack.append((child, child_near))
+
+        if return_index:
+            return closest_object, saved_intersection_point, closest_t, closest_index, closest_face
+        return closest_object, saved_intersection_point, closest_t
+
+    def any_hit(self, ray, max_distance=np.inf, profile=None):
+        #single ray occlusion query, returns True as soon as anything is hit between the origin and max_distance
+        origin = floats(ray.origin)
+        direction = floats(ray.direction)
+        self.rays_traced += 1
+
+        for index in self.unbounded:
+            if profile is not None:
+                profile.count(self._test_counter(index))
+            if self.objects[index].occluded(ray, max_distance):
+                return True
+
+        if self.node_total == 0:
+            return False
+
+        inverse_direction = safe_inverse(direction)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._box_entry(node, origin, inverse_direction, max_distance) == np.inf:
+                continue
+            self.node_visits += 1
+
+            count = self.node_count[node]
+            if count > 0:
+                first = self.node_first[node]
+                for slot in self.primitive_order[first:first + count]:
+                    self.primitive_tests += 1
+                    if profile is not None:
+                        profile.count(self._test_counter(self.primitive_objects[slot]))
+                    if self._occluded_primitive(slot, ray, max_distance):
+                        return True
+            else:
+                stack.append(self.node_left[node])
+                stack.append(self.node_left[node] + 1)
+
+        return False
+
+    def _closest_hit_primitive(self, slot, ray, profile=None):
+        #single ray test of one primitive, (object hit, intersection point, t) with None for the point on a miss.
+        #triangles and mesh faces go straight to the packed arrays, a mesh face comes back as a MeshFace.
+        #instances trace the ray through their mesh's BVH and hand back the face they hit, everything else goes through its own intersect()
+        index = self.primitive_objects[slot]
+        object = self.objects[index]
+        if self.primitive_types[slot] in (TRIANGLE, MESH):
+            intersection_point, t = intersect_triangle(ray, *self._triangle(slot))
+            if intersection_point is not None and self.primitive_types[slot] == MESH:
+                object = object.face(self.primitive_faces[slot])
+            return object, intersection_point, t
+        if self.scene.object_types[index] == INSTANCE:
+            return object.closest_hit(ray, profile)
+        return (object,) + object.intersect(ray)
+
+    def _occluded_primitive(self, slot, ray, max_distance):
+        if self.primitive_types[slot] in (TRIANGLE, MESH):
+            intersection_point, t = intersect_triangle(ray, *self._triangle(slot))
+            return intersection_point is not None and 0 < t < max_distance
+        return self.objects[self.primitive_objects[slot]].occluded(ray, max_distance)
+
+    def _triangle(self, slot):
+        #v0, edge1 and edge2 of a triangle or mesh face slot, from the scene's arrays.
+        #mesh faces get gathered like Scene.mesh_triangles does, one vertex at a time is quicker for a single face
+        scene = self.scene
+        row = self.primitive_rows[slot]
+        if self.primitive_types[slot] == MESH:
+            corner0, corner1, corner2 = scene.mesh_faces[row].tolist()
+            v0 = scene.mesh_vertices[corner0]
+            return v0, scene.mesh_vertices[corner1] - v0, scene.mesh_vertices[corner2] - v0
+        return scene.triangle_v0[row], scene.triangle_edge1[row], scene.triangle_edge2[row]
+
+    def _test_counter(self, index):
+        return 'tests.' + type_names[self.scene.object_types[index]]
+
+    def _box_entry(self, node, origin, inverse_direction, max_distance):
+        #slab test, returns the distance at which the ray enters the box or np.inf if it misses it within [0, max_distance)
+        t0 = (self.node_min[node] - origin) * inverse_direction
+        t1 = (self.node_max[node] - origin) * inverse_direction
+        near = max(np.minimum(t0, t1).max(), 0.0)
+        far = min(np.maximum(t0, t1).min() * self.box_padding, max_distance)
+        if near > far:
+            return np.inf
+        return near
+
+    def closest_hit_batch(self, origins, directions, profile=None, return_faces=False):
+        #batched closest hit with the same output as objectHandler.closest_hit_batch:
+        #per ray distance and index into objects (-1 where nothing got hit), and with return_faces the face like Scene.closest_hit_batch.
+        origins = floats(origins)
+        directions = floats(directions)
+        ray_count = len(origins)
+        closest_t = np.full(ray_count, np.inf, dtype=directions.dtype)
+        closest_index = np.full(ray_count, -1)
+        closest_face = np.zeros(ray_count, dtype=np.int64)
+        self.rays_traced += ray_count
+
+        for index in self.unbounded:
+            if profile is not None:
+                profile.count(self._test_counter(index), ray_count)
+            t, hit = self.objects[index].intersect_batch(origins, directions)
+            closer = hit & (t > 0) & (t < closest_t)
+            closest_t[closer] = t[closer]
+            closest_index[closer] = index
+
+        if self.node_total == 0:
+            return (closest_t, closest_index, closest_face) if return_faces else (closest_t, closest_index)
+
+        self._closest_hit_traversal(origins, directions, closest_t, closest_index, closest_face, profile)
+
+        if return_faces:
+            return closest_t, closest_index, closest_face
+        return closest_t, closest_index
+
+    def closest_hit_packet(self, origins, directions, profile=None):
+        #closest hit of a packet of coherent rays sharing one origin (neighbouring camera rays), same output as closest_hit_batch with return_faces
+        #plus how many bounds (nodes, primitives and planes) got tested against the packet and how many of those culled it.
+        #the packet is wrapped in a bounding cone that gets tested once against the bounds of every node the traversal reaches and of every
+        #primitive in the leaves (and planes against the directions that reach them). What's outside the cone is dropped for the whole packet
+        #before any per ray test, the rest goes through the same traversal as closest_hit_batch.
+        origins = floats(origins)
+        directions = floats(directions)
+        ray_count = len(origins)
+        closest_t = np.full(ray_count, np.inf, dtype=directions.dtype)
+        closest_index = np.full(ray_count, -1)
+        closest_face = np.zeros(ray_count, dtype=np.int64)
+        self.rays_traced += ray_count
+        cone = (origins[0],) + bounding_cone(directions)
+
+        tested = culled = 0
+        for index in self.unbounded:
+            if self.scene.object_types[index] == PLANE:
+                tested += 1
+                if not cone_reaches_plane(*cone, self.objects[index].yLevel):
+                    culled += 1
+                    continue
+            if profile is not None:
+                profile.count(self._test_counter(index), ray_count)
+            t, hit = self.objects[index].intersect_batch(origins, directions)
+            closer = hit & (t > 0) & (t < closest_t)
+            closest_t[closer] = t[closer]
+            closest_index[closer] = index
+
+        if self.node_total:
+            cone_counts = self._closest_hit_traversal(origins, directions, closest_t, closest_index, closest_face, profile, cone)
+            tested += cone_counts[0]
+            culled += cone_counts[1]
+        return closest_t, closest_index, closest_face, tested, culled
+
+    def _closest_hit_traversal(self, origins, directions, closest_t, closest_index, closest_face, profile=None, cone=None):
+        #every active (ray, node) pair is processed level by level with array ops, leaves are expanded into (ray, primitive) pairs.
+        #closest_t/closest_index/closest_face get updated in place. With cone (apex, axis, half angle) the nodes and primitives outside it are
+        #dropped before their per ray tests, and the number of bounds tested against it and culled by it are returned
+        inverse_directions = safe_inverse(directions)
+        ray_ids = np.arange(len(origins))
+        node_ids = np.zeros(len(origins), dtype=np.int64)
+        #per primitive slot: 0 not looked at yet, 1 inside the cone, -1 culled
+        slot_states = None if cone is None else np.zeros(len(self.primitive_objects), dtype=np.int8)
+        tested = culled = 0
+        while len(ray_ids):
+            if cone is not None:
+                nodes, inverse = np.unique(node_ids, return_inverse=True)
+                node_inside = cone_hits_boxes(*cone, self.node_min[nodes], self.node_max[nodes])
+                tested += len(nodes)
+                culled += int(len(nodes) - node_inside.sum())
+                inside = node_inside[inverse]
+                ray_ids = ray_ids[inside]
+                node_ids = node_ids[inside]
+            near, far = self._box_entry_batch(node_ids, origins[ray_ids], inverse_directions[ray_ids])
+            keep = (near <= far) & (near < closest_t[ray_ids])
+            ray_ids = ray_ids[keep]
+            node_ids = node_ids[keep]
+            self.node_visits += len(ray_ids)
+
+            leaf = self.node_count[node_ids] > 0
+            pair_rays, pair_slots = self._leaf_pairs(ray_ids[leaf], node_ids[leaf])
+            if cone is not None and len(pair_slots):
+                new_slots = np.unique(pair_slots[slot_states[pair_slots] == 0])
+                slot_inside = cone_hits_boxes(*cone, self.primitive_min[new_slots], self.primitive_max[new_slots])
+                slot_states[new_slots] = np.where(slot_inside, 1, -1)
+                tested += len(new_slots)
+                culled += int(len(new_slots) - slot_inside.sum())
+                inside = slot_states[pair_slots] == 1
+                pair_rays, pair_slots = pair_rays[inside], pair_slots[inside]
+            if len(pair_rays):
+                t, pair_faces = self._intersect_pairs(origins, directions, pair_rays, pair_slots, profile)
+                closer = t < closest_t[pair_rays]
+                pair_rays, pair_slots, pair_faces, t = pair_rays[closer], pair_slots[closer], pair_faces[closer], t[closer]
+                #keep the smallest t per ray
+                order = np.lexsort((t, pair_rays))
+                pair_rays, pair_slots, pair_faces, t = pair_rays[order], pair_slots[order], pair_faces[order], t[order]
+                first = np.ones(len(pair_rays), dtype=bool)
+                first[1:] = pair_rays[1:] != pair_rays[:-1]
+                closest_t[pair_rays[first]] = t[first]
+                closest_index[pair_rays[first]] = self.primitive_objects[pair_slots[first]]
+                closest_face[pair_rays[first]] = pair_faces[first]
+
+            inner_rays = ray_ids[~leaf]
+            inner_lefts = self.node_left[node_ids[~leaf]]
+            ray_ids = np.concatenate([inner_rays, inner_rays])
+            node_ids = np.concatenate([inner_lefts, inner_lefts + 1])
+
+        return tested, culled
+
+    def any_hit_batch(self, origins, directions, max_distance=np.inf, profile=None):
+        #batched occlusion query, returns a boolean mask of the rays that hit anything closer than max_distance.
+        #rays drop out of the traversal as soon as they're blocked.
+        origins = floats(origins)
+        directions = floats(directions)
+        ray_count = len(origins)
+        max_distance = np.broadcast_to(floats(max_distance), (ray_count,))
+        blocked = np.zeros(ray_count, dtype=bool)
+        self.rays_traced += ray_count
+
+        for index in self.unbounded:
+            if profile is not None:
+                profile.count(self._test_counter(index), ray_count)
+            blocked |= self.objects[index].occluded_batch(origins, directions, max_distance)
+
+        if self.node_total == 0:
+            return blocked
+
+        inverse_directions = safe_inverse(directions)
+        ray_ids = np.flatnonzero(~blocked)
+        node_ids = np.zeros(len(ray_ids), dtype=np.int64)
+        while len(ray_ids):
+            near, far = self._box_entry_batch(node_ids, origins[ray_ids], inverse_directions[ray_ids])
+            keep = (near <= far) & (near < max_distance[ray_ids]) & ~blocked[ray_ids]
+            ray_ids = ray_ids[keep]
+            node_ids = node_ids[keep]
+            self.node_visits += len(ray_ids)
+
+            leaf = self.node_count[node_ids] > 0
+            pair_rays, pair_slots = self._leaf_pairs(ray_ids[leaf], node_ids[leaf])
+            if len(pair_rays):
+                t = self._intersect_pairs(origins, directions, pair_rays, pair_slots, profile)[0]
+                blocked[pair_rays[t < max_distance[pair_rays]]] = True
+
+            inner = ~leaf & ~blocked[ray_ids]
+            inner_rays = ray_ids[inner]
+            inner_lefts = self.node_left[node_ids[inner]]
+            ray_ids = np.concatenate([inner_rays, inner_rays])
+            node_ids = np.concatenate([inner_lefts, inner_lefts + 1])
+
+        return blocked
+
+    def _box_entry_batch(self, node_ids, origins, inverse_directions):
+        t0 = (self.node_min[node_ids] - origins) * inverse_directions
+        t1 = (self.node_max[node_ids] - origins) * inverse_directions
+        near = np.maximum(np.minimum(t0, t1).max(axis=1), 0.0)
+        far = np.maximum(t0, t1).min(axis=1) * self.box_padding
+        return near, far
+
+    def _leaf_pairs(self, ray_ids, leaf_ids):
+        #expand (ray, leaf) pairs into one (ray, primitive slot) pair per primitive in the leaf
+        counts = self.node_count[leaf_ids]
+        total = counts.sum()
+        pair_rays = np.repeat(ray_ids, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_slots = self.primitive_order[np.repeat(self.node_first[leaf_ids], counts) + offsets]
+        return pair_rays, pair_slots
+
+    def _intersect_pairs(self, origins, directions, pair_rays, pair_slots, profile=None):
+        #distance of every (ray, primitive) pair, np.inf for misses and for hits behind the ray, and the face it hit
+        self.primitive_tests += len(pair_rays)
+        t = np.full(len(pair_rays), np.inf, dtype=directions.dtype)
+        faces = self.primitive_faces[pair_slots]
+        types = self.primitive_types[pair_slots]
+        if profile is not None:
+            for type_code, count in enumerate(np.bincount(self.scene.object_types[self.primitive_objects[pair_slots]], minlength=len(type_names))):
+                if count:
+                    profile.count('tests.' + type_names[type_code], int(count))
+
+        scene = self.scene
+        triangles = types == TRIANGLE
+        if triangles.any():
+            rays, rows = pair_rays[triangles], self.primitive_rows[pair_slots[triangles]]
+            t[triangles] = intersect_triangles(origins[rays], directions[rays], scene.triangle_v0[rows], scene.triangle_edge1[rows], scene.triangle_edge2[rows])[0]
+
+        meshes = types == MESH
+        if meshes.any():
+            rays, rows = pair_rays[meshes], self.primitive_rows[pair_slots[meshes]]
+            t[meshes] = intersect_triangles(origins[rays], directions[rays], *scene.mesh_triangles(rows))[0]
+
+        spheres = types == SPHERE
+        if spheres.any():
+            rays, rows = pair_rays[spheres], self.primitive_rows[pair_slots[spheres]]
+            t[spheres] = intersect_spheres(origins[rays], directions[rays], scene.sphere_centers[rows], scene.sphere_radii_squared[rows])[0]
+
+        #anything else with bounds falls back to the object's own intersect_batch, instances go through their mesh's BVH
+        others = np.flatnonzero(~triangles & ~meshes & ~spheres)
+        for slot in np.unique(pair_slots[others]):
+            pairs = others[pair_slots[others] == slot]
+            rays = pair_rays[pairs]
+            index = self.primitive_objects[slot]
+            if self.scene.object_types[index] == INSTANCE:
+                t[pairs], _, faces[pairs] = self.objects[index].closest_hit_batch(origins[rays], directions[rays], profile, return_faces=True)
+            else:
+                t[pairs] = self.objects[index].intersect_batch(origins[rays], directions[rays])[0]
+
+        t[t <= 0] = np.inf
+        return t, faces
+
+def surface_area(box_min, box_max):
+    extent = box_max - box_min
+    return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+def bounding_cone(directions):
+    #(unit axis, half angle) of a cone around all the directions. The axis is their average, a tiny margin covers the rounding.
+    #it's worked out in float64 whatever the precision, arccos is too touchy near 1 for float32
+    directions = directions.astype(np.float64)
+    axis = directions.sum(axis=0)
+    axis = axis / np.linalg.norm(axis)
+    return axis, np.arccos(np.clip((directions @ axis).min(), -1, 1)) + 1e-6
+
+def cone_hits_boxes(apex, axis, angle, box_min, box_max):
+    #mask of the boxes that may be inside the cone, going by their bounding spheres: a sphere at distance d and radius r is seen
+    #under asin(r / d) from the apex, so it can be in the cone if its center is less than the cone's angle plus that off the axis
+    apex = apex.astype(np.float64)
+    box_min = box_min.astype(np.float64)
+    box_max = box_max.astype(np.float64)
+    centers = (box_min + box_max) / 2
+    radii = np.linalg.norm(box_max - box_min, axis=1) / 2
+    offsets = centers - apex
+    distances = np.linalg.norm(offsets, axis=1)
+    inside = distances <= radii
+    safe_distances = np.where(inside, 1, distances)
+    center_angles = np.arccos(np.clip(offsets @ axis / safe_distances, -1, 1))
+    return inside | (center_angles <= angle + np.arcsin(np.minimum(radii / safe_distances, 1)))
+
+def cone_reaches_plane(apex, axis, angle, height):
+    #whether any direction in the cone goes towards the horizontal plane at that height, i.e. is less than 90 degrees off straight towards it
+    if apex[1] == height:
+        return True
+    towards = -1.0 if apex[1] > height else 1.0
+    return np.arccos(np.clip(axis[1] * towards, -1, 1)) < np.pi / 2 + angle
+
+def round_outwards(box_min, box_max, dtype):
+    #the boxes in dtype, one step further out than the nearest value when that's a narrower type so they can only grow
+    if np.dtype(dtype).itemsize >= box_min.dtype.itemsize:
+        return box_min.astype(dtype), box_max.astype(dtype)
+    return np.nextafter(box_min.astype(dtype), dtype(-np.inf)), np.nextafter(box_max.astype(dtype), dtype(np.inf))
+
+def safe_inverse(directions):
+    #1 / direction for the slab test. Zero components get a tiny stand in so we end up with huge numbers instead of inf * 0 = nan
+    directions = floats(directions)
+    return 1.0 / np.where(directions == 0, 1e-30, directions)
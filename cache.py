@@ -0,0 +1,33 @@
+import hashlib
+import os
+import numpy as np
+
+#decoded/parsed assets get saved here as .npy files so the next run can just memory map them.
+#it sits next to the code rather than in the working directory, so running from somewhere else still finds it
+cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+def cache_key(filename, suffix=""):
+    #path prefix for the cached versions of filename. It's keyed on the file's absolute path, modification time and size,
+    #so editing the file makes the old cache entries unreachable and two files that only share a name don't get each other's.
+    #the name is kept in front so the cache stays readable
+    stat = os.stat(filename)
+    path_hash = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:16]
+    return os.path.join(cache_directory, f"{os.path.basename(filename)}-{path_hash}-{stat.st_mtime_ns}-{stat.st_size}{suffix}")
+
+def load_array(filename):
+    #memory mapped so huge arrays don't get read until they're used, None if it isn't cached
+    if not os.path.exists(filename):
+        return None
+    return np.load(filename, mmap_mode='r')
+
+def save_array(filename, data):
+    #caching is best effort, a read only checkout just redoes the work every time
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        #write to a temporary file first so a crash (or another process) never sees half an array
+        temporary = filename + f".{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            np.save(file, data)
+        os.replace(temporary, filename)
+    except OSError:
+        pass
@@ -1,5 +1,7 @@
 import numpy as np
+import precision
 from ray import Ray
+from objectHandler import dot_rows
 
 class Camera:
     def __init__(self, position, screenWidth, screenHeight, fov):
@@ -7,14 +9,17 @@ class Camera:
         self.screenWidth = screenWidth
         self.screenHeight = screenHeight
         self.fov = fov
+        #the rays come out in the precision the camera was made in, see precision.py
+        self.dtype = precision.dtype
 
-    def castRay(self, x, y):
+    def castRay(self, x, y, offset_x=0.5, offset_y=0.5):
+        #offset_x/offset_y pick where in the pixel the ray goes through, between 0 and 1. The center by default, antialiasing moves it around
         aspect_ratio = self.screenWidth / self.screenHeight
 
         #we center x and y since a pixel is usually defined by its top left corner
         #aka the point (2,2) is the topleft corner of the (2,2) pixel. We don't want that.
         #what we want is (2.5, 2.5), aka the center of the (2,2) pixel.
-        centeredX = x + 0.5
+        centeredX = x + offset_x
         #divide the x position by screen width to normalize it, *2 so it's between [0, 2] then subtract 1 so its between [-1, 1] where -1 is the absolute left of the screen and 1 is the absolute right.
         screenNormalizedX = 2 * centeredX / self.screenWidth - 1
         #scale x by aspect ratio to determine its proper position on the screen
@@ -23,12 +28,42 @@ class Camera:
         #I just stole the equation under this comment. Give me like 2 weeks ill probably understand what it does 
         screenX = screenScaledX * np.tan(np.radians(self.fov) / 2)
 
-        centeredY = y + 0.5
+        centeredY = y + offset_y
         #same as normalizing X except we subtract the value from 1 because in most graphic frameworks (like pygame) (0, 0) is at the top left of the screen rather that bottom left
         screenY = 1 - 2 * centeredY / self.screenHeight
 
-        direction = np.array([screenX, screenY, -1])
+        direction = np.array([screenX, screenY, -1], dtype=self.dtype)
         #Z=-1 since we want the ray to be going OUT of the camera AWAY from the viewer. 1 would make it go towards the screen/viewer.
         direction = direction / np.linalg.norm(direction)
 
-        return Ray(self.position, direction)
\ No newline at end of file
+        return Ray(self.position, direction)
+
+    def castRays(self, x0=0, y0=0, width=None, height=None):
+        #batched version of castRay. Returns the origins and directions of every pixel in a tile (or the whole frame by default)
+        #as two contiguous (N, 3) arrays in row major order, so pixel (x, y) of the tile lives at index (y - y0) * width + (x - x0).
+        if width is None:
+            width = self.screenWidth - x0
+        if height is None:
+            height = self.screenHeight - y0
+
+        #these only depend on the camera so we compute them once per tile instead of once per pixel
+        aspect_ratio = self.screenWidth / self.screenHeight
+        fov_scale = np.tan(np.radians(self.fov) / 2)
+
+        #same math as castRay, just on a whole row/column at once
+        centeredX = np.arange(x0, x0 + width, dtype=np.float64) + 0.5
+        screenX = (2 * centeredX / self.screenWidth - 1) * aspect_ratio * fov_scale
+        centeredY = np.arange(y0, y0 + height, dtype=np.float64) + 0.5
+        screenY = 1 - 2 * centeredY / self.screenHeight
+
+        directions = np.empty((height * width, 3), dtype=self.dtype)
+        directions[:, 0] = np.tile(screenX, height)
+        directions[:, 1] = np.repeat(screenY, width)
+        directions[:, 2] = -1
+        #same as np.linalg.norm in castRay (dot_rows rounds like np.dot), so the rays come out bit for bit the same as castRay's
+        directions /= np.sqrt(dot_rows(directions, directions))[:, None]
+
+        origins = np.empty((height * width, 3), dtype=self.dtype)
+        origins[:] = self.position
+
+        return origins, directions
@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import os
+import pickle
+import queue
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from renderer import Framebuffer, render_tile, split_tiles, new_counts, merge_counts
+from profiler import Profile
+import precision
+
+#renders frames across several machines. Every worker is a long running process listening on a TCP port
+#(python distributed.py worker --listen host:port), a Coordinator connects to all of them and hands out tiles one at a time.
+#   the scene, its BVH and the skybox get pickled once and sent to a worker the first time it needs them. Workers keep the
+#   last few scenes they got keyed by the sha256 of that pickle, so the next frames (or the next run with the same scene) only send
+#   the camera, the lights and the settings along with every tile.
+#   a tile whose worker dies or takes longer than the timeout goes back in the queue for the others, and that worker is dropped.
+#messages are pickles, which run code when they're loaded, so both ends only talk to peers that know the authkey (multiprocessing's
+#HMAC handshake). Still only run workers on networks you trust.
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def scene_payload(job):
+    #the part of a job that's the same from frame to frame, pickled, and its content hash
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    payload = pickle.dumps((scene, bvh, skybox), protocol=pickle.HIGHEST_PROTOCOL)
+    return hashlib.sha256(payload).hexdigest(), payload
+
+def frame_settings(job):
+    #the part of a job that gets sent with every tile
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    return camera, lights, reflection_depth, min_reflection_weight, antialiasing
+
+class WorkerConnection():
+    def __init__(self, address, connection, scenes):
+        self.address = address
+        self.connection = connection
+        #hashes of the scenes the worker has cached
+        self.scenes = set(scenes)
+
+    def render(self, key, payload, settings, tile, options, timeout):
+        #renders one tile on the worker, sending it the scene first if it doesn't have it. options is (profiling, packet_size).
+        #returns the worker's ('tile', tile, pixels, counts, profile) or ('error', traceback), raises OSError/EOFError if the worker died and TimeoutError if it took too long
+        if key not in self.scenes:
+            self.connection.send(('scene', payload))
+            self.scenes.add(key)
+        self.connection.send(('tile', key, settings, tile, options))
+        if not self.connection.poll(timeout):
+            raise TimeoutError(f"{self.address} took more than {timeout} s for tile {tile}")
+        message = self.connection.recv()
+        if message[0] == 'missing':
+            #the worker dropped the scene from its cache since it told us it had it
+            self.scenes.discard(key)
+            return self.render(key, payload, settings, tile, options, timeout)
+        return message
+
+    def close(self):
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+class Coordinator():
+    #addresses are (host, port) of running workers, the ones that can't be reached are skipped.
+    #timeout is how long a worker gets for a tile before its tile is given to someone else
+    def __init__(self, addresses, authkey, timeout=60):
+        self.timeout = timeout
+        self.workers = []
+        for address in addresses:
+            try:
+                connection = Client(address, authkey=authkey)
+                message = connection.recv()
+            except (OSError, EOFError, AuthenticationError) as error:
+                print(f"worker {address[0]}:{address[1]} unavailable: {error}")
+                continue
+            self.workers.append(WorkerConnection(address, connection, message[1]))
+        if not self.workers:
+            raise RuntimeError("no worker could be reached")
+        #(id(scene), id(bvh), id(skybox), geometry key) -> (hash, payload) of the last scene, so it isn't pickled again every frame
+        self.payload_key = None
+        self.payload = None
+
+    def render_frame(self, job, tile_size=32, on_tile=None, stats=None, profile=None, packet_size=None):
+        #same as renderer.render_frame, but the tiles are rendered by the workers
+        camera, scene, bvh, lights, skybox = job[:5]
+        payload_key = (id(scene), id(bvh), id(skybox), scene.geometry_key())
+        if payload_key != self.payload_key:
+            self.payload_key = payload_key
+            self.payload = scene_payload(job)
+        key, payload = self.payload
+        settings = frame_settings(job)
+
+        frame = Framebuffer(camera.screenWidth, camera.screenHeight)
+        tiles = split_tiles(camera.screenWidth, camera.screenHeight, tile_size)
+        frame_counts = new_counts()
+        pending = queue.Queue()
+        for tile in tiles:
+            pending.put(tile)
+        results = queue.Queue()
+
+        def feed(worker):
+            #one thread per worker, it keeps taking tiles until it gets None. If the worker fails its tile goes back in the queue
+            while True:
+                tile = pending.get()
+                if tile is None:
+                    return
+                try:
+                    results.put(worker.render(key, payload, settings, tile, (profile is not None, packet_size), self.timeout))
+                except (OSError, EOFError, TimeoutError) as error:
+                    print(f"worker {worker.address[0]}:{worker.address[1]} dropped: {type(error).__name__} {error}")
+                    worker.close()
+                    pending.put(tile)
+                    results.put(('dropped', worker))
+                    return
+
+        threads = [threading.Thread(target=feed, args=(worker,), daemon=True) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+
+        done = set()
+        try:
+            while len(done) < len(tiles):
+                message = results.get()
+                if message[0] == 'dropped':
+                    self.workers.remove(message[1])
+                    if not self.workers:
+                        raise RuntimeError(f"every worker failed, {len(tiles) - len(done)} tiles left")
+                    continue
+                if message[0] == 'error':
+                    raise RuntimeError(f"a worker failed to render a tile:\n{message[1]}")
+                _, (x0, y0, width, height), pixels, counts, tile_profile = message
+                if (x0, y0) in done:
+                    continue
+                done.add((x0, y0))
+                frame.pixels[y0:y0 + height, x0:x0 + width] = pixels
+                merge_counts(frame_counts, counts)
+                if tile_profile is not None:
+                    profile.merge(tile_profile)
+                if on_tile is not None:
+                    on_tile(x0, y0, pixels)
+        finally:
+            for _ in threads:
+                pending.put(None)
+
+        if stats is not None:
+            stats.update(frame_counts)
+        return frame.pixels
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        self.close()
+
+def serve(address, authkey, cache_size=4):
+    #worker loop: serves one coordinator at a time, forever. The scenes cache (hash -> (scene, bvh, skybox)) outlives the connections
+    scenes = {}
+    with Listener(address, authkey=authkey) as listener:
+        print(f"worker listening on {address[0]}:{address[1]}")
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as error:
+                print(f"refused a connection: {error}")
+                continue
+            with connection:
+                try:
+                    serve_connection(connection, scenes, cache_size)
+                except (OSError, EOFError):
+                    pass
+
+def serve_connection(connection, scenes, cache_size):
+    connection.send(('ready', list(scenes)))
+    while True:
+        message = connection.recv()
+        if message[0] == 'scene':
+            payload = message[1]
+            key = hashlib.sha256(payload).hexdigest()
+            scenes.pop(key, None)
+            scenes[key] = pickle.loads(payload)
+            #dicts keep insertion order, so the first one is the scene that was sent the longest ago
+            while len(scenes) > cache_size:
+                del scenes[next(iter(scenes))]
+        elif message[0] == 'tile':
+            _, key, settings, (x0, y0, width, height), (profiling, packet_size) = message
+            if key not in scenes:
+                connection.send(('missing', key))
+                continue
+            scene, bvh, skybox = scenes[key]
+            #whatever the worker builds from plain values should be in the scene's precision
+            precision.set_precision(scene.dtype)
+            camera, lights, reflection_depth, min_reflection_weight, antialiasing = settings
+            job = (camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing)
+            counts = new_counts()
+            profile = Profile() if profiling else None
+            try:
+                pixels = render_tile(job, x0, y0, width, height, counts, profile, packet_size)
+            except Exception:
+                connection.send(('error', traceback.format_exc()))
+                continue
+            connection.send(('tile', (x0, y0, width, height), pixels, counts, profile))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["worker"])
+    parser.add_argument("--listen", default="127.0.0.1:7700", help="host:port to listen on")
+    parser.add_argument("--processes", type=int, default=1, help="start this many workers, on the port and the ones after it")
+    parser.add_argument("--authkey", default=os.environ.get("RAYTRACER_AUTHKEY"), help="shared secret with the coordinator (default: $RAYTRACER_AUTHKEY)")
+    parser.add_argument("--cache-size", type=int, default=4, help="number of scenes every worker keeps around")
+    arguments = parser.parse_args()
+    if not arguments.authkey:
+        parser.error("an --authkey (or $RAYTRACER_AUTHKEY) is needed")
+
+    host, port = parse_address(arguments.listen)
+    authkey = arguments.authkey.encode()
+    if arguments.processes <= 1:
+        serve((host, port), authkey, arguments.cache_size)
+    else:
+        processes = [multiprocessing.Process(target=serve, args=((host, port + index), authkey, arguments.cache_size)) for index in range(arguments.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
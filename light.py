@@ -1,17 +1,72 @@
 import numpy as np
 
 class Light():
-    def __init__(self, position, color, strength):
+    #radius: if set, the light fades out with distance and doesn't reach anything past it, which lets it be skipped for far away surfaces.
+    #without one it lights everything at full strength like it always did.
+    def __init__(self, position, color, strength, radius=None):
         self.position = position
         self.color = np.array(color)/255
         #you really want to normalize light color into a [0,1] range otherwise it just comes out completely scuffed
         #but this also means colors don't really mix well?
         #not sure, but if there's a fix to this it's either here or in the final_color calculation. TODO
         self.strength = strength
+        self.radius = radius
 
     def calculate_direction(self, intersection_point):
         #normalization is just V = (P - L) / (|P - L|)
         vector = self.position - intersection_point 
         #np.linalg.norm(vector) is just distance (sqrt(x^2 + y^2 + z^2))
         normalized_vector = vector / np.linalg.norm(vector)
-        return normalized_vector
\ No newline at end of file
+        return normalized_vector
+
+    def calculate_direction_batch(self, intersection_points):
+        #same as calculate_direction for an (N, 3) array of points
+        vectors = np.array(self.position) - np.asarray(intersection_points)
+        return vectors / np.linalg.norm(vectors, axis=1)[:, None]
+
+    def attenuation_batch(self, distances):
+        #how much of the light is left at every distance, smooth falloff from 1 at the light to 0 at its radius
+        if self.radius is None:
+            return np.ones_like(distances)
+        return np.clip(1 - (distances / self.radius)**2, 0, 1)**2
+
+def lights_near(lights, box_min, box_max):
+    #indices of the lights that can reach anything inside the box, lights without a radius always can
+    indices = []
+    for index, light in enumerate(lights):
+        if light.radius is not None:
+            closest = np.clip(light.position, box_min, box_max)
+            if np.sum((closest - light.position)**2) >= light.radius**2:
+                continue
+        indices.append(index)
+    return indices
+
+def cull_lights(lights, points, normals, min_contribution=1/255):
+    #(point, light) pairs worth tracing a shadow ray for, as arrays: point index, light index, unit direction to the light,
+    #distance to the light and attenuation. A light is skipped for a point if the point is past its radius, if it's behind
+    #the surface (normal . direction <= 0), or if even unshadowed it would add less than min_contribution of the surface color.
+    #the default threshold only drops lights that would add less than 1 to a 0-255 channel.
+    #lights are first culled against the bounding box of all the points, so the per point work only scales with the lights nearby.
+    pair_points = []
+    pair_lights = []
+    pair_directions = []
+    pair_distances = []
+    pair_attenuations = []
+    if len(points):
+        for light_index in lights_near(lights, points.min(axis=0), points.max(axis=0)):
+            light = lights[light_index]
+            vectors = np.array(light.position, dtype=points.dtype) - points
+            distances = np.linalg.norm(vectors, axis=1)
+            directions = vectors / distances[:, None]
+            attenuations = light.attenuation_batch(distances)
+            facing = np.einsum('ij,ij->i', normals, directions)
+            contribution = np.maximum(0, facing) * light.strength * attenuations * np.max(light.color)
+            keep = np.flatnonzero((facing > 0) & (contribution >= min_contribution))
+            pair_points.append(keep)
+            pair_lights.append(np.full(len(keep), light_index))
+            pair_directions.append(directions[keep])
+            pair_distances.append(distances[keep])
+            pair_attenuations.append(attenuations[keep])
+    if not pair_points:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=points.dtype), np.zeros(0, dtype=points.dtype), np.zeros(0, dtype=points.dtype)
+    return np.concatenate(pair_points), np.concatenate(pair_lights), np.concatenate(pair_directions), np.concatenate(pair_distances), np.concatenate(pair_attenuations)
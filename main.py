@@ -1,36 +1,39 @@
-import pygame
+import argparse
+import json
+import os
 import numpy as np
+import pygame
 from skybox import Skybox
 from camera import Camera
-from objectHandler import Sphere, Plane, Triangle, read_object
+from objectHandler import Sphere, Plane, Instance, load_mesh, make_transform
 from light import Light
-from ray import Ray
-
-def main():
-    pygame.init()
-
-    reflection_depth = 1
-
+from bvh import BVH
+from scene import Scene
+from renderer import render_frame, save_image
+from distributed import Coordinator, parse_address
+from profiler import Profile
+import precision
+
+def build_scene(screen_width=400, screen_height=300, reflection_depth=1, min_reflection_weight=0.01, skybox_cubemap=None, lamps=0, antialiasing=None, cubes=0):
     skybox_image = "skybox.png"
-    skybox = Skybox(skybox_image)
+    skybox = Skybox(skybox_image, skybox_cubemap)
 
-    screen_width = 400
-    screen_height = 300
     #camera_position = (0, 1, 3)
     camera_position = (-7, 3, 6)
 
     #standard FOV is 90, quake FOB is 110, play around with it if you want, looks funny.
     fov = 90
-    screen = pygame.display.set_mode((screen_width, screen_height))
-    pygame.display.set_caption("Ray Tracing from Ouedkniss")
 
     camera = Camera(camera_position, screen_width, screen_height, fov)
 
-    light = Light((-2, 6, 2), (255, 255, 255), 1)
-    #might add multi-light support later? probably?
-
-    cube_vertices, cube_faces, cube_normals = read_object("objects/cube.obj")
+    lights = [Light((-2, 6, 2), (255, 255, 255), 1)]
+    #small colored lamps scattered around the floor. They have a radius so every surface only pays for the ones close to it
+    generator = np.random.default_rng(0)
+    for _ in range(lamps):
+        position = tuple(generator.uniform((-15, -0.5, -10), (8, 2, 4)))
+        lights.append(Light(position, tuple(generator.integers(60, 256, 3)), 0.6, radius=4))
 
+    cube = load_mesh("objects/cube.obj", (200, 50, 50))
     objects = [
         #(x, y, z), radius, color
         #Sphere((0, 1, -5), 1, (200, 0, 0)),
@@ -43,107 +46,116 @@ def main():
         #y, color
         #Plane(-1, ((20, 20, 50), (40, 40, 100)), 0.5),
         Plane(-1, (20, 20, 50), 0.5),
+
+        #the whole cube is one indexed mesh
+        cube,
     ]
 
-    for index in range(len(cube_faces)):
-        point1 = cube_vertices[cube_faces[index][0]-1]
-        point2 = cube_vertices[cube_faces[index][1]-1]
-        point3 = cube_vertices[cube_faces[index][2]-1]
-        normal = cube_normals[index]
-        objects.append(Triangle(point1, point2, point3, (200, 50, 50), normal))
-
-    for y in range(screen_height):
-        for x in range(screen_width):
-            ray = camera.castRay(x, y)
-            #will probably refactor intersection detection later on so that it's based on the ray rather than the object. I think it'd be better that way?
-            closest_t = np.inf
-            closest_object = None
-            saved_intersection_point = None
-
-            for object in objects:
-                intersection_point, t = object.intersect(ray)
-                if intersection_point is not None:
-                    if t < closest_t:
-                        closest_t = t
-                        closest_object = object
-                        saved_intersection_point = intersection_point
-                        #find the intersection point of each object and render the closest one.
-            if closest_object:
-                vector = np.array(light.position) - np.array(saved_intersection_point)
-                normalized_vector = vector / np.linalg.norm(vector)
-                OG_obj_light_distance = np.linalg.norm(np.array(light.position) - np.array(saved_intersection_point))
-                shadow_ray = Ray(saved_intersection_point + normalized_vector * 1e-4, normalized_vector)
-                obstructed = False
-                for object in objects:
-                    if object is not closest_object:
-                        shadow_intersection_result = object.intersect(shadow_ray)
-                        if shadow_intersection_result[0] is not None:
-                            obj_light_distance = np.linalg.norm(np.array(light.position) - np.array(shadow_intersection_result[1]))
-                            if obj_light_distance < OG_obj_light_distance and obj_light_distance > 0:
-                                obstructed = True
-                                break
-                
-                #if the shadow ray could not successfully make it to the light source we color the pixel black, otherwise we proceed as usual.
-                if obstructed:
-                    closest_object.render(screen, x, y, saved_intersection_point, light, True)
-                else:
-                    #if the ray successfully makes it to the light source, we check for reflections
-                    if closest_object.reflection > 0:
-                        if reflection_depth > 0:
-                            #if the object has a reflection, we find the reflection ray and call the function
-                            reflection_direction = ray.direction - 2 * np.dot(ray.direction, closest_object.get_normal(saved_intersection_point)) * closest_object.get_normal(saved_intersection_point)
-                            reflection_ray = Ray(saved_intersection_point + reflection_direction * 1e-4, reflection_direction)
-                            closest_reflection_t = np.inf
-                            closest_reflection_object = None
-                            saved_reflection_point = None
-
-                            for reflection_object in objects:
-                                reflection_intersection_point, reflection_t = reflection_object.intersect(reflection_ray)
-                                if reflection_intersection_point is not None:
-                                    if reflection_t < closest_reflection_t:
-                                        closest_reflection_t = reflection_t
-                                        closest_reflection_object = reflection_object
-                                        saved_reflection_point = reflection_intersection_point
-
-                            if closest_reflection_object:
-                                
-                                reflection_normal = closest_reflection_object.get_normal(saved_reflection_point)
-                                reflection_light_direction = light.calculate_direction(saved_reflection_point)
-                                reflection_intensity = max(0, np.dot(reflection_normal, reflection_light_direction)) * light.strength
-                                closest_reflection_object_color = np.array(closest_reflection_object.color)
-                                final_color = closest_reflection_object_color * reflection_intensity * light.color
-                                final_color = np.clip(final_color, 0, 255)              
-
-                                mixed_color = np.array(closest_object.color) * (1 - closest_object.reflection) + np.array(final_color) * closest_reflection_object.reflection
-                                mixed_color = np.clip(mixed_color, 0, 255)
-                                closest_object.render(screen, x, y, saved_intersection_point, light, False, mixed_color)
-                            else:
-                                skybox_pixel = skybox.get_skybox_pixel(reflection_direction)[:3]
-                                mixed_color = np.array(closest_object.color) * (1 - closest_object.reflection) + np.array(skybox_pixel) * closest_object.reflection
-                                mixed_color = np.clip(mixed_color, 0, 255)
-
-                                closest_object.render(screen, x, y, saved_intersection_point, light, False, mixed_color)
-                        else:
-                            closest_object.render(screen, x, y, saved_intersection_point, light, False)
-                    else:
-                        closest_object.render(screen, x, y, saved_intersection_point, light)
-                pygame.display.update((x, y, 1, 1))
-            else:
-                #if there is no intersection, we find the corresponding pixel in the skybox
-                direction = ray.direction
-                normalized_direction = direction / np.linalg.norm(direction)
-                result = skybox.get_skybox_pixel(normalized_direction)
-                screen.set_at((x, y), result)
-                pygame.display.update((x, y, 1, 1))
-
-    pygame.display.flip()
-    running = True
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-
-    pygame.quit()
+    #copies of the cube lying around on the floor. They're instances so they all share the one mesh (and its BVH)
+    generator = np.random.default_rng(1)
+    for _ in range(cubes):
+        size = generator.uniform(0.2, 0.6)
+        position = (generator.uniform(-20, 10), -1 + size, generator.uniform(-25, 2))
+        #cube.obj sits around (0, 0, -5), move it to the origin first
+        transform = make_transform(position, size, (0, generator.uniform(0, 90), 0)) @ make_transform((0, 0, 5))
+        objects.append(Instance(cube, transform, tuple(generator.integers(40, 256, 3))))
+
+    #pack the objects into contiguous arrays, then build the acceleration structure once on top of them.
+    #every closest hit query goes through it instead of looping over all objects
+    scene = Scene(objects)
+    bvh = BVH(scene)
+    print(bvh.report())
+
+    return (camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing)
+
+def main(workers=1, tile_size=32, output=None, show_window=True, screen_width=400, screen_height=300, reflection_depth=1, min_reflection_weight=0.01, skybox_cubemap=None, profile=False, profile_output=None, lamps=0, antialiasing=None, cubes=0, distribute=None, authkey=None, worker_timeout=60, packet_size=None):
+    job = build_scene(screen_width, screen_height, reflection_depth, min_reflection_weight, skybox_cubemap, lamps, antialiasing, cubes)
+
+    #everything is rendered into a numpy framebuffer, the window (if there is one) only gets the finished tiles blitted onto it
+    on_tile = None
+    if show_window:
+        pygame.init()
+        screen = pygame.display.set_mode((screen_width, screen_height))
+        pygame.display.set_caption("Ray Tracing from Ouedkniss")
+
+        def on_tile(x0, y0, pixels):
+            screen.blit(pygame.surfarray.make_surface(pixels.swapaxes(0, 1)), (x0, y0))
+            pygame.display.update((x0, y0, pixels.shape[1], pixels.shape[0]))
+            #keep the window responsive while the rest of the frame renders
+            pygame.event.pump()
+
+    stats = {}
+    #profiling is opt in, it adds a timer call around every step of every pixel
+    frame_profile = Profile() if profile or profile_output else None
+    if distribute:
+        #tiles go to the worker processes at these (host, port) addresses instead of the local ones, see distributed.py
+        with Coordinator(distribute, authkey, worker_timeout) as coordinator:
+            pixels = coordinator.render_frame(job, tile_size, on_tile, stats, frame_profile, packet_size)
+    else:
+        pixels = render_frame(job, workers, tile_size, on_tile, stats, frame_profile, packet_size)
+    for depth, count in enumerate(stats['reflection_rays']):
+        print(f"reflection depth {depth + 1}: {count} rays")
+    if antialiasing is not None:
+        print(f"antialiasing: {stats['antialiasing_rays']} extra samples on {stats['antialiased_pixels']} edge pixels "
+              f"({stats['antialiased_pixels'] / stats['primary_rays']:.1%} of the frame)")
+    if packet_size:
+        print(f"packets: {stats['packet_bounds_culled']} of {stats['packet_bounds_tested']} bounds tests culled the packet "
+              f"({stats['packet_bounds_culled'] / max(stats['packet_bounds_tested'], 1):.1%})")
+    if profile:
+        print(frame_profile.report())
+    if profile_output is not None:
+        with open(profile_output, 'w') as file:
+            json.dump(frame_profile.as_dict(), file, indent=2)
+        print(f"saved {profile_output}")
+
+    if output is not None:
+        save_image(pixels, output)
+        print(f"saved {output}")
+
+    if show_window:
+        pygame.display.flip()
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+
+        pygame.quit()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes, 1 renders everything on the main process")
+    parser.add_argument("--tile-size", type=int, default=32, help="size in pixels of the square tiles the frame is split into")
+    parser.add_argument("--output", help="save the render to this file (.png or .ppm)")
+    parser.add_argument("--headless", action="store_true", help="don't open a window, just render to --output (render.png by default)")
+    parser.add_argument("--width", type=int, default=400)
+    parser.add_argument("--height", type=int, default=300)
+    parser.add_argument("--reflection-depth", type=int, default=1, help="maximum number of reflection bounces, 0 turns reflections off")
+    parser.add_argument("--min-reflection-weight", type=float, default=0.01, help="reflection paths contributing less than this are cut early")
+    parser.add_argument("--skybox-cubemap", type=int, help="resample the skybox into cubemap faces of this size for trig free lookups")
+    parser.add_argument("--lamps", type=int, default=0, help="add this many small colored lamps to the scene")
+    parser.add_argument("--cubes", type=int, default=0, help="scatter this many instanced copies of the cube around")
+    parser.add_argument("--antialiasing", type=int, default=0, metavar="GRID", help="give edge pixels GRID x GRID extra jittered samples, 0 turns it off")
+    parser.add_argument("--antialiasing-threshold", type=int, default=16, help="color difference (0-255) with a neighbour past which a pixel counts as an edge")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64", help="floating point precision of the whole ray pipeline, see precision.py")
+    parser.add_argument("--packets", type=int, default=0, metavar="SIZE", help="trace the camera rays in SIZE x SIZE packets culled by their frustum, 0 traces them one by one")
+    parser.add_argument("--profile", action="store_true", help="print time per stage, ray and intersection test counts and tile times after the frame")
+    parser.add_argument("--profile-json", help="write the profile to this JSON file")
+    parser.add_argument("--distribute", help="comma separated host:port of running workers (python distributed.py worker) to render the tiles on")
+    parser.add_argument("--authkey", default=os.environ.get("RAYTRACER_AUTHKEY"), help="shared secret with the workers (default: $RAYTRACER_AUTHKEY)")
+    parser.add_argument("--worker-timeout", type=float, default=60, help="seconds a worker gets for a tile before it's given to another one")
+    arguments = parser.parse_args()
+    #before anything gets built, every array takes the precision of when it's made
+    precision.set_precision(arguments.precision)
+
+    output = arguments.output
+    if arguments.headless and output is None:
+        output = "render.png"
+    antialiasing = (arguments.antialiasing, arguments.antialiasing_threshold) if arguments.antialiasing > 0 else None
+    distribute = None
+    if arguments.distribute:
+        if not arguments.authkey:
+            parser.error("--distribute needs an --authkey (or $RAYTRACER_AUTHKEY)")
+        distribute = [parse_address(address) for address in arguments.distribute.split(',')]
+    main(arguments.workers, arguments.tile_size, output, not arguments.headless, arguments.width, arguments.height, arguments.reflection_depth, arguments.min_reflection_weight, arguments.skybox_cubemap, arguments.profile, arguments.profile_json, arguments.lamps, antialiasing, arguments.cubes,
+         distribute, arguments.authkey.encode() if distribute else None, arguments.worker_timeout, arguments.packets or None)
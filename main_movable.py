@@ -1,64 +1,295 @@
+import argparse
+import copy
+import threading
+import time
 import pygame
 import numpy as np
 from camera import Camera
-from objectHandler import Sphere, Plane, Triangle, read_object
-from light import Light
-from ray import Ray
-
-def update_view(screen, render_surface, camera, objects, render_width, render_height, light):
-    #black background, will probably replace with a floor/skybox or something later
-    background_color = (135, 206, 235)
-    render_surface.fill(background_color)
-
-    for y in range(render_height):
-        for x in range(render_width):
-            ray = camera.castRay(x, y)
-            #will probably refactor intersection detection later on so that it's based on the ray rather than the object. I think it'd be better that way?
-            closest_t = np.inf
-            closest_object = None
-            saved_intersection_point = None
-
-            for object in objects:
-                intersection_point, t = object.intersect(ray)
-                if intersection_point is not None:
-                    if t < closest_t:
-                        closest_t = t
-                        closest_object = object
-                        saved_intersection_point = intersection_point
-                        #find the intersection point of each object and render the closest one.
-            if closest_object:
-                vector = np.array(light.position) - np.array(saved_intersection_point)
-                normalized_vector = vector / np.linalg.norm(vector)
-                OG_obj_light_distance = np.linalg.norm(np.array(light.position) - np.array(saved_intersection_point))
-                shadow_ray = Ray(saved_intersection_point + normalized_vector * 1e-4, normalized_vector)
-                obstructed = False
-                for object in objects:
-                    if object is not closest_object:
-                        shadow_intersection_result = object.intersect(shadow_ray)
-                        if shadow_intersection_result[0] is not None:
-                            obj_light_distance = np.linalg.norm(np.array(light.position) - np.array(shadow_intersection_result[1]))
-                            if obj_light_distance < OG_obj_light_distance and obj_light_distance > 0:
-                                obstructed = True
-                                break
-                if obstructed:
-                    closest_object.render(render_surface, x, y, saved_intersection_point, light, True)
-                else:
-                    closest_object.render(render_surface, x, y, saved_intersection_point, light)
-            else:
-                render_surface.set_at((x, y), background_color)
+from objectHandler import Sphere, Plane, load_mesh
+from light import Light, cull_lights
+from scene import Scene
+from shading import receives_shadow, shade
+import precision
+from precision import ray_offset
 
+#rays traced per step, long passes check between steps whether they should stop
+band_size = 16384
+
+def bands(count):
+    for start in range(0, count, band_size):
+        yield slice(start, min(start + band_size, count))
+
+class ShadowCache():
+    #light visibility of world space voxels cell_size wide, filled in lazily by the shadow rays GBuffer.shade needs and reused by every later
+    #frame (from any camera position or resolution) for points that fall in a voxel already seen. Only one ray gets traced per new voxel.
+    #it's a sparse voxel hash per light: the sorted packed coordinates of the voxels seen so far and whether they were in shadow.
+    #a light's table is dropped when it moves or its radius changes, all of them when the geometry changes (strength and color don't
+    #change what's in shadow). The price is that shadow edges turn into staircases of cell_size, hits/lookups are kept to tune it.
+    def __init__(self, cell_size=0.05):
+        self.cell_size = cell_size
+        self.geometry_key = None
+        #light index -> ((position, radius), voxel keys, occluded)
+        self.tables = {}
+        #of the last shade and since the start
+        self.hits = 0
+        self.lookups = 0
+        self.total_hits = 0
+        self.total_lookups = 0
+
+    def voxel_keys(self, points):
+        #the voxel coordinates packed 21 bits each into one int64, anything further than 2**20 cells out gets clamped to the border voxels
+        cells = np.clip(np.floor(points / self.cell_size).astype(np.int64) + 2**20, 0, 2**21 - 1)
+        return (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+
+    def occluded(self, scene, lights, points, pair_lights, light_directions, light_distances, cancelled=None):
+        #whether each (point, light) pair is in shadow like scene.any_hit_batch would say (give or take the voxel size),
+        #returns None if cancelled() says so between bands of shadow rays. Nothing is added to the cache then
+        geometry_key = scene.geometry_key()
+        if geometry_key != self.geometry_key:
+            self.geometry_key = geometry_key
+            self.tables = {}
+        keys = self.voxel_keys(points)
+        occluded = np.empty(len(keys), dtype=bool)
+        #the pair that gets traced for every new (light, voxel) and the pairs that take its result
+        traced = []
+        new_voxels = []
+        start = 0
+        for index, light in enumerate(lights):
+            state = (tuple(light.position), light.radius)
+            if index not in self.tables or self.tables[index][0] != state:
+                self.tables[index] = (state, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool))
+            _, table_keys, table_occluded = self.tables[index]
+            pairs = np.flatnonzero(pair_lights == index)
+            slots = np.minimum(np.searchsorted(table_keys, keys[pairs]), max(len(table_keys) - 1, 0))
+            found = table_keys[slots] == keys[pairs] if len(table_keys) else np.zeros(len(pairs), dtype=bool)
+            occluded[pairs[found]] = table_occluded[slots[found]]
+            missing = pairs[~found]
+            voxels, first, inverse = np.unique(keys[missing], return_index=True, return_inverse=True)
+            traced.append(missing[first])
+            new_voxels.append((index, voxels, start, missing, inverse))
+            start += len(voxels)
+
+        traced = np.concatenate(traced) if traced else np.zeros(0, dtype=np.int64)
+        origins = points[traced] + light_directions[traced] * ray_offset(points)
+        traced_occluded = np.empty(len(traced), dtype=bool)
+        for band in bands(len(traced)):
+            if cancelled is not None and cancelled():
+                return None
+            traced_occluded[band] = scene.any_hit_batch(origins[band], light_directions[traced[band]], light_distances[traced[band]])
+
+        for index, voxels, start, missing, inverse in new_voxels:
+            voxel_occluded = traced_occluded[start:start + len(voxels)]
+            occluded[missing] = voxel_occluded[inverse]
+            state, table_keys, table_occluded = self.tables[index]
+            table_keys = np.concatenate([table_keys, voxels])
+            order = np.argsort(table_keys)
+            self.tables[index] = (state, table_keys[order], np.concatenate([table_occluded, voxel_occluded])[order])
+
+        self.lookups = len(keys)
+        self.hits = len(keys) - sum(len(missing) for _, _, _, missing, _ in new_voxels)
+        self.total_lookups += self.lookups
+        self.total_hits += self.hits
+        return occluded
+
+    def report(self):
+        voxels = sum(len(table[1]) for table in self.tables.values())
+        last = self.hits / self.lookups if self.lookups else 0
+        total = self.total_hits / self.total_lookups if self.total_lookups else 0
+        return f"shadow cache: {last:.0%} hits last frame, {total:.0%} overall, {voxels} voxels ({self.cell_size} wide)"
+
+class GBuffer():
+    #per pixel primary visibility: the id of the object every camera ray hit (-1 for the background),
+    #the hit point, the normal there and its base color.
+    #none of that depends on the lights, so moving one or changing its strength only redoes the shadow rays and shading on top of this.
+    def __init__(self):
+        self.key = None
+
+    def update(self, camera, scene, cancelled=None):
+        #retraces the camera rays only if the camera or the scene's geometry changed since last time, returns True if it did.
+        #cancelled() is checked every band_size rays, if it returns True the update stops and returns None (the cache stays invalid)
+        key = (tuple(camera.position), camera.screenWidth, camera.screenHeight, camera.fov, id(scene), scene.geometry_key())
+        if key == self.key:
+            return False
+        self.key = None
+
+        origins, directions = camera.castRays()
+        t = np.empty(len(origins), dtype=origins.dtype)
+        object_ids = np.empty(len(origins), dtype=np.int64)
+        faces = np.empty(len(origins), dtype=np.int64)
+        for band in bands(len(origins)):
+            if cancelled is not None and cancelled():
+                return None
+            t[band], object_ids[band], faces[band] = scene.closest_hit_batch(origins[band], directions[band], return_faces=True)
+        hit = object_ids >= 0
+        self.object_ids = object_ids
+        self.hit = hit
+        self.points = np.zeros((len(hit), 3), dtype=origins.dtype)
+        self.points[hit] = origins[hit] + directions[hit] * t[hit, None]
+        self.normals = np.zeros((len(hit), 3), dtype=origins.dtype)
+        self.normals[hit] = scene.get_normals(object_ids[hit], self.points[hit], faces[hit])
+        self.colors = np.zeros((len(hit), 3), dtype=origins.dtype)
+        self.colors[hit] = scene.get_colors(object_ids[hit], self.points[hit])
+
+        self.receives_shadow = hit & receives_shadow(scene, np.maximum(object_ids, 0), self.points)
+
+        self.key = key
+        return True
+
+    def shade(self, scene, lights, background_color, cancelled=None, shadow_cache=None):
+        #(N, 3) pixel colors from the cached surfaces: shadow rays towards every light that reaches them (or their cached
+        #result, with a ShadowCache), then shading.shade on top. Returns None if cancelled() says so between bands of shadow rays
+        pixels = np.empty((len(self.hit), 3), dtype=self.points.dtype)
+        pixels[:] = background_color
+        points = self.points[self.hit]
+        normals = self.normals[self.hit]
+
+        #one shadow ray per (point, light) pair that can actually light the point, see cull_lights
+        pair_points, pair_lights, light_directions, light_distances, attenuations = cull_lights(lights, points, normals)
+        if shadow_cache is not None:
+            obstructed = shadow_cache.occluded(scene, lights, points[pair_points], pair_lights, light_directions, light_distances, cancelled)
+            if obstructed is None:
+                return None
+        else:
+            #only things between the point and the light can block it. The object itself is tested too so concave meshes can shadow themselves.
+            shadow_origins = points[pair_points] + light_directions * ray_offset(points)
+            obstructed = np.empty(len(pair_points), dtype=bool)
+            for band in bands(len(pair_points)):
+                if cancelled is not None and cancelled():
+                    return None
+                obstructed[band] = scene.any_hit_batch(shadow_origins[band], light_directions[band], light_distances[band])
+
+        pixels[self.hit] = shade(self.colors[self.hit], normals, self.receives_shadow[self.hit], lights,
+                                 pair_points, pair_lights, light_directions, attenuations, obstructed)
+        return pixels
+
+#black background, will probably replace with a floor/skybox or something later
+background_color = (135, 206, 235)
+
+def render_pixels(camera, objects, lights, gbuffer=None, cancelled=None, shadow_cache=None):
+    #renders a frame into an (H, W, 3) uint8 array, None if cancelled() returned True midway.
+    #only touches numpy arrays so it can run off the main thread
+    #the camera rays are only traced again when the camera or the objects moved, see GBuffer
+    if gbuffer is None:
+        gbuffer = GBuffer()
+    if gbuffer.update(camera, objects, cancelled) is None:
+        return None
+    pixels = gbuffer.shade(objects, lights, background_color, cancelled, shadow_cache)
+    if pixels is None:
+        return None
+    #astype truncates like set_at does with float colors
+    return pixels.reshape(camera.screenHeight, camera.screenWidth, 3).astype(np.uint8)
+
+def show_frame(screen, pixels):
     #we do a lil scaling
-    scaled_surface = pygame.transform.scale(render_surface, screen.get_size())
+    scaled_surface = pygame.transform.scale(pygame.surfarray.make_surface(pixels.swapaxes(0, 1)), screen.get_size())
     screen.blit(scaled_surface, (0, 0))
 
-def main():
+def level_sizes(display_width, display_height, coarsest=32):
+    #progressive render resolutions from the display size down, halving until the width gets below display_width / coarsest
+    sizes = [(display_width, display_height)]
+    while sizes[-1][0] // 2 >= max(1, display_width // coarsest) and sizes[-1][1] // 2 >= 1:
+        sizes.append((sizes[-1][0] // 2, sizes[-1][1] // 2))
+    return sizes[::-1]
+
+def pick_level(sizes, seconds_per_pixel, target_frame_time):
+    #finest level expected to render within target_frame_time, the coarsest one if nothing does (or we have no estimate yet)
+    level = 0
+    if seconds_per_pixel is None:
+        return level
+    for index, (width, height) in enumerate(sizes):
+        if width * height * seconds_per_pixel <= target_frame_time:
+            level = index
+    return level
+
+#posted by the render thread whenever it has a new frame
+frame_ready = pygame.USEREVENT + 1
+
+class RenderThread(threading.Thread):
+    #renders frames off the event loop so input keeps getting handled while a frame is in progress.
+    #request() hands it a copy of the latest camera and lights. It renders that progressively: first the finest level that fits
+    #in target_frame_time, then doubling the resolution level by level. A newer request cancels whatever it's doing (checked between
+    #bands of rays), so a burst of key presses only ever renders the last state and stale frames never make it to the screen.
+    #finished passes wait in self.frame (only the newest one is kept) and a frame_ready event is posted for the main loop.
+    def __init__(self, objects, sizes, target_frame_time, shadow_cache=None):
+        super().__init__(daemon=True)
+        self.objects = objects
+        self.sizes = sizes
+        self.target_frame_time = target_frame_time
+        #every level keeps its own G-buffer, so going back to a level after a light change only reshades it
+        self.gbuffers = [GBuffer() for _ in sizes]
+        #the shadow cache is in world space, so all the levels share it
+        self.shadow_cache = shadow_cache
+        self.seconds_per_pixel = None
+
+        self.condition = threading.Condition()
+        #bumped by every request, a pass is stale as soon as it doesn't match anymore
+        self.generation = 0
+        self.pending = None
+        self.frame = None
+        self.running = True
+
+    def request(self, camera, lights):
+        #positions get replaced rather than modified in place, so shallow copies are enough to freeze the state
+        with self.condition:
+            self.pending = (copy.copy(camera), [copy.copy(light) for light in lights])
+            self.generation += 1
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.generation += 1
+            self.condition.notify()
+        self.join()
+
+    def take_frame(self):
+        #newest finished frame as an (H, W, 3) array, or None if there's nothing new
+        with self.condition:
+            frame, self.frame = self.frame, None
+        return frame
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                camera, lights = self.pending
+                self.pending = None
+                generation = self.generation
+
+            def cancelled():
+                return self.generation != generation
+
+            level = pick_level(self.sizes, self.seconds_per_pixel, self.target_frame_time)
+            while level < len(self.sizes) and not cancelled():
+                width, height = self.sizes[level]
+                level_camera = Camera(camera.position, width, height, camera.fov)
+                start_time = time.perf_counter()
+                pixels = render_pixels(level_camera, self.objects, lights, self.gbuffers[level], cancelled, self.shadow_cache)
+                if pixels is None:
+                    break
+                #keep a running estimate of the cost per pixel to pick the next coarse level
+                measured = (time.perf_counter() - start_time) / (width * height)
+                self.seconds_per_pixel = measured if self.seconds_per_pixel is None else (self.seconds_per_pixel + measured) / 2
+
+                with self.condition:
+                    if self.generation == generation:
+                        self.frame = pixels
+                        pygame.event.post(pygame.event.Event(frame_ready))
+                level += 1
+
+def main(display_width=900, display_height=600, target_frame_time=0.1, progressive=True, shadow_cache_cell=None, warm_lamp=False):
+    #progressive: right after a key press the frame is rendered at the finest resolution that fits in target_frame_time (going by how long
+    #the last passes took), then it's refined by doubling the resolution up to the display's while nothing happens.
+    #a key press drops the pass in progress. Without it every frame is rendered at a fixed 75x50.
+    #rendering happens on a RenderThread, this loop only handles input and puts finished frames on the screen.
+    #shadow_cache_cell turns on the ShadowCache with voxels that size, its hit rate goes in the window title.
+    #warm_lamp adds a second, small light by the spheres.
     pygame.init()
-    #if this is true, we move the camera
-    #if it's false, we move the light
     render_width = 75
     render_height = 50
-    display_width = 900
-    display_height = 600
     camera_position = (-7, 3, 6)
     #standard FOV is 90, quake FOV is 110, play around with it if you want, looks funny.
     fov = 90
@@ -66,11 +297,11 @@ def main():
     pygame.display.set_caption("Ray Tracing from Ouedkniss")
     camera = Camera(camera_position, render_width, render_height, fov)
     moving_object = camera
-    #(x, y, z), radius
-    light = Light((14, 6, 10), (255, 255, 255), 1)
-    #might add multi-light support later? probably?
-
-    cube_vertices, cube_faces, cube_normals = read_object("objects/cube.obj")
+    #(x, y, z), color, strength
+    lights = [Light((14, 6, 10), (255, 255, 255), 1)]
+    if warm_lamp:
+        #a small warm lamp by the spheres, it has a radius so it only lights what's close to it
+        lights.append(Light((-10, 1.5, 1), (255, 170, 80), 0.8, radius=6))
 
     objects = [
         #(x, y, z), radius, color
@@ -83,26 +314,40 @@ def main():
         #Triangle((-4, 0, -3), (-1, 4, -5), (-1, 0, -3), (25, 25, 200)),
 
         #y, color
-        Plane(-1, ((50, 50, 50), (80, 80, 80)))
-    ]
+        Plane(-1, ((50, 50, 50), (80, 80, 80))),
 
-    for index in range(len(cube_faces)):
-        point1 = cube_vertices[cube_faces[index][0]-1]
-        point2 = cube_vertices[cube_faces[index][1]-1]
-        point3 = cube_vertices[cube_faces[index][2]-1]
-        normal = cube_normals[index]
-        objects.append(Triangle(point1, point2, point3, (200, 50, 50), normal))
+        #the whole cube is one indexed mesh
+        load_mesh("objects/cube.obj", (200, 50, 50)),
+    ]
+    #packed into contiguous arrays, the objects stay usable one by one as views into them
+    objects = Scene(objects)
 
-    render_surface = pygame.Surface((render_width, render_height))
+    if progressive:
+        sizes = level_sizes(display_width, display_height)
+    else:
+        sizes = [(render_width, render_height)]
+    shadow_cache = None if shadow_cache_cell is None else ShadowCache(shadow_cache_cell)
+    render_thread = RenderThread(objects, sizes, target_frame_time, shadow_cache)
+    render_thread.start()
+    render_thread.request(camera, lights)
 
     running = True
     while running:
-        update_view(screen, render_surface, camera, objects, render_width, render_height, light)
-        pygame.display.flip()
-        for event in pygame.event.get():
+        #block until something happens instead of spinning, then go through everything that's queued up
+        #so a burst of key presses turns into a single request
+        changed = False
+        for event in [pygame.event.wait()] + pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            if event.type == frame_ready:
+                pixels = render_thread.take_frame()
+                if pixels is not None:
+                    show_frame(screen, pixels)
+                    pygame.display.flip()
+                    if shadow_cache is not None:
+                        pygame.display.set_caption(f"Ray Tracing from Ouedkniss ({shadow_cache.report()})")
             if event.type == pygame.KEYDOWN:
+                changed = True
                 if event.key == pygame.K_LEFT:
                     moving_object.position = (moving_object.position[0] - 1, moving_object.position[1], moving_object.position[2])
                 if event.key == pygame.K_RIGHT:
@@ -111,24 +356,41 @@ def main():
                     moving_object.position = (moving_object.position[0], moving_object.position[1] - 1, moving_object.position[2])
                 if event.key == pygame.K_SPACE:
                     moving_object.position = (moving_object.position[0], moving_object.position[1] + 1, moving_object.position[2])
+                #F1/F2 change the strength of the selected light (the first one while moving the camera)
+                selected_light = lights[0] if moving_object is camera else moving_object
                 if event.key == pygame.K_F1:
-                    light.strength += 0.25
+                    selected_light.strength += 0.25
                 if event.key == pygame.K_F2:
-                    light.strength -= 0.25
+                    selected_light.strength -= 0.25
                 if event.key == pygame.K_UP:
                     moving_object.position = (moving_object.position[0], moving_object.position[1], moving_object.position[2] - 1)
                 if event.key == pygame.K_DOWN:
                     moving_object.position = (moving_object.position[0], moving_object.position[1], moving_object.position[2] + 1)
 
+                #the camera or one of the lights, LCTRL goes through them
                 if event.key == pygame.K_LCTRL:
-                    if moving_object == camera:
-                        moving_object = light
-                        print("swapped to light")
-                    else:
-                        moving_object = camera
-                        print("swapped to camera")
+                    movable = [camera] + lights
+                    index = (next(i for i, thing in enumerate(movable) if thing is moving_object) + 1) % len(movable)
+                    moving_object = movable[index]
+                    print("swapped to camera" if index == 0 else f"swapped to light {index}")
+
+        if changed and running:
+            render_thread.request(camera, lights)
 
+    render_thread.stop()
+    if shadow_cache is not None:
+        print(shadow_cache.report())
     pygame.quit()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=900, help="window width, the finest progressive pass renders at this size")
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--frame-time", type=float, default=0.1, help="target time in seconds for the first (coarse) pass after a key press")
+    parser.add_argument("--no-progressive", action="store_true", help="always render at a fixed 75x50 instead")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64", help="floating point precision of the whole ray pipeline, see precision.py")
+    parser.add_argument("--shadow-cache", type=float, metavar="CELL", help="reuse shadow rays across frames in world space voxels of this size")
+    parser.add_argument("--warm-lamp", action="store_true", help="add a small warm lamp with a limited radius by the spheres")
+    arguments = parser.parse_args()
+    precision.set_precision(arguments.precision)
+    main(arguments.width, arguments.height, arguments.frame_time, not arguments.no_progressive, arguments.shadow_cache, arguments.warm_lamp)
@@ -1,98 +1,442 @@
 import numpy as np
 from ray import Ray
+from cache import cache_key, load_array, save_array
+import precision
+from precision import floats, triangle_epsilon
 
 shadowMultiplier = 0.2
 
-def read_object(filename):
-    vertices = []
-    faces = []
-    normals = []
+#arrays returned by load_obj, they're also the names of its cached .npy files
+mesh_arrays = ('vertices', 'faces', 'face_normals', 'normals', 'face_normal_indices', 'texcoords', 'face_texcoord_indices')
 
+def read_object(filename):
+    #vertices (V, 3), faces (F, 3) with 0 based vertex indices and one flat normal per face (F, 3)
+    mesh = load_obj(filename)
+    return mesh['vertices'], mesh['faces'], mesh['face_normals']
+
+def load_mesh(filename, color, reflection=0, smooth=False):
+    #loads an OBJ file as a single Mesh. With smooth the normals are interpolated over the faces, using the file's vn
+    #when every corner has one and the average normal of the faces around every vertex otherwise.
+    mesh = load_obj(filename)
+    vertices, faces = mesh['vertices'], mesh['faces']
+    normals = normal_indices = None
+    if smooth:
+        if len(faces) and (mesh['face_normal_indices'] >= 0).all():
+            normals, normal_indices = mesh['normals'], mesh['face_normal_indices']
+        else:
+            normals, normal_indices = vertex_normals(vertices, faces), faces
+    return Mesh(vertices, faces, color, mesh['face_normals'], normals, normal_indices, reflection)
+
+def vertex_normals(vertices, faces):
+    #(V, 3) normal of every vertex, the sum of the faces around it weighted by their area (the cross product's length is twice the area)
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    weighted = np.cross(v1 - v0, v2 - v0)
+    normals = np.zeros((len(vertices), 3))
+    for corner in range(3):
+        np.add.at(normals, faces[:, corner], weighted)
+    return normalize_rows(normals)
+
+def load_obj(filename, use_cache=True):
+    #parses an OBJ file straight into numpy arrays (see parse_obj). The result is cached as .npy files keyed on the
+    #file's mtime and size, so loading the same mesh again is just a few memory maps.
+    key = cache_key(filename, "-mesh") if use_cache else None
+    if key is not None:
+        mesh = {name: load_array(f"{key}-{name}.npy") for name in mesh_arrays}
+        if all(array is not None for array in mesh.values()):
+            return mesh
+
+    mesh = parse_obj(filename)
+    if key is not None:
+        for name in mesh_arrays:
+            save_array(f"{key}-{name}.npy", mesh[name])
+    return mesh
+
+def parse_obj(filename):
+    #supports v, vn, vt and f lines with any of the f v, v/vt, v//vn and v/vt/vn forms, negative (relative) indices,
+    #and polygons (fan triangulated). Returns a dict with:
+    #   vertices (V, 3) float, faces (F, 3) int (0 based)
+    #   face_normals (F, 3): one flat normal per triangle
+    #   normals (N, 3) and face_normal_indices (F, 3): the vn lines and the one each corner uses (-1 if it has none)
+    #   texcoords (T, 2) and face_texcoord_indices (F, 3): same thing for vt
+    #our own objects use a non standard "n x y z" line after each face to give that face's normal, that still works too.
+    vertex_lines = []
+    normal_lines = []
+    texcoord_lines = []
+    face_lines = []
+    legacy_normal_lines = []
+
+    #startswith is a lot cheaper than splitting millions of lines just to look at the keyword
+    with open(filename, 'r') as file:
+        for line in file:
+            #anything after a # is a comment
+            if '#' in line:
+                line = line[:line.index('#')] + '\n'
+            if line.startswith(('v ', 'v\t')):
+                vertex_lines.append(line[2:])
+            elif line.startswith(('f ', 'f\t')):
+                face_lines.append(line[2:])
+            elif line.startswith(('vn ', 'vn\t')):
+                normal_lines.append(line[3:])
+            elif line.startswith(('vt ', 'vt\t')):
+                texcoord_lines.append(line[3:])
+            elif line.startswith(('n ', 'n\t')):
+                legacy_normal_lines.append(line[2:])
+
+    vertices = parse_numbers(vertex_lines, 3)
+    normals = parse_numbers(normal_lines, 3)
+    texcoords = parse_numbers(texcoord_lines, 2)
+
+    #split every face into its corners, then every corner into (v, vt, vn) with 0 standing for "not given" (OBJ indices start at 1).
+    #the corners of every face are counted on the joined bytes instead of splitting line by line. Faces with less than 3 corners
+    #don't make a triangle and get dropped by the triangulation below
+    tokens, corner_counts = split_faces(face_lines)
+    corner_indices = parse_corners(tokens)
+
+    #resolve negative indices and switch to 0 based, missing ones become -1
+    if (corner_indices < 0).any():
+        offsets = np.repeat(count_before_faces(filename), corner_counts, axis=0)
+        corner_indices = np.where(corner_indices < 0, offsets + corner_indices + 1, corner_indices)
+    corner_indices = corner_indices - 1
+
+    #fan triangulation: a polygon with corners 0..n-1 becomes triangles (0, i, i + 1)
+    triangle_counts = np.maximum(corner_counts - 2, 0)
+    first_corner = np.repeat(np.cumsum(corner_counts) - corner_counts, triangle_counts)
+    fan = np.arange(triangle_counts.sum()) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+    triangle_corners = np.stack([first_corner, first_corner + fan + 1, first_corner + fan + 2], axis=1)
+
+    faces = corner_indices[triangle_corners, 0]
+    face_texcoord_indices = corner_indices[triangle_corners, 1]
+    face_normal_indices = corner_indices[triangle_corners, 2]
+
+    #flat normals: the geometric one by default, the average of the corners' vn when they have one, and our own n lines above all
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    face_normals = normalize_rows(np.cross(v1 - v0, v2 - v0))
+    has_normals = (face_normal_indices >= 0).all(axis=1)
+    if has_normals.any():
+        face_normals[has_normals] = normalize_rows(normals[face_normal_indices[has_normals]].sum(axis=1))
+    if len(legacy_normal_lines) == len(face_lines) and len(face_lines):
+        face_normals = np.repeat(parse_numbers(legacy_normal_lines, 3), triangle_counts, axis=0)
+
+    return {
+        'vertices': vertices,
+        'faces': faces,
+        'face_normals': face_normals,
+        'normals': normals,
+        'face_normal_indices': face_normal_indices,
+        'texcoords': texcoords,
+        'face_texcoord_indices': face_texcoord_indices,
+    }
+
+def split_faces(face_lines):
+    #all the corner tokens of the faces in order, and how many corners every face has.
+    #a token starts on every non whitespace byte that follows whitespace, the number of them before each newline says how many every face has
+    text = ' ' + ''.join(face_lines)
+    if not text.endswith('\n'):
+        text += '\n'
+    tokens = text.split()
+    characters = np.frombuffer(text.encode(), dtype=np.uint8)
+    blank = characters <= ord(' ')
+    token_starts = np.flatnonzero(blank[:-1] & ~blank[1:])
+    corner_counts = np.diff(np.searchsorted(token_starts, np.flatnonzero(characters == ord('\n'))), prepend=0)
+    if len(corner_counts) == len(face_lines) and len(token_starts) == len(tokens):
+        return tokens, corner_counts
+    #control characters python doesn't split on, or whitespace it does that isn't ascii, go line by line
+    face_corners = [line.split() for line in face_lines]
+    return [token for corners in face_corners for token in corners], np.array([len(corners) for corners in face_corners], dtype=np.int64)
+
+def count_before_faces(filename):
+    #(F, 3) how many v, vt and vn lines come before each face. Negative indices are relative to that,
+    #this only runs for files that use them so the main parsing loop doesn't have to keep track.
+    counts = [0, 0, 0]
+    offsets = []
     with open(filename, 'r') as file:
         for line in file:
-            if line.startswith('v'):
-                vertex = tuple(float(coord) for coord in line.split()[1:])
-                vertices.append(vertex)
+            if line.startswith(('v ', 'v\t')):
+                counts[0] += 1
+            elif line.startswith(('vt ', 'vt\t')):
+                counts[1] += 1
+            elif line.startswith(('vn ', 'vn\t')):
+                counts[2] += 1
+            elif line.startswith(('f ', 'f\t')):
+                offsets.append(tuple(counts))
+    return np.array(offsets, dtype=np.int64).reshape(-1, 3)
+
+def parse_numbers(lines, width):
+    #(len(lines), width) float array from lines of whitespace separated numbers.
+    #fast path parses everything in one go, lines with extra (v with w or colors) or missing values go the slow way.
+    if not lines:
+        return np.zeros((0, width))
+    numbers = np.array(' '.join(lines).split(), dtype=np.float64)
+    if numbers.size == width * len(lines):
+        return numbers.reshape(-1, width)
+    return np.array([(line.split() + ['0'] * width)[:width] for line in lines], dtype=np.float64)
+
+def parse_corners(tokens):
+    #(len(tokens), 3) int array of (v, vt, vn) from face tokens like "1", "1/2", "1//3" or "1/2/3", 0 where a field is missing
+    if not tokens:
+        return np.zeros((0, 3), dtype=np.int64)
+    #fast path, only if every corner uses the same form as the first one. Counting the numbers isn't enough to tell,
+    #a file mixing "1", "1/2" and "1/2/3" corners can add up right and get split at the wrong places.
+    #v//vn and v/vt/vn count as the same form, the // becomes /0/
+    #the slashes of every corner get counted on the joined bytes, the spaces before a slash say which corner it's in
+    joined = ' '.join(tokens)
+    characters = np.frombuffer(joined.encode(), dtype=np.uint8)
+    corner_ids = np.cumsum(characters == ord(' '))
+    slashes = np.bincount(corner_ids[characters == ord('/')], minlength=len(tokens))
+    if (slashes == slashes[0]).all():
+        fields = tokens[0].replace('//', '/0/').count('/') + 1
+        numbers = np.array(joined.replace('//', '/0/').replace('/', ' ').split(), dtype=np.int64)
+        if numbers.size == fields * len(tokens):
+            corners = np.zeros((len(tokens), 3), dtype=np.int64)
+            corners[:, :fields] = numbers.reshape(-1, fields)
+            return corners
+    corners = np.zeros((len(tokens), 3), dtype=np.int64)
+    for index, token in enumerate(tokens):
+        for field, value in enumerate(token.split('/')[:3]):
+            if value:
+                corners[index, field] = int(value)
+    return corners
+
+def normalize_rows(vectors):
+    lengths = np.linalg.norm(vectors, axis=1)
+    return vectors / np.where(lengths > 0, lengths, 1)[:, None]
+
+
+#batched intersection kernels shared by the primitives and the BVH.
+#the primitive arguments broadcast against the rays, so they can either be a single primitive ((3,) vectors)
+#or one primitive per ray ((N, 3) arrays) when testing (ray, primitive) pairs.
+def dot_rows(a, b):
+    #dot product of the last axis. It goes through matmul because that adds up the 3 products exactly like np.dot does (einsum doesn't),
+    #so the batched kernels give bit for bit the same results as the single ray ones and a ray right on an edge gets the same answer from both
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return (a[..., None, :] @ b[..., :, None])[..., 0, 0]
+
+def intersect_triangles(origins, directions, v0, edge_vector1, edge_vector2):
+    #moller trumbore, see intersect_triangle for the step by step version
+    epsilon = triangle_epsilon(edge_vector1)
+    origins = floats(origins)
+    directions = floats(directions)
+
+    perpendicular_vector = np.cross(directions, edge_vector2)
+    determinant = dot_rows(edge_vector1, perpendicular_vector)
+
+    #rays parallel to the triangle get a dummy determinant so the division below doesn't warn, the mask throws them out anyway
+    hit = np.abs(determinant) >= epsilon
+    inverse_determinant = 1.0 / np.where(hit, determinant, 1.0)
+
+    vertex_to_ray_origin = origins - v0
+    u_parameter = inverse_determinant * dot_rows(vertex_to_ray_origin, perpendicular_vector)
+    hit &= (u_parameter >= 0.0) & (u_parameter <= 1.0)
+
+    cross_product_ray = np.cross(vertex_to_ray_origin, edge_vector1)
+    v_parameter = inverse_determinant * dot_rows(directions, cross_product_ray)
+    hit &= (v_parameter >= 0.0) & (u_parameter + v_parameter <= 1.0)
+
+    ray_distance = inverse_determinant * dot_rows(edge_vector2, cross_product_ray)
+    hit &= ray_distance > epsilon
+
+    return np.where(hit, ray_distance, np.inf), hit
+
+def intersect_spheres(origins, directions, centers, radii_squared):
+    #quadratic from Sphere.intersect.
+    #NOTE: like Sphere.intersect, a sphere fully behind the ray still counts as a hit with a negative t (t2) so both paths agree.
+    origins = floats(origins)
+    directions = floats(directions)
+    center_to_origin = origins - centers
+
+    a = dot_rows(directions, directions)
+    b = 2 * dot_rows(directions, center_to_origin)
+    c = dot_rows(center_to_origin, center_to_origin) - radii_squared
+
+    delta = b**2 - 4*a*c
+    hit = delta >= 0
+    root = np.sqrt(np.where(hit, delta, 0))
+    t1 = (-b - root) / (2*a)
+    t2 = (-b + root) / (2*a)
+    #t1 <= t2 so the closest positive one is t1 whenever t1 > 0
+    t = np.where(t1 > 0, t1, t2)
+
+    return np.where(hit, t, np.inf), hit
+
+def intersect_planes(origins, directions, heights):
+    #horizontal planes y = height, see Plane.intersect
+    origins = floats(origins)
+    directions = floats(directions)
+
+    #parallel rays get a dummy divisor, the mask throws them out
+    hit = directions[..., 1] != 0
+    t = (heights - origins[..., 1]) / np.where(hit, directions[..., 1], 1.0)
+    hit &= t >= 0
+
+    return np.where(hit, t, np.inf), hit
+
+def checkerboard(points, first_colors, second_colors):
+    #checkered plane pattern at (N, 3) points: 1.25 sized tiles alternating between the two colors and the yellow tile in the middle.
+    #the colors broadcast against the points so they can be one pair for every point or one pair per point.
+    tile_size = 1.25
+    x = points[:, 0]
+    z = points[:, 2]
+    first_color = (x // tile_size + z // tile_size) % 2 < 1
+    colors = np.where(first_color[:, None], first_colors, second_colors).astype(points.dtype)
+    center_tile = (x < 0.5) & (x > -0.5) & (z < 0.5) & (z > -0.5)
+    colors[center_tile] = (200, 200, 50)
+    return colors
+
+
+def intersect_triangle(ray, v0, edge_vector1, edge_vector2):
+    #moller trumbore algorithm
+    #references:
+    #https://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
+    #https://www.scratchapixel.com/lessons/3d-basic-rendering/ray-tracing-rendering-a-triangle/moller-trumbore-ray-triangle-intersection.html
+
+    #depends on the precision the triangle is stored in, see precision.py
+    epsilon = triangle_epsilon(edge_vector1)
+    #haven't had any issues with floating point precision so far but if something comes up just uncomment this and any epsilon instances further below
+    
+    #edge_vector1 and edge_vector2 are two vectors of the triangle with a shared origin (v0). This essentially just gives us the entire thing. Third edge is redundant
+    #they're computed once up front (Triangle.__init__, the scene's packed arrays) instead of on every ray
 
-            elif line.startswith('f'):
-                face = tuple(int(index) for index in line.split()[1:])
-                faces.append(face)
+    #get a vector perpendicular to both the ray and one of the edge vectors (2nd in this case). Think of the right hand rule.
+    perpendicular_vector = np.cross(ray.direction, edge_vector2)
 
-            elif line.startswith('n'):
-                normal = tuple(float(coord) for coord in line.split()[1:])
-                normals.append(normal)
-                
-    return vertices, faces, normals
+    #calculate determinant to see if the ray is parallel to the triangle
+    determinant = np.dot(edge_vector1, perpendicular_vector)
 
+    #we know that if a determinant is zero (or really close to zero in this instance to account for errors) then the ray is parallel to the triangle 
+    #if abs(determinant) < 0:
+    if abs(determinant) < epsilon:
+        return None, None
 
-class Triangle():
-    def __init__(self, a, b, c, color, normal, reflection=0):
-        self.v0 = np.array(a)
-        self.v1 = np.array(b)
-        self.v2 = np.array(c)
-        self.color = color
-        self.normal = normal
-        self.reflection = reflection
+    inverse_determinant = 1.0 / determinant
 
-    def intersect(self, ray):
-        #moller trumbore algorithm
-        #references:
-        #https://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
-        #https://www.scratchapixel.com/lessons/3d-basic-rendering/ray-tracing-rendering-a-triangle/moller-trumbore-ray-triangle-intersection.html
+    # Vector from the triangle's first vertex to the ray's origin
+    vertex_to_ray_origin = ray.origin - v0
 
-        epsilon = 0.00001
-        #haven't had any issues with floating point precision so far but if something comes up just uncomment this and any epsilon instances further below
-        
-        #calculate two vectors of the triangle with a shared origin. This essentially just gives us the entire thing. Third edge is redundant
-        edge_vector1 = self.v1 - self.v0
-        edge_vector2 = self.v2 - self.v0
+    #calculate u and v. These are barycentric coordinates. essentially they go from 0 to 1, add up to 1 with 0 being inside the triangle. think of them as weights. there's a third one but again we don't care about it because two are enough. 
+    #calculate u. This is the barycentric for edge_vector1
+    u_parameter = inverse_determinant * np.dot(vertex_to_ray_origin, perpendicular_vector)
+    if u_parameter < 0.0 or u_parameter > 1.0:
+        #if its less than 0 or bigger than 1 it's outside the triangle. We don't need to go any further.
+        return None, None
 
-        #get a vector perpendicular to both the ray and one of the edge vectors (2nd in this case). Think of the right hand rule.
-        perpendicular_vector = np.cross(ray.direction, edge_vector2)
+    #calculate v.
+    cross_product_ray = np.cross(vertex_to_ray_origin, edge_vector1)
+    v_parameter = inverse_determinant * np.dot(ray.direction, cross_product_ray)
 
-        #calculate determinant to see if the ray is parallel to the triangle
-        determinant = np.dot(edge_vector1, perpendicular_vector)
+    #here we make sure its actually inside the triangle.
+    if v_parameter < 0.0 or u_parameter + v_parameter > 1.0:
+        return None, None
 
-        #we know that if a determinant is zero (or really close to zero in this instance to account for errors) then the ray is parallel to the triangle 
-        #if abs(determinant) < 0:
-        if abs(determinant) < epsilon:
-            return None, None
+    #now we know for a fact its inside the triangle and intersects. We calculate how far along the ray the intersection is.
+    ray_distance = inverse_determinant * np.dot(edge_vector2, cross_product_ray)
 
-        inverse_determinant = 1.0 / determinant
+    #if ray_distance > 0:
+    if ray_distance > epsilon:
+        #get the intersection point and the distance.
+        intersection_point = ray.origin + ray.direction * ray_distance
+        return intersection_point, ray_distance
+    else:
+        #if its smaller than 0 the intersection is behind the ray (aka camera) and we just don't care about it.
+        return None, None
+
+def packed_attribute(name):
+    #an attribute that stays in sync with the arrays of the Scene the object got packed into: setting it also copies it there
+    #(Scene.update_object), so the renderer sees the change. Before the object is packed it's a plain attribute
+    def get(self):
+        return self.__dict__[name]
+
+    def set(self, value):
+        self.__dict__[name] = value
+        packed = self.__dict__.get('packed')
+        if packed is not None:
+            packed[0].update_object(packed[1], name)
+
+    return property(get, set)
+
+def occluded(object, ray, max_distance=np.inf):
+    #shadow query, True if the object sits on the ray somewhere between its origin and max_distance.
+    #Triangle, Mesh, Plane and Sphere use this as their occluded method, built on their own intersect. Instance has its own that goes through its mesh's BVH
+    intersection_point, t = object.intersect(ray)
+    return intersection_point is not None and 0 < t < max_distance
+
+def occluded_batch(object, origins, directions, max_distance=np.inf):
+    #occluded for a batch of rays, returns a mask
+    t, hit = object.intersect_batch(origins, directions)
+    return hit & (t > 0) & (t < max_distance)
+
+def any_hit(objects, ray, max_distance=np.inf):
+    #occlusion query against a list of objects, stops at the first object that blocks the ray
+    for object in objects:
+        if object.occluded(ray, max_distance):
+            return True
+    return False
+
+def any_hit_batch(objects, origins, directions, max_distance=np.inf):
+    #batched occlusion query, returns a mask of the rays that are blocked before max_distance (a number or one per ray).
+    #rays that are already blocked aren't tested against the remaining objects.
+    origins = floats(origins)
+    directions = floats(directions)
+    max_distance = np.broadcast_to(floats(max_distance), (len(origins),))
+    blocked = np.zeros(len(origins), dtype=bool)
+    for object in objects:
+        active = np.flatnonzero(~blocked)
+        if len(active) == 0:
+            break
+        blocked[active] = object.occluded_batch(origins[active], directions[active], max_distance[active])
+    return blocked
 
-        # Vector from the triangle's first vertex to the ray's origin
-        vertex_to_ray_origin = ray.origin - self.v0
+class Triangle():
+    #color and reflection write through to the scene's arrays once packed, see packed_attribute
+    color = packed_attribute('color')
+    reflection = packed_attribute('reflection')
 
-        #calculate u and v. These are barycentric coordinates. essentially they go from 0 to 1, add up to 1 with 0 being inside the triangle. think of them as weights. there's a third one but again we don't care about it because two are enough. 
-        #calculate u. This is the barycentric for edge_vector1
-        u_parameter = inverse_determinant * np.dot(vertex_to_ray_origin, perpendicular_vector)
-        if u_parameter < 0.0 or u_parameter > 1.0:
-            #if its less than 0 or bigger than 1 it's outside the triangle. We don't need to go any further.
-            return None, None
+    def __init__(self, a, b, c, color, normal, reflection=0):
+        #only v0 and the two edges are kept, they're all intersect() needs. v1 and v2 are rebuilt from them when asked for.
+        #once the triangle is added to a Scene these become views into the scene's packed arrays.
+        self.v0 = np.array(a, dtype=precision.dtype)
+        self.edge1 = np.array(b, dtype=precision.dtype) - self.v0
+        self.edge2 = np.array(c, dtype=precision.dtype) - self.v0
+        self.color = color
+        self.normal = np.array(normal, dtype=precision.dtype)
+        self.reflection = reflection
 
-        #calculate v.
-        cross_product_ray = np.cross(vertex_to_ray_origin, edge_vector1)
-        v_parameter = inverse_determinant * np.dot(ray.direction, cross_product_ray)
+    @property
+    def v1(self):
+        return self.v0 + self.edge1
 
-        #here we make sure its actually inside the triangle.
-        if v_parameter < 0.0 or u_parameter + v_parameter > 1.0:
-            return None, None
+    @property
+    def v2(self):
+        return self.v0 + self.edge2
+
+    def intersect(self, ray):
+        #moller trumbore, see intersect_triangle
+        return intersect_triangle(ray, self.v0, self.edge1, self.edge2)
 
-        #now we know for a fact its inside the triangle and intersects. We calculate how far along the ray the intersection is.
-        ray_distance = inverse_determinant * np.dot(edge_vector2, cross_product_ray)
+    def intersect_batch(self, origins, directions):
+        #same moller trumbore test as intersect() but over (N, 3) arrays of ray origins and directions.
+        #returns the distance t of every ray (np.inf where it misses) and a boolean hit mask.
+        return intersect_triangles(origins, directions, self.v0, self.edge1, self.edge2)
 
-        #if ray_distance > 0:
-        if ray_distance > epsilon:
-            #get the intersection point and the distance.
-            intersection_point = ray.origin + ray.direction * ray_distance
-            return intersection_point, ray_distance
-        else:
-            #if its smaller than 0 the intersection is behind the ray (aka camera) and we just don't care about it.
-            return None, None
+    #shadow queries, see occluded at the top
+    occluded = occluded
+    occluded_batch = occluded_batch
+
+    def get_bounds(self):
+        #axis aligned bounding box as (min corner, max corner), used by the BVH
+        vertices = self.v0 + np.array([np.zeros(3), self.edge1, self.edge2])
+        return vertices.min(axis=0), vertices.max(axis=0)
 
-        
     def get_normal(self, intersection_point):
-        return np.array(self.normal)
+        return self.normal
+
+    def get_normal_batch(self, intersection_points):
+        return np.broadcast_to(self.normal, np.shape(intersection_points))
+
+    def get_color_batch(self, intersection_points):
+        #base color of the surface at every point, (N, 3)
+        points = floats(intersection_points)
+        return np.broadcast_to(np.array(self.color, dtype=points.dtype), points.shape)
     
     def render(self, screen, x, y, saved_intersection_point, light, inShadow=False, new_color=None):
         #refer to the plane rendering function everything is commented there.
@@ -100,26 +444,262 @@ class Triangle():
         light_direction = light.calculate_direction(saved_intersection_point)
         intensity = max(0, np.dot(normal, light_direction)) * light.strength
 
-        converted_color = np.array(self.color)
+        #new_color replaces the base color (reflections), it still gets lit like the spheres and planes do
+        if new_color is not None:
+            converted_color = new_color
+        else:
+            converted_color = np.array(self.color)
         final_color = converted_color * intensity * light.color
         if inShadow:
             final_color *= shadowMultiplier
 
-        if new_color is not None:
-            final_color = new_color
         final_color = np.clip(final_color, 0, 255)
         screen.set_at((x, y), final_color)
 
+class Mesh():
+    #indexed triangle mesh: one shared vertex buffer and an index buffer instead of a Triangle object per face.
+    #   vertices (V, 3), faces (F, 3) int32 indices into vertices, face_normals (F, 3) flat normal of every face
+    #   normals (N, 3) and normal_indices (F, 3): for smooth shading, the normal at every corner of every face.
+    #   without them every face is flat shaded with its face normal
+    #a face costs its 3 indices and its normal (36 bytes), shared vertices are only stored once.
+    #inside a Scene every face becomes a primitive of its own, the BVH works on faces and not on the whole mesh.
+    #a hit on a single face is handed out as a MeshFace (see face()), which shades like a Triangle.
+
+    #color and reflection write through to the scene's arrays once packed, see packed_attribute
+    color = packed_attribute('color')
+    reflection = packed_attribute('reflection')
+
+    def __init__(self, vertices, faces, color, face_normals=None, normals=None, normal_indices=None, reflection=0):
+        self.vertices = np.array(vertices, dtype=precision.dtype).reshape(-1, 3)
+        self.faces = np.array(faces, dtype=np.int32).reshape(-1, 3)
+        if face_normals is None:
+            v0, v1, v2 = self.get_corners()
+            face_normals = normalize_rows(np.cross(v1 - v0, v2 - v0))
+        self.face_normals = np.array(face_normals, dtype=precision.dtype).reshape(-1, 3)
+        self.normals = None if normals is None else np.array(normals, dtype=precision.dtype).reshape(-1, 3)
+        self.normal_indices = None if normal_indices is None else np.array(normal_indices, dtype=np.int32).reshape(-1, 3)
+        self.color = color
+        self.reflection = reflection
+        #BVH over just this mesh, see get_bvh
+        self.bvh = None
+
+    @property
+    def smooth(self):
+        return self.normals is not None
+
+    def get_corners(self, faces=slice(None)):
+        #v0, v1, v2 of the faces as three (F, 3) arrays
+        corners = self.vertices[self.faces[faces]]
+        return corners[..., 0, :], corners[..., 1, :], corners[..., 2, :]
+
+    def face(self, index):
+        return MeshFace(self, index)
+
+    def get_bvh(self):
+        #acceleration structure over the faces of this mesh alone, built the first time it's needed and shared by every Instance of it
+        if self.bvh is None:
+            from bvh import BVH
+            self.bvh = BVH([self])
+        return self.bvh
+
+    def intersect_faces(self, origins, directions):
+        #closest face hit by every ray, all faces tested in chunks of rays. Returns per ray t (np.inf on a miss) and the face (-1 on a miss)
+        origins = floats(origins).reshape(-1, 3)
+        directions = floats(directions).reshape(-1, 3)
+        closest_t = np.full(len(origins), np.inf, dtype=directions.dtype)
+        closest_face = np.full(len(origins), -1)
+        if len(self.faces) == 0:
+            return closest_t, closest_face
+        v0, v1, v2 = self.get_corners()
+        edge1, edge2 = v1 - v0, v2 - v0
+        step = max(1, 2**20 // len(self.faces))
+        for start in range(0, len(origins), step):
+            chunk = slice(start, start + step)
+            t = intersect_triangles(origins[chunk, None], directions[chunk, None], v0, edge1, edge2)[0]
+            face = t.argmin(axis=1)
+            closest_t[chunk] = t[np.arange(len(face)), face]
+            closest_face[chunk] = np.where(closest_t[chunk] < np.inf, face, -1)
+        return closest_t, closest_face
+
+    def intersect(self, ray):
+        t, face = self.intersect_faces(np.asarray(ray.origin)[None], np.asarray(ray.direction)[None])
+        if face[0] < 0:
+            return None, None
+        return ray.origin + ray.direction * t[0], t[0]
+
+    def intersect_face(self, ray, face):
+        #single ray against a single face, (intersection point, t) or (None, None) like Triangle.intersect
+        v0, v1, v2 = self.get_corners(face)
+        return intersect_triangle(ray, v0, v1 - v0, v2 - v0)
+
+    def intersect_batch(self, origins, directions):
+        t, face = self.intersect_faces(origins, directions)
+        return t, face >= 0
+
+    #shadow queries, see occluded at the top
+    occluded = occluded
+    occluded_batch = occluded_batch
+
+    def get_bounds(self):
+        used = self.vertices[self.faces.ravel()]
+        return used.min(axis=0), used.max(axis=0)
+
+    def get_normal_batch(self, intersection_points, faces):
+        #(N, 3) normals at points on the given faces. Smooth meshes interpolate their corner normals with the point's barycentric coordinates
+        faces = np.asarray(faces)
+        if not self.smooth:
+            return self.face_normals[faces]
+        v0, v1, v2 = self.get_corners(faces)
+        edge1, edge2 = v1 - v0, v2 - v0
+        offsets = floats(intersection_points) - v0
+        d00 = dot_rows(edge1, edge1)
+        d01 = dot_rows(edge1, edge2)
+        d11 = dot_rows(edge2, edge2)
+        d20 = dot_rows(offsets, edge1)
+        d21 = dot_rows(offsets, edge2)
+        denominator = d00 * d11 - d01 * d01
+        denominator = np.where(denominator != 0, denominator, 1)
+        weight1 = (d11 * d20 - d01 * d21) / denominator
+        weight2 = (d00 * d21 - d01 * d20) / denominator
+        weight0 = 1 - weight1 - weight2
+        corner_normals = self.normals[self.normal_indices[faces]]
+        normals = weight0[..., None] * corner_normals[..., 0, :] + weight1[..., None] * corner_normals[..., 1, :] + weight2[..., None] * corner_normals[..., 2, :]
+        lengths = np.linalg.norm(normals, axis=-1)[..., None]
+        return np.where(lengths > 0, normals / np.where(lengths > 0, lengths, 1), self.face_normals[faces])
+
+    def get_color_batch(self, intersection_points):
+        points = floats(intersection_points)
+        return np.broadcast_to(np.array(self.color, dtype=points.dtype), points.shape)
+
+class MeshFace():
+    #a single face of a Mesh (or of an Instance), only made for faces that actually got hit so the per pixel code can treat it like any other object
+    __slots__ = ('mesh', 'index')
+
+    def __init__(self, mesh, index):
+        self.mesh = mesh
+        self.index = index
+
+    @property
+    def color(self):
+        return self.mesh.color
+
+    @property
+    def reflection(self):
+        return self.mesh.reflection
+
+    def get_normal(self, intersection_point):
+        return self.mesh.get_normal_batch(intersection_point, self.index)
+
+    def get_color_batch(self, intersection_points):
+        return self.mesh.get_color_batch(intersection_points)
+
+    #same shading as a triangle, only the normal comes from the mesh
+    render = Triangle.render
+
+def make_transform(translation=(0, 0, 0), scale=1, rotation=(0, 0, 0)):
+    #4x4 matrix that scales (a number or one per axis), then rotates around x, y and z (degrees), then translates
+    rx, ry, rz = np.radians(rotation)
+    rotate_x = np.array([[1, 0, 0], [0, np.cos(rx), -np.sin(rx)], [0, np.sin(rx), np.cos(rx)]])
+    rotate_y = np.array([[np.cos(ry), 0, np.sin(ry)], [0, 1, 0], [-np.sin(ry), 0, np.cos(ry)]])
+    rotate_z = np.array([[np.cos(rz), -np.sin(rz), 0], [np.sin(rz), np.cos(rz), 0], [0, 0, 1]])
+    transform = np.eye(4)
+    transform[:3, :3] = rotate_z @ rotate_y @ rotate_x @ np.diag(np.broadcast_to(np.asarray(scale, dtype=np.float64), (3,)))
+    transform[:3, 3] = translation
+    return transform
+
+class Instance():
+    #a Mesh placed in the scene with a 4x4 transform (object space to world space), without copying its geometry.
+    #rays get moved into the mesh's object space and traced through the mesh's own BVH, which all instances of the mesh share,
+    #so a thousand copies of an asset only cost a thousand matrices on top of one mesh.
+    #the ray direction isn't renormalized in object space, so t means the same distance along the ray in both spaces.
+    #color and reflection default to the mesh's.
+
+    #color and reflection write through to the scene's arrays once packed, see packed_attribute
+    color = packed_attribute('color')
+    reflection = packed_attribute('reflection')
+
+    def __init__(self, mesh, transform, color=None, reflection=None):
+        self.mesh = mesh
+        self.transform = np.array(transform, dtype=precision.dtype)
+        self.inverse = np.linalg.inv(self.transform)
+        #normals go through the inverse transpose so they stay perpendicular under non uniform scaling
+        self.normal_matrix = self.inverse[:3, :3].T
+        self.color = mesh.color if color is None else color
+        self.reflection = mesh.reflection if reflection is None else reflection
+        #built once here so worker processes get it with the mesh instead of all building their own
+        mesh.get_bvh()
+
+    def to_object_space(self, origins, directions):
+        origins = floats(origins)
+        directions = floats(directions)
+        return origins @ self.inverse[:3, :3].T + self.inverse[:3, 3], directions @ self.inverse[:3, :3].T
+
+    def face(self, index):
+        return MeshFace(self, index)
+
+    def closest_hit(self, ray, profile=None):
+        #single ray closest hit like BVH.closest_hit: (MeshFace, intersection point, t) or (None, None, np.inf)
+        origin, direction = self.to_object_space(ray.origin, ray.direction)
+        hit_face, _, t = self.mesh.get_bvh().closest_hit(Ray(origin, direction), profile)
+        if hit_face is None:
+            return None, None, np.inf
+        return self.face(hit_face.index), ray.origin + ray.direction * t, t
+
+    def closest_hit_batch(self, origins, directions, profile=None, return_faces=False):
+        #same output as BVH.closest_hit_batch, the index being 0 (the mesh) on a hit
+        origins, directions = self.to_object_space(origins, directions)
+        return self.mesh.get_bvh().closest_hit_batch(origins, directions, profile, return_faces)
+
+    def intersect(self, ray):
+        hit_face, intersection_point, t = self.closest_hit(ray)
+        if hit_face is None:
+            return None, None
+        return intersection_point, t
+
+    def intersect_batch(self, origins, directions):
+        t, index = self.closest_hit_batch(origins, directions)
+        return t, index >= 0
+
+    def occluded(self, ray, max_distance=np.inf):
+        origin, direction = self.to_object_space(ray.origin, ray.direction)
+        return self.mesh.get_bvh().any_hit(Ray(origin, direction), max_distance)
+
+    def occluded_batch(self, origins, directions, max_distance=np.inf):
+        origins, directions = self.to_object_space(origins, directions)
+        return self.mesh.get_bvh().any_hit_batch(origins, directions, max_distance)
+
+    def get_bounds(self):
+        #world space box around the 8 transformed corners of the mesh's box
+        bounds_min, bounds_max = self.mesh.get_bounds()
+        corners = np.array([[x, y, z] for x in (bounds_min[0], bounds_max[0]) for y in (bounds_min[1], bounds_max[1]) for z in (bounds_min[2], bounds_max[2])])
+        corners = corners @ self.transform[:3, :3].T + self.transform[:3, 3]
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def get_normal_batch(self, intersection_points, faces):
+        points = floats(intersection_points)
+        local_points = points @ self.inverse[:3, :3].T + self.inverse[:3, 3]
+        normals = self.mesh.get_normal_batch(local_points, faces) @ self.normal_matrix.T
+        return normals / np.linalg.norm(normals, axis=-1)[..., None]
+
+    def get_color_batch(self, intersection_points):
+        points = floats(intersection_points)
+        return np.broadcast_to(np.array(self.color, dtype=points.dtype), points.shape)
+
 class Plane():
+    #yLevel, color and reflection write through to the scene's arrays once packed, see packed_attribute
+    yLevel = packed_attribute('yLevel')
+    color = packed_attribute('color')
+    reflection = packed_attribute('reflection')
+
     def __init__(self, yLevel, color, reflection=0):
         self.yLevel = yLevel
         self.color = color
         self.reflection = reflection
 
     def intersect(self, ray):
-        origin = np.array(ray.origin)
-        direction = np.array(ray.direction)
-        yLevel = np.array(self.yLevel)
+        origin = ray.origin
+        direction = ray.direction
+        yLevel = self.yLevel
 
         if direction[1] == 0:
             return None, None
@@ -135,6 +715,14 @@ class Plane():
         intersection = origin + t * direction
 
         return (intersection, t)
+
+    def intersect_batch(self, origins, directions):
+        #batched version of intersect(), returns per ray t (np.inf on a miss) and a hit mask
+        return intersect_planes(origins, directions, self.yLevel)
+
+    #shadow queries, see occluded at the top
+    occluded = occluded
+    occluded_batch = occluded_batch
     
     def render(self, screen, x, y, saved_intersection_point, light, inShadow=False, new_color=None):
 
@@ -185,17 +773,43 @@ class Plane():
                 final_color = np.clip(final_color, 0, 255)
                 screen.set_at((x, y), final_color)
 
+    def get_bounds(self):
+        #the plane is infinite so it can't go in the BVH, it gets tested separately
+        return None
+
     def get_normal(self, intersection_point):
         #since our plane is always horizontal the normal is always (0, 1, 0)
         #probably replace this later if we get non horizontal planes
-        return np.array([0, 1, 0])
+        return np.array([0.0, 1.0, 0.0], dtype=precision.dtype)
+
+    def get_normal_batch(self, intersection_points):
+        points = floats(intersection_points)
+        return np.broadcast_to(np.array([0.0, 1.0, 0.0], dtype=points.dtype), points.shape)
+
+    def get_color_batch(self, intersection_points):
+        #same pattern as render(): single color, or the checkerboard with the yellow center tile
+        intersection_points = floats(intersection_points)
+        if len(self.color) == 3:
+            return np.broadcast_to(np.array(self.color, dtype=intersection_points.dtype), intersection_points.shape)
+        return checkerboard(intersection_points, np.array(self.color[0], dtype=intersection_points.dtype), np.array(self.color[1], dtype=intersection_points.dtype))
 
 class Sphere():
+    #radius, color and reflection write through to the scene's arrays once packed, see packed_attribute
+    radius = packed_attribute('radius')
+    color = packed_attribute('color')
+    reflection = packed_attribute('reflection')
+
     def __init__(self, center, radius, color, reflection=0):
-        self.center = center
+        #center becomes a view into the scene's packed arrays once the sphere is added to a Scene
+        self.center = np.array(center, dtype=precision.dtype)
         self.radius = radius
         self.color = color
         self.reflection = reflection
+
+    @property
+    def radius_squared(self):
+        return self.radius**2
+
     def intersect(self, ray):
 
         #Variables:
@@ -215,13 +829,13 @@ class Sphere():
         #Solve for t:
         #at² + bt + c = 0
 
-        origin = np.array(ray.origin)
-        direction = np.array(ray.direction)
-        center = np.array(self.center)
+        origin = ray.origin
+        direction = ray.direction
+        center = self.center
 
         a = np.dot(direction, direction)
         b = 2 * np.dot(direction, (origin - center))
-        c = np.dot((origin - center), (origin - center)) - self.radius**2
+        c = np.dot((origin - center), (origin - center)) - self.radius_squared
 
         delta = b**2 - 4*a*c
         if delta < 0:
@@ -242,6 +856,18 @@ class Sphere():
             #plug t into the ray equation to find the intersection point and return it
             intersection = origin + direction * t
             return (intersection, t)
+
+    def intersect_batch(self, origins, directions):
+        #batched version of intersect(), same quadratic just solved for every ray at once.
+        #returns per ray t (np.inf on a miss) and a hit mask.
+        return intersect_spheres(origins, directions, self.center, self.radius_squared)
+
+    #shadow queries, see occluded at the top
+    occluded = occluded
+    occluded_batch = occluded_batch
+
+    def get_bounds(self):
+        return self.center - self.radius, self.center + self.radius
         
     def render(self, screen, x, y, saved_intersection_point, light, inShadow=False, new_color=None):
         #refer to the plane rendering function everything is commented there.
@@ -264,10 +890,32 @@ class Sphere():
 
     def get_normal(self, intersection_point):
         #a sphere's normal vector is just the vector from the center to the intersection point going outside.
-        vector = np.array(intersection_point) - np.array(self.center)
+        vector = intersection_point - self.center
         normalized_vector = vector / np.linalg.norm(vector)
         return normalized_vector
-            
+
+    def get_normal_batch(self, intersection_points):
+        vectors = floats(intersection_points) - self.center
+        return vectors / np.linalg.norm(vectors, axis=1)[:, None]
+
+    def get_color_batch(self, intersection_points):
+        points = floats(intersection_points)
+        return np.broadcast_to(np.array(self.color, dtype=points.dtype), points.shape)
+
+def closest_hit_batch(objects, origins, directions):
+    #closest hit of every ray against a list of objects using the batched kernels.
+    #returns the distance and the index into objects of the closest hit per ray (-1 where nothing got hit).
+    closest_t = np.full(len(origins), np.inf)
+    closest_index = np.full(len(origins), -1)
+    for index, object in enumerate(objects):
+        t, hit = object.intersect_batch(origins, directions)
+        #spheres behind the ray come back as hits with a negative t, they don't count (same as in the BVH).
+        #strictly closer only, so on a tie the first object in the list wins like in the per pixel loop
+        closer = hit & (t > 0) & (t < closest_t)
+        closest_t[closer] = t[closer]
+        closest_index[closer] = index
+    return closest_t, closest_index
+
 #simple test to check if the intersection works
 if __name__ == "__main__":
     ray_origin = (0, 0, 0)
@@ -294,6 +942,6 @@ if __name__ == "__main__":
     else:
         print("No intersection.")
 
-    cube_vertices, cube_faces = read_object("objects/cube.obj")
+    cube_vertices, cube_faces, cube_normals = read_object("objects/cube.obj")
     print(cube_vertices)
     print(cube_faces)
\ No newline at end of file
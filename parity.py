@@ -0,0 +1,416 @@
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import numpy as np
+from skybox import Skybox
+from scene import Scene
+from bvh import BVH
+from ray import Ray
+from objectHandler import Mesh, Instance
+from renderer import Framebuffer, render_frame, save_image, split_tiles, find_edges, stratified_offsets
+from distributed import Coordinator, parse_address
+from main import build_scene
+from main_movable import GBuffer, ShadowCache, render_pixels, background_color
+import benchmark
+import precision
+from precision import ray_offset
+
+#checks that the fast render paths draw the same pixels as a reference renderer that doesn't share their shortcuts.
+#the reference is the baseline's renderer: one camera ray per pixel (Camera.castRay) tested against every object of the scene with the object's
+#own intersect, without the BVH or the Scene's packed arrays, every light of a hit drawn with the object's own render() and added up, in float64.
+#light culling, shadows (object.occluded) and reflections follow the renderer's rules (cull_lights, trace_reflections) but are worked out ray by ray.
+#a ray only skips the objects whose (padded) bounding box it misses, going through all of them would take minutes on the bigger scenes.
+#every scene is rendered through the reference and then through every mode, which is compared against it pixel by pixel and timed.
+#   the exact modes (same math, same precision) have to match it exactly: the batched kernels add up their dot products like np.dot
+#   (objectHandler.dot_rows) and Camera.castRays normalizes like castRay, so every ray gets bit for bit the same answer as in the reference.
+#   the others pass if few enough pixels (--tolerance, --low-res-tolerance for the low-res mode) are off by more than the 1 a color
+#   truncated on the other side of a rounding gives:
+#   float32 rounds differently, the shadow cache shares shadow rays between nearby points, and the interactive modes test faces in another
+#   order, so on a tie between two faces at the same distance the other one wins.
+#   the interactive modes (main_movable's GBuffer) have no reflections or skybox, so their reference is the same scene rendered
+#   with a reflection depth of 0 over main_movable's background color.
+#with --antialiasing a pixel that lands on the other side of an edge changes which pixels count as edges, and with them the jitter
+#of every edge pixel after it in its tile, so a single one can move dozens of pixels. Expect to raise --tolerance with it.
+#with --masks every mode that doesn't match the reference exactly gets an image of where it differs: the reference dimmed, pixels that differ in red.
+
+class Background():
+    #stands in for a Skybox that's the same color in every direction
+    def __init__(self, color):
+        self.color = np.array(color, dtype=np.uint8)
+
+    def get_skybox_pixel(self, direction):
+        return self.color
+
+    def get_skybox_pixels(self, directions):
+        return np.broadcast_to(self.color, (len(directions), 3))
+
+class ColorCapture():
+    #stand in screen that keeps the color render() draws instead of drawing it, so the render() of every light can be added up
+    def set_at(self, position, color):
+        self.color = color
+
+def object_bounds(objects):
+    #(O, 3) min and max corners of every object's bounding box, padded a bit. Unbounded objects (planes) get an infinite box
+    box_min = np.full((len(objects), 3), -np.inf)
+    box_max = np.full((len(objects), 3), np.inf)
+    for index, object in enumerate(objects):
+        bounds = object.get_bounds()
+        if bounds is not None:
+            padding = 1e-6 * (1 + np.abs(np.concatenate(bounds)).max())
+            box_min[index] = np.asarray(bounds[0], dtype=np.float64) - padding
+            box_max[index] = np.asarray(bounds[1], dtype=np.float64) + padding
+    return box_min, box_max
+
+def candidate_objects(bounds, rays, max_distances=None):
+    #indices of the objects every ray passes the bounding box of (before its max distance), one array per ray.
+    #this only skips objects a ray can't hit, every candidate still goes through its own intersect
+    box_min, box_max = bounds
+    step = max(1, 2**20 // max(1, len(box_min)))
+    for start in range(0, len(rays), step):
+        chunk = rays[start:start + step]
+        origins = np.array([ray.origin for ray in chunk], dtype=np.float64)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse_directions = 1 / np.array([ray.direction for ray in chunk], dtype=np.float64)[:, None]
+            near = (box_min - origins) * inverse_directions
+            far = (box_max - origins) * inverse_directions
+        #fmin/fmax skip the nans a ray parallel to a box side starting right on it gives, that axis just doesn't narrow it down
+        entry = np.fmax.reduce(np.fmin(near, far), axis=2)
+        exit = np.fmin.reduce(np.fmax(near, far), axis=2)
+        limit = np.inf if max_distances is None else np.asarray(max_distances[start:start + step])[:, None]
+        for row in (entry <= exit) & (exit >= 0) & (entry <= limit):
+            yield np.flatnonzero(row)
+
+def intersect(object, ray):
+    #the object's own single ray intersect as (object to shade, intersection point, t), (None, None, np.inf) on a miss.
+    #meshes and instances hand out the face that got hit (a MeshFace), which shades like a Triangle
+    if isinstance(object, Instance):
+        return object.closest_hit(ray)
+    if isinstance(object, Mesh):
+        t, face = object.intersect_faces(ray.origin[None], ray.direction[None])
+        if face[0] < 0:
+            return None, None, np.inf
+        return object.face(face[0]), ray.origin + ray.direction * t[0], t[0]
+    intersection_point, t = object.intersect(ray)
+    if intersection_point is None:
+        return None, None, np.inf
+    return object, intersection_point, t
+
+def reference_hits(objects, bounds, rays):
+    #closest hit of every ray, the baseline's loop over the objects. Returns the index of the object every ray hit (-1 for none)
+    #and per ray (object to shade, intersection point) or None.
+    #spheres behind the ray come back with a negative t, those don't count. On a tie the first object in the list wins
+    object_ids = np.full(len(rays), -1)
+    hits = []
+    for ray_index, (ray, candidates) in enumerate(zip(rays, candidate_objects(bounds, rays))):
+        closest_t = np.inf
+        closest_hit = None
+        for index in candidates:
+            hit_object, intersection_point, t = intersect(objects[index], ray)
+            if hit_object is not None and 0 < t < closest_t:
+                closest_t = t
+                closest_hit = (hit_object, intersection_point)
+                object_ids[ray_index] = index
+        hits.append(closest_hit)
+    return object_ids, hits
+
+def reference_occluded(objects, bounds, rays, max_distances):
+    #shadow rays: True for every ray that one of the objects blocks before its max distance (the object the ray starts on included)
+    return [any(objects[index].occluded(ray, max_distance) for index in candidates)
+            for ray, max_distance, candidates in zip(rays, max_distances, candidate_objects(bounds, rays, max_distances))]
+
+def attenuation(light, point):
+    return light.attenuation_batch(np.array([np.linalg.norm(np.subtract(light.position, point))]))[0]
+
+def reaching_lights(object, point, lights):
+    #(light, unit direction to it, attenuation) of the lights worth shading the point with. A light is skipped for a point behind it
+    #or that it would add less than 1 to a channel of, like light.cull_lights does
+    normal = object.get_normal(point)
+    reaching = []
+    for light in lights:
+        light_direction = light.calculate_direction(point)
+        light_attenuation = attenuation(light, point)
+        facing = np.dot(normal, light_direction)
+        if facing > 0 and facing * light.strength * light_attenuation * np.max(light.color) >= 1/255:
+            reaching.append((light, light_direction, light_attenuation))
+    return reaching
+
+def lit_color(object, point, lighting, new_color=None):
+    #sum of what the object's render() draws for every (light, attenuation, in shadow) in lighting, black if there's none.
+    #render() doesn't know about attenuation, so it gets a copy of the light with its strength faded
+    capture = ColorCapture()
+    color = np.zeros(3)
+    for light, light_attenuation, shadowed in lighting:
+        faded = copy.copy(light)
+        faded.strength = light.strength * light_attenuation
+        object.render(capture, 0, 0, point, faded, shadowed, new_color)
+        color += capture.color
+    return np.clip(color, 0, 255)
+
+def reference_reflections(objects, bounds, lights, skybox, points, directions, normals, colors, reflections, weights, depth, min_weight):
+    #base colors of reflective surfaces mixed with what their reflection ray sees. Hits are lit without shadows by the lights that reach them,
+    #reflective ones get their own reflection first while there's depth left and the weight of the path stays over min_weight
+    reflection_directions = [direction - 2 * np.dot(direction, normal) * normal for direction, normal in zip(directions, normals)]
+    rays = [Ray(point + direction * ray_offset(point), direction) for point, direction in zip(points, reflection_directions)]
+    object_ids, hits = reference_hits(objects, bounds, rays)
+    hit_colors = [None if hit is None else hit[0].get_color_batch(hit[1][None])[0] for hit in hits]
+
+    bounce = [index for index, hit in enumerate(hits) if depth > 1 and hit is not None and hit[0].reflection > 0 and weights[index] * hit[0].reflection >= min_weight]
+    if bounce:
+        mixed_colors = reference_reflections(objects, bounds, lights, skybox, [hits[index][1] for index in bounce], [reflection_directions[index] for index in bounce],
+                                             [hits[index][0].get_normal(hits[index][1]) for index in bounce], [hit_colors[index] for index in bounce],
+                                             [hits[index][0].reflection for index in bounce], [weights[index] * hits[index][0].reflection for index in bounce],
+                                             depth - 1, min_weight)
+        for index, mixed_color in zip(bounce, mixed_colors):
+            hit_colors[index] = mixed_color
+
+    mixed_colors = []
+    for index, hit in enumerate(hits):
+        if hit is None:
+            #the skybox gets mixed in with the reflecting surface's own coefficient
+            seen_color = skybox.get_skybox_pixel(reflection_directions[index])[:3]
+            mix_factor = reflections[index]
+        else:
+            object, point = hit
+            seen_color = lit_color(object, point, [(light, light_attenuation, False) for light, _, light_attenuation in reaching_lights(object, point, lights)], hit_colors[index])
+            mix_factor = object.reflection
+        mixed_colors.append(np.clip(np.asarray(colors[index]) * (1 - reflections[index]) + seen_color * mix_factor, 0, 255))
+    return mixed_colors
+
+def reference_colors(job, rays):
+    #(N, 3) colors of N camera rays through the reference, and the index of the object each one hit (-1 for the skybox)
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    objects = scene.objects
+    bounds = object_bounds(objects)
+    object_ids, hits = reference_hits(objects, bounds, rays)
+    colors = np.zeros((len(rays), 3))
+
+    #every light that reaches a hit gets a shadow ray
+    pairs = []
+    shadow_rays = []
+    shadow_distances = []
+    for index, hit in enumerate(hits):
+        if hit is None:
+            direction = rays[index].direction
+            colors[index] = skybox.get_skybox_pixel(direction / np.linalg.norm(direction))[:3]
+            continue
+        object, point = hit
+        for light, light_direction, light_attenuation in reaching_lights(object, point, lights):
+            pairs.append((index, light, light_attenuation))
+            shadow_rays.append(Ray(point + light_direction * ray_offset(point), light_direction))
+            shadow_distances.append(np.linalg.norm(np.subtract(light.position, point)))
+    shadowed = reference_occluded(objects, bounds, shadow_rays, shadow_distances)
+    lighting = [[] for _ in hits]
+    for (index, light, light_attenuation), blocked in zip(pairs, shadowed):
+        lighting[index].append((light, light_attenuation, blocked))
+
+    #reflective surfaces at least one light reaches get the color of their reflection mixed in
+    new_colors = [None] * len(hits)
+    queue = [index for index, hit in enumerate(hits) if reflection_depth > 0 and hit is not None and hit[0].reflection > 0
+             and any(not blocked for _, _, blocked in lighting[index])]
+    if queue:
+        mixed_colors = reference_reflections(objects, bounds, lights, skybox, [hits[index][1] for index in queue], [rays[index].direction for index in queue],
+                                             [hits[index][0].get_normal(hits[index][1]) for index in queue],
+                                             [hits[index][0].get_color_batch(hits[index][1][None])[0] for index in queue],
+                                             [hits[index][0].reflection for index in queue], [hits[index][0].reflection for index in queue],
+                                             reflection_depth, min_reflection_weight)
+        for index, mixed_color in zip(queue, mixed_colors):
+            new_colors[index] = mixed_color
+
+    for index, hit in enumerate(hits):
+        if hit is not None:
+            colors[index] = lit_color(hit[0], hit[1], lighting[index], new_colors[index])
+    return colors, object_ids
+
+def render_reference(job, tile_size):
+    #the job's frame through the reference as an (H, W, 3) uint8 array. Antialiasing picks the edges and jitters the samples
+    #tile by tile like renderer.antialias_tile, so it needs the tile size of the render it gets compared with
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    width, height = camera.screenWidth, camera.screenHeight
+    colors, object_ids = reference_colors(job, [camera.castRay(x, y) for y in range(height) for x in range(width)])
+    frame = Framebuffer(width, height)
+    for index, color in enumerate(colors):
+        frame.set_at((index % width, index // width), color)
+    if antialiasing is None:
+        return frame.pixels
+
+    grid, threshold = antialiasing
+    pixels = frame.pixels.copy()
+    object_ids = object_ids.reshape(height, width)
+    for x0, y0, tile_width, tile_height in split_tiles(width, height, tile_size):
+        tile = (slice(y0, y0 + tile_height), slice(x0, x0 + tile_width))
+        edges = find_edges(pixels[tile], object_ids[tile], threshold)
+        generator = np.random.default_rng([x0, y0])
+        samples = [camera.castRay(x0 + column, y0 + row, offset_x, offset_y) for row, column in np.argwhere(edges) for offset_x, offset_y in stratified_offsets(grid, generator)]
+        if not samples:
+            continue
+        sample_colors, _ = reference_colors(job, samples)
+        #samples get truncated to 0-255 like any pixel before they're averaged
+        sample_colors = np.clip(sample_colors, 0, 255).astype(np.uint8).reshape(-1, grid * grid, 3).astype(np.float64)
+        frame.pixels[tile][edges] = ((sample_colors.sum(axis=1) + pixels[tile][edges]) / (grid * grid + 1)).astype(np.uint8)
+    return frame.pixels
+
+#scenes checked by default. Any of the benchmark's cases works too (with the benchmark's camera), main is main.py's scene with some lamps and cubes thrown in.
+#the big meshes are left out, the interactive modes go through every triangle for every ray
+scenes = ['main', 'spheres-100', 'mesh-1k', 'instances-1000', 'plane', 'reflective', 'lamps-16']
+
+def build_job(name, width, height, antialiasing=None):
+    #the scene's job for renderer.render_frame, built in the current precision
+    if name == 'main':
+        return build_scene(width, height, lamps=16, antialiasing=antialiasing, cubes=20)
+    build, reflection_depth, build_lights = benchmark.cases[name]
+    scene = Scene(build())
+    return (benchmark.case_camera(width, height), scene, BVH(scene), build_lights(), Skybox("skybox.png"), reflection_depth, 0.01, antialiasing)
+
+def interactive_job(job):
+    #what main_movable draws: no reflections, no antialiasing and a flat background
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    return (camera, scene, bvh, lights, Background(background_color), 0, min_reflection_weight, None)
+
+def render_interactive(job, shadow_cache=None):
+    camera, scene, bvh, lights = job[:4]
+    return render_pixels(camera, scene, lights, GBuffer(), None, shadow_cache)
+
+#name: (precision, reference ('frame', 'low-res' or 'interactive'), exact, render(job, arguments, coordinator))
+#low-res is the frame at half the width and height, the knife edge pixels float32 gets wrong are a bigger share of a small frame (see precision.py)
+modes = {
+    'render-frame': ('float64', 'frame', True, lambda job, arguments, coordinator: render_frame(job, 1, arguments.tile_size)),
+    'workers': ('float64', 'frame', True, lambda job, arguments, coordinator: render_frame(job, arguments.workers, arguments.tile_size)),
+    'packets': ('float64', 'frame', True, lambda job, arguments, coordinator: render_frame(job, 1, arguments.tile_size, packet_size=arguments.packets)),
+    'float32': ('float32', 'frame', False, lambda job, arguments, coordinator: render_frame(job, 1, arguments.tile_size)),
+    'float32-packets': ('float32', 'frame', False, lambda job, arguments, coordinator: render_frame(job, 1, arguments.tile_size, packet_size=arguments.packets)),
+    'float32-low-res': ('float32', 'low-res', False, lambda job, arguments, coordinator: render_frame(job, 1, arguments.tile_size)),
+    'interactive': ('float64', 'interactive', False, lambda job, arguments, coordinator: render_interactive(job)),
+    'interactive-shadow-cache': ('float64', 'interactive', False, lambda job, arguments, coordinator: render_interactive(job, ShadowCache(arguments.shadow_cache))),
+    'distributed': ('float64', 'frame', True, lambda job, arguments, coordinator: coordinator.render_frame(job, arguments.tile_size)),
+}
+
+def timed(render):
+    start_time = time.perf_counter()
+    pixels = render()
+    return pixels, time.perf_counter() - start_time
+
+def mismatch_mask(reference, pixels):
+    #the reference at a third of its brightness, with every pixel that differs in red, brighter the more it's off (anything from 1 shows)
+    difference = np.abs(reference.astype(np.int16) - pixels.astype(np.int16)).max(axis=2)
+    mask = (reference // 3).astype(np.uint8)
+    differing = difference > 0
+    mask[differing] = 0
+    mask[differing, 0] = np.clip(128 + difference[differing], 0, 255)
+    return mask
+
+def run_scene(name, mode_names, arguments, coordinator=None):
+    #renders the scene through the reference and every mode, returns a result dict per mode
+    antialiasing = (arguments.antialiasing, arguments.antialiasing_threshold) if arguments.antialiasing > 0 else None
+    precision.set_precision('float64')
+    job = build_job(name, arguments.width, arguments.height, antialiasing)
+    references = {}
+    results = []
+    for mode in mode_names:
+        mode_precision, reference_kind, exact, render = modes[mode]
+        width, height = arguments.width, arguments.height
+        if reference_kind == 'low-res':
+            width, height = width // 2, height // 2
+            reference_job = build_job(name, width, height, antialiasing)
+        else:
+            reference_job = job if reference_kind == 'frame' else interactive_job(job)
+        if reference_kind not in references:
+            references[reference_kind] = timed(lambda: render_reference(reference_job, arguments.tile_size))
+        reference, reference_seconds = references[reference_kind]
+
+        mode_job = reference_job
+        if mode_precision != 'float64':
+            #everything gets built again from scratch in the mode's precision
+            precision.set_precision(mode_precision)
+            mode_job = build_job(name, width, height, antialiasing)
+            if reference_kind == 'interactive':
+                mode_job = interactive_job(mode_job)
+            precision.set_precision('float64')
+        pixels, seconds = timed(lambda: render(mode_job, arguments, coordinator))
+
+        error = precision.reference_error(reference, pixels)
+        if exact:
+            passed = error['differing'] == 0
+        else:
+            passed = error['beyond_rounding'] <= (arguments.low_res_tolerance if reference_kind == 'low-res' else arguments.tolerance)
+        results.append({
+            'scene': name,
+            'mode': mode,
+            'width': width,
+            'height': height,
+            'exact': exact,
+            'passed': passed,
+            'error': error,
+            'reference_seconds': reference_seconds,
+            'seconds': seconds,
+            'speedup': reference_seconds / seconds,
+        })
+        if arguments.masks and error['differing'] > 0:
+            os.makedirs(arguments.masks, exist_ok=True)
+            save_image(mismatch_mask(reference, pixels), os.path.join(arguments.masks, f"{name}-{mode}.png"))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenes", nargs='*', help=f"scenes to check, main or any of the benchmark's cases (default: {', '.join(scenes)})")
+    parser.add_argument("--modes", help=f"comma separated modes to check (default: all of {', '.join(mode for mode in modes if mode != 'distributed')}, and distributed with --distribute)")
+    parser.add_argument("--width", type=int, default=120)
+    parser.add_argument("--height", type=int, default=90)
+    parser.add_argument("--workers", type=int, default=4, help="worker processes of the workers mode")
+    parser.add_argument("--tile-size", type=int, default=32)
+    parser.add_argument("--packets", type=int, default=16, metavar="SIZE", help="packet size of the packet modes")
+    parser.add_argument("--shadow-cache", type=float, default=0.05, metavar="CELL", help="voxel size of the interactive-shadow-cache mode")
+    parser.add_argument("--antialiasing", type=int, default=0, metavar="GRID", help="render the frame modes and their reference with adaptive antialiasing")
+    parser.add_argument("--antialiasing-threshold", type=int, default=16)
+    parser.add_argument("--distribute", help="comma separated host:port of running workers (python distributed.py worker) for the distributed mode")
+    parser.add_argument("--authkey", default=os.environ.get("RAYTRACER_AUTHKEY"), help="shared secret with the workers (default: $RAYTRACER_AUTHKEY)")
+    parser.add_argument("--tolerance", type=float, default=0.005, help="share of the pixels a mode that isn't exact can have off by more than 1 (edges are a bigger share of a small frame)")
+    parser.add_argument("--low-res-tolerance", type=float, default=0.02, help="--tolerance of the low-res mode")
+    parser.add_argument("--masks", metavar="DIR", help="save an image of where every mode differs from the reference in this directory")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    arguments = parser.parse_args()
+
+    names = arguments.scenes or scenes
+    unknown = [name for name in names if name != 'main' and name not in benchmark.cases]
+    if unknown:
+        parser.error(f"unknown scenes: {', '.join(unknown)}")
+    if arguments.modes:
+        mode_names = arguments.modes.split(',')
+    else:
+        mode_names = [mode for mode in modes if mode != 'distributed' or arguments.distribute]
+    unknown = [mode for mode in mode_names if mode not in modes]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+    coordinator = None
+    if 'distributed' in mode_names:
+        if not arguments.distribute or not arguments.authkey:
+            parser.error("the distributed mode needs --distribute and an --authkey (or $RAYTRACER_AUTHKEY)")
+        coordinator = Coordinator([parse_address(address) for address in arguments.distribute.split(',')], arguments.authkey.encode())
+
+    results = []
+    print(f"{'scene':<16}{'mode':<26}{'max':>5}{'mean':>9}{'differing':>11}{'off by >1':>11}{'time':>9}{'speedup':>9}")
+    try:
+        for name in names:
+            for result in run_scene(name, mode_names, arguments, coordinator):
+                results.append(result)
+                error = result['error']
+                print(f"{result['scene']:<16}{result['mode']:<26}{error['max']:>5}{error['mean']:>9.4f}{error['differing']:>11.4%}{error['beyond_rounding']:>11.4%}"
+                      f"{result['seconds']:>8.2f}s{result['speedup']:>8.2f}x{'' if result['passed'] else '  FAIL'}")
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump({'width': arguments.width, 'height': arguments.height, 'antialiasing': arguments.antialiasing, 'tolerance': arguments.tolerance, 'low_res_tolerance': arguments.low_res_tolerance, 'results': results}, file, indent=2)
+        print(f"saved {arguments.output}")
+
+    failures = [f"{result['scene']}/{result['mode']}" for result in results if not result['passed']]
+    if failures:
+        print(f"failed: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
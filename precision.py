@@ -0,0 +1,72 @@
+import numpy as np
+
+#floating point precision of the ray pipeline. float64 is the reference, float32 halves the memory traffic of everything batched
+#(ray buffers, the scene's packed arrays, BVH nodes, mesh vertices, intersection kernels, shading).
+#set_precision goes first, before any object is built: arrays made from plain values (tuples, lists) take the current dtype when
+#they're created and keep it, and the kernels follow the dtype of what they get. So a scene built in float32 stays float32 in worker
+#processes too, and the epsilons are looked up by the dtype of the data they go with.
+#
+#error bound of float32 against the float64 reference render, measured with parity.py: share of the pixels off by more than 1 in a
+#channel, float32 / float32-packets (- wasn't measured):
+#                   400x300          240x180          120x90           60x45 (the float32-low-res mode)
+#   main            0.011% / 0.014%  0.016% / 0.016%  0.19% / 0.19%    0.26% / 0.19%
+#   spheres-100     -                0      / 0.002%  0     / 0        0     / 0
+#   mesh-1k         -                0.002% / 0.002%  0     / 0        0     / 0
+#   instances-1000  -                0.005% / 0.005%  0     / 0        0     / 0.04%
+#   plane           0.39%  / 0.39%   0.68%  / 0.68%   0.33% / 0.35%    1.52% / 1.70%
+#   reflective      0.33%  / 0.34%   0.60%  / 0.60%   0.25% / 0.28%    1.44% / 1.59%
+#   lamps-16        0.33%  / 0.33%   0.59%  / 0.59%   0.25% / 0.27%    1.44% / 1.59%
+#   - nearly all of them are knife edge rays: the scenes sit on round coordinates (the camera at (0, 2, 6), the floor at -1, main's cubes),
+#     so at some pixels the ray lands right on a checkerboard seam or grazes a cube's face. float64 puts it 1e-13 to one side of it,
+#     float32 1e-6 to either side. Those can be off by anything, it's the other tile's or surface's color. Scaling the epsilons or ray
+#     offsets with the distance doesn't move them, it's not precision that's lost, it's a tie. How many pixels line up with a seam
+#     depends on the resolution in no simple way (plane: 36 pixels at 120x90, 294 at 240x180, 41 at 60x45), so the bound only holds for the sizes above
+#   - everything else matches, or is off by 1 in a channel where the color got truncated to an int on the other side of a rounding
+#parity.py measures it (with reference_error()), its --tolerance (120x90) and --low-res-tolerance (60x45) leave some room over this table.
+
+dtype = np.float64
+
+#ray_offset: how far shadow and reflection rays start off the surface so rounding doesn't make them hit it again.
+#triangle_epsilon: determinant under which a ray counts as parallel to a triangle, and minimum distance of a triangle hit.
+#box_padding: relative slack on the far distance of the BVH's box tests so rounding doesn't lose rays grazing a box (2 gamma(3), see pbrt).
+#float32 rounds positions about 1e-7 of the way to the origin, hits 20 units out are off by ~1e-5, so its offset is 10x the float64 one.
+#float64 keeps the values it's always had and no box padding, so the reference renders don't change
+epsilons = {
+    np.dtype(np.float64): {'ray_offset': 1e-4, 'triangle_epsilon': 0.00001, 'box_padding': 0.0},
+    np.dtype(np.float32): {'ray_offset': 1e-3, 'triangle_epsilon': 0.0001, 'box_padding': 4e-7},
+}
+
+def set_precision(name):
+    #'float64' or 'float32'
+    global dtype
+    if np.dtype(name) not in epsilons:
+        raise ValueError(f"unsupported precision {name}, use one of {', '.join(str(key) for key in epsilons)}")
+    dtype = np.dtype(name).type
+
+def floats(values):
+    #values as a float array, kept as they are if they already are float32/float64, in the current dtype otherwise
+    values = np.asarray(values)
+    if values.dtype in epsilons:
+        return values
+    return values.astype(dtype)
+
+def settings(values):
+    #the epsilons that go with values (an array, or a dtype), float64's for anything that isn't float32
+    kind = np.dtype(values) if isinstance(values, (np.dtype, type)) else np.asarray(values).dtype
+    return epsilons.get(kind, epsilons[np.dtype(np.float64)])
+
+def ray_offset(values):
+    return settings(values)['ray_offset']
+
+def triangle_epsilon(values):
+    return settings(values)['triangle_epsilon']
+
+def box_padding(values):
+    return settings(values)['box_padding']
+
+def reference_error(reference, pixels):
+    #how far an (H, W, 3) uint8 render is from the reference: the share of pixels that differ at all,
+    #the share off by more than 1 in a channel, the largest difference and the mean one over every channel of every pixel
+    difference = np.abs(reference.astype(np.int16) - pixels.astype(np.int16))
+    largest = difference.max(axis=2)
+    return {'differing': float((largest > 0).mean()), 'beyond_rounding': float((largest > 1).mean()), 'max': int(largest.max()), 'mean': float(difference.mean())}
@@ -0,0 +1,59 @@
+import time
+
+class Profile():
+    #opt-in instrumentation for the renderer. Everything that can be profiled takes a profile=None argument and only
+    #touches it when it isn't None, so with profiling off the cost is an `is not None` check here and there.
+    #   counters: named counts (rays by type, intersection tests by primitive type, hits/misses, occlusion early-outs...)
+    #   stages: cumulative seconds per stage, filled with lap(): every lap charges the time since the previous one to a stage
+    #   tiles: (x0, y0, width, height, seconds) of every rendered tile
+    def __init__(self):
+        self.counters = {}
+        self.stages = {}
+        self.tiles = []
+        self.last_lap = time.perf_counter()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def restart(self):
+        #start timing from now, whatever happened since the last lap isn't charged to anything
+        self.last_lap = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last_lap
+        self.last_lap = now
+
+    def merge(self, other):
+        #adds up another profile (from another tile or worker process) into this one
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for stage, seconds in other.stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.tiles.extend(other.tiles)
+
+    def as_dict(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'stages_seconds': dict(sorted(self.stages.items(), key=lambda item: -item[1])),
+            'tiles': [{'x0': x0, 'y0': y0, 'width': width, 'height': height, 'seconds': seconds} for x0, y0, width, height, seconds in self.tiles],
+        }
+
+    def report(self):
+        #summary table for the end of a frame
+        lines = []
+        total = sum(self.stages.values())
+        lines.append(f"{'stage':<24}{'seconds':>10}{'share':>8}")
+        for stage, seconds in sorted(self.stages.items(), key=lambda item: -item[1]):
+            lines.append(f"{stage:<24}{seconds:>10.3f}{seconds / total if total else 0:>8.1%}")
+        lines.append("")
+        lines.append(f"{'counter':<24}{'value':>10}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<24}{value:>10}")
+        if self.tiles:
+            times = sorted(tile[4] for tile in self.tiles)
+            slowest = max(self.tiles, key=lambda tile: tile[4])
+            lines.append("")
+            lines.append(f"{len(self.tiles)} tiles: {times[0]:.3f} s fastest, {times[len(times) // 2]:.3f} s median, "
+                         f"{slowest[4]:.3f} s slowest (at {slowest[0]}, {slowest[1]})")
+        return "\n".join(lines)
@@ -0,0 +1,387 @@
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from objectHandler import dot_rows
+import precision
+from precision import floats, ray_offset
+from light import cull_lights
+from shading import receives_shadow, shade
+from profiler import Profile
+
+class Framebuffer():
+    #numpy backed stand in for a pygame surface. It implements set_at like a surface does, plus set_pixels to draw a batch at once,
+    #which lets the renderer draw into an (H, W, 3) uint8 array without a window.
+    #x0/y0 is where the buffer sits on the full frame, so a tile can be drawn into with full frame pixel coordinates.
+    def __init__(self, width, height, x0=0, y0=0):
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        self.x0 = x0
+        self.y0 = y0
+
+    def set_at(self, position, color):
+        x, y = position
+        #pygame truncates float colors to ints, so we do the same to stay pixel identical with the window
+        self.pixels[y - self.y0, x - self.x0] = np.clip(np.asarray(color[:3], dtype=np.float64), 0, 255).astype(np.uint8)
+
+    def set_pixels(self, xs, ys, colors):
+        #set_at for arrays of pixels and (N, 3) colors
+        self.pixels[np.asarray(ys) - self.y0, np.asarray(xs) - self.x0] = np.clip(colors, 0, 255).astype(np.uint8)
+
+#every function below takes an optional profiler.Profile. With one, time gets charged to the stages
+#(camera, primary, shadow, shading, skybox, reflection_rays, reflection_shading, antialiasing) and counters are kept for rays, intersection tests,
+#hits/misses, (hit, light) pairs skipped by light culling (lights.culled) and shadow rays stopped early by an occluder (shadow.occluded, the rest are shadow.lit).
+
+def trace_pixel(screen, x, y, ray, bvh, skybox, hits, profile=None):
+    #primary visibility of one pixel. Hits are appended to hits as (x, y, object index, face, intersection point, ray direction) to be shaded
+    #all together by shade_hits, misses are drawn straight away with the skybox.
+    #returns True if the pixel hit something.
+    closest_object, saved_intersection_point, closest_t, index, face = bvh.closest_hit(ray, profile, return_index=True)
+    if profile is not None:
+        profile.lap('primary')
+        profile.count('primary.hits' if closest_object else 'primary.misses')
+    if closest_object:
+        hits.append((x, y, index, face, saved_intersection_point, ray.direction))
+        return True
+    else:
+        #if there is no intersection, we find the corresponding pixel in the skybox
+        direction = ray.direction
+        normalized_direction = direction / np.linalg.norm(direction)
+        result = skybox.get_skybox_pixel(normalized_direction)
+        screen.set_at((x, y), result)
+        if profile is not None:
+            profile.lap('skybox')
+        return False
+
+def trace_packet(screen, x0, y0, width, height, camera, bvh, skybox, hits, counts, profile=None):
+    #primary visibility of a width x height packet of pixels starting at (x0, y0), traced together with BVH.closest_hit_packet.
+    #same output as calling trace_pixel on every pixel, returns the (height, width) indices of the objects hit (-1 for the skybox).
+    #counts gets the number of bounds tested against the packet and how many of those culled it
+    origins, directions = camera.castRays(x0, y0, width, height)
+    if profile is not None:
+        profile.lap('camera')
+    t, object_ids, faces, tested, culled = bvh.closest_hit_packet(origins, directions, profile)
+    counts['packet_bounds_tested'] += tested
+    counts['packet_bounds_culled'] += culled
+    hit = object_ids >= 0
+    if profile is not None:
+        profile.lap('primary')
+        profile.count('primary.hits', int(hit.sum()))
+        profile.count('primary.misses', int(len(hit) - hit.sum()))
+        profile.count('packet.bounds_tested', tested)
+        profile.count('packet.bounds_culled', culled)
+    xs = x0 + np.tile(np.arange(width), height)
+    ys = y0 + np.repeat(np.arange(height), width)
+    points = origins + directions * np.where(hit, t, 0)[:, None]
+    hits.extend(zip(xs[hit], ys[hit], object_ids[hit], faces[hit], points[hit], directions[hit]))
+    if not hit.all():
+        screen.set_pixels(xs[~hit], ys[~hit], skybox.get_skybox_pixels(directions[~hit]))
+        if profile is not None:
+            profile.lap('skybox')
+    return object_ids.reshape(height, width)
+
+def shade_hits(screen, hits, job, counts, profile=None):
+    #shades all the hits collected by trace_pixel at once and draws them. The surfaces are looked up in the scene's arrays
+    #(normals, base colors with the checkerboard, reflection coefficients), the (hit, light) pairs that can contribute are picked
+    #by cull_lights and all their shadow rays are traced as one batch. Reflective hits that have an unshadowed light get their
+    #reflections traced as one wavefront (see trace_reflections) and their base color replaced by the mix, then shading.shade lights everything.
+    #counts (from new_counts()) gets the shadow and reflection rays added to it.
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    if not hits:
+        return
+    xs = np.array([hit[0] for hit in hits])
+    ys = np.array([hit[1] for hit in hits])
+    object_ids = np.array([hit[2] for hit in hits], dtype=np.int64)
+    faces = np.array([hit[3] for hit in hits], dtype=np.int64)
+    points = np.array([hit[4] for hit in hits], dtype=scene.dtype)
+    directions = np.array([hit[5] for hit in hits], dtype=scene.dtype)
+    normals = scene.get_normals(object_ids, points, faces)
+    colors = scene.get_colors(object_ids, points)
+    shadowable = receives_shadow(scene, object_ids, points)
+
+    pair_points, pair_lights, light_directions, distances, attenuations = cull_lights(lights, points, normals)
+    #only things between the point and the light can block it. The object itself is tested too so concave meshes can shadow themselves.
+    occluded = bvh.any_hit_batch(points[pair_points] + light_directions * ray_offset(points), light_directions, distances, profile)
+    counts['shadow_rays'] += len(pair_points)
+    if profile is not None:
+        profile.lap('shadow')
+        profile.count('lights.culled', len(hits) * len(lights) - len(pair_points))
+        profile.count('shadow.occluded', int(occluded.sum()))
+        profile.count('shadow.lit', int(len(occluded) - occluded.sum()))
+
+    if reflection_depth > 0:
+        #if none of the lights that reach a hit make it past the shadow rays it just gets the shadowed colors, no need for its reflection
+        lit = np.zeros(len(hits), dtype=bool)
+        lit[pair_points[~occluded]] = True
+        queue = np.flatnonzero((scene.reflections[object_ids] > 0) & lit)
+        if len(queue):
+            if profile is not None:
+                profile.lap('reflection_shading')
+            mixed_colors = trace_reflections(bvh, lights, skybox, points[queue], directions[queue], normals[queue], colors[queue],
+                                             scene.reflections[object_ids[queue]], reflection_depth, min_reflection_weight, counts['reflection_rays'], profile)
+            #checkered planes keep drawing their pattern without the reflection, like Plane.render always did
+            mixed = ~scene.checkered[object_ids[queue]]
+            colors[queue[mixed]] = mixed_colors[mixed]
+
+    screen.set_pixels(xs, ys, shade(colors, normals, shadowable, lights, pair_points, pair_lights, light_directions, attenuations, occluded))
+    if profile is not None:
+        profile.lap('shading')
+
+def trace_reflections(bvh, lights, skybox, points, directions, normals, colors, reflections, max_depth, min_weight=0.01, ray_counts=None, profile=None):
+    #wavefront reflection engine. Takes the reflective surfaces as arrays (hit points, incoming ray directions, normals,
+    #base colors and reflection coefficients) and returns their base colors mixed with what they reflect, ready to be shaded in their place.
+    #every bounce is a queue of rays traced as one batch. Rays that hit a reflective object go in the next bounce's queue until max_depth,
+    #unless the weight of their path (product of the reflection coefficients so far) drops under min_weight.
+    #ray_counts (a list) gets the number of rays traced at each depth added to it.
+    scene = bvh.scene
+    levels = []
+    parents = np.arange(len(points))
+    parent_reflections = floats(reflections)
+    weights = parent_reflections
+    for depth in range(max_depth):
+        if len(points) == 0:
+            break
+        reflection_directions = directions - 2 * dot_rows(directions, normals)[:, None] * normals
+        origins = points + reflection_directions * ray_offset(points)
+        t, object_ids, faces = bvh.closest_hit_batch(origins, reflection_directions, profile, return_faces=True)
+        if ray_counts is not None:
+            if len(ray_counts) <= depth:
+                ray_counts.append(0)
+            ray_counts[depth] += len(origins)
+
+        hit = object_ids >= 0
+        if profile is not None:
+            profile.lap('reflection_rays')
+            profile.count('reflection.hits', int(hit.sum()))
+            profile.count('reflection.misses', int(len(hit) - hit.sum()))
+        hit_points = origins + reflection_directions * np.where(hit, t, 0)[:, None]
+        hit_normals = np.zeros((len(hit), 3), dtype=hit_points.dtype)
+        hit_colors = np.zeros((len(hit), 3), dtype=hit_points.dtype)
+        hit_reflections = np.zeros(len(hit), dtype=hit_points.dtype)
+        hit_normals[hit] = scene.get_normals(object_ids[hit], hit_points[hit], faces[hit])
+        hit_colors[hit] = scene.get_colors(object_ids[hit], hit_points[hit])
+        hit_reflections[hit] = scene.reflections[object_ids[hit]]
+        levels.append((parents, parent_reflections, reflection_directions, hit, hit_points, hit_normals, hit_colors, hit_reflections))
+
+        #queue up the next bounce. Checkered planes draw their pattern without what they reflect (see shade_hits), no point tracing it
+        path_weights = weights * hit_reflections
+        bounce = hit & (hit_reflections > 0) & ~scene.checkered[object_ids] & (path_weights >= min_weight)
+        parents = np.flatnonzero(bounce)
+        parent_reflections = hit_reflections[bounce]
+        weights = path_weights[bounce]
+        points = hit_points[bounce]
+        directions = reflection_directions[bounce]
+        normals = hit_normals[bounce]
+        if profile is not None:
+            profile.lap('reflection_shading')
+
+    #resolve the colors from the deepest bounce back up to the original surfaces.
+    #each level hands its parents the color their reflection sees and the coefficient to mix it with.
+    seen_colors = None
+    for parents, parent_reflections, reflection_directions, hit, hit_points, hit_normals, hit_colors, hit_reflections in reversed(levels):
+        base_colors = hit_colors.copy()
+        if seen_colors is not None:
+            base_colors[child_parents] = np.clip(base_colors[child_parents] * (1 - hit_reflections[child_parents, None]) + seen_colors * mix_factors[:, None], 0, 255)
+
+        level_colors = np.empty((len(hit), 3), dtype=hit_points.dtype)
+        #hits are lit without a shadow test, by the lights cull_lights keeps for them like for the primary hits
+        lit_points = hit_points[hit]
+        pair_points, pair_lights, light_directions, distances, attenuations = cull_lights(lights, lit_points, hit_normals[hit])
+        level_colors[hit] = shade(base_colors[hit], hit_normals[hit], np.zeros(len(lit_points), dtype=bool), lights,
+                                  pair_points, pair_lights, light_directions, attenuations, np.zeros(len(pair_points), dtype=bool))
+        #rays that escape see the skybox
+        level_colors[~hit] = skybox.get_skybox_pixels(reflection_directions[~hit])
+
+        #hits are mixed in with the hit object's coefficient, the skybox with the reflecting surface's own one
+        mix_factors = np.where(hit, hit_reflections, parent_reflections)
+        seen_colors = level_colors
+        child_parents = parents
+
+    if profile is not None:
+        profile.lap('reflection_shading')
+    if seen_colors is None:
+        return floats(colors)
+    return np.clip(colors * (1 - reflections[:, None]) + seen_colors * mix_factors[:, None], 0, 255)
+
+def new_counts():
+    #ray counters filled in by render_tile, reflection rays are counted per depth.
+    #antialiasing_rays are the extra camera rays traced for antialiasing and antialiased_pixels the edge pixels they went to.
+    #packet_bounds_tested/culled are the bounds the packets of primary rays got tested against and the ones that culled them (see trace_packet)
+    return {'primary_rays': 0, 'shadow_rays': 0, 'reflection_rays': [], 'antialiasing_rays': 0, 'antialiased_pixels': 0,
+            'packet_bounds_tested': 0, 'packet_bounds_culled': 0}
+
+def merge_counts(total, counts):
+    for name in ('primary_rays', 'shadow_rays', 'antialiasing_rays', 'antialiased_pixels', 'packet_bounds_tested', 'packet_bounds_culled'):
+        total[name] += counts[name]
+    for depth, count in enumerate(counts['reflection_rays']):
+        if len(total['reflection_rays']) <= depth:
+            total['reflection_rays'].append(0)
+        total['reflection_rays'][depth] += count
+
+def find_edges(pixels, object_ids, threshold):
+    #(H, W) mask of the pixels that hit another object than one of their 4 neighbours, or differ from one by more than threshold in a color channel
+    colors = pixels.astype(np.int16)
+    edges = np.zeros(object_ids.shape, dtype=bool)
+    horizontal = (object_ids[:, 1:] != object_ids[:, :-1]) | (np.abs(colors[:, 1:] - colors[:, :-1]).max(axis=2) > threshold)
+    edges[:, 1:] |= horizontal
+    edges[:, :-1] |= horizontal
+    vertical = (object_ids[1:] != object_ids[:-1]) | (np.abs(colors[1:] - colors[:-1]).max(axis=2) > threshold)
+    edges[1:] |= vertical
+    edges[:-1] |= vertical
+    return edges
+
+def stratified_offsets(grid, generator):
+    #(grid * grid, 2) positions inside a pixel, the pixel is cut in a grid x grid grid with one randomly placed sample per cell
+    cells = np.arange(grid * grid)
+    offset_x = (cells % grid + generator.random(grid * grid)) / grid
+    offset_y = (cells // grid + generator.random(grid * grid)) / grid
+    return np.stack([offset_x, offset_y], axis=1)
+
+def antialias_tile(tile, object_ids, job, counts, profile=None):
+    #adaptive antialiasing: only the pixels find_edges picks out get grid x grid more camera rays, stratified over the pixel,
+    #and end up as the average of those and their center sample. Everything else keeps its single sample.
+    #edges are only looked for inside the tile, so tiles stay independent of each other.
+    #the jitter is seeded by the tile's position, so the same frame always comes out the same whatever the number of workers
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, (grid, threshold) = job
+    edges = find_edges(tile.pixels, object_ids, threshold)
+    edge_pixels = np.argwhere(edges)
+    if profile is not None:
+        profile.lap('antialiasing')
+    if len(edge_pixels) == 0:
+        return
+
+    #the extra samples are traced and shaded exactly like normal pixels, sample i being drawn at (i, 0) of their own buffer
+    generator = np.random.default_rng([tile.x0, tile.y0])
+    samples = Framebuffer(len(edge_pixels) * grid * grid, 1)
+    hits = []
+    index = 0
+    for row, column in edge_pixels:
+        for offset_x, offset_y in stratified_offsets(grid, generator):
+            ray = camera.castRay(tile.x0 + column, tile.y0 + row, offset_x, offset_y)
+            if profile is not None:
+                profile.lap('camera')
+            trace_pixel(samples, index, 0, ray, bvh, skybox, hits, profile)
+            index += 1
+    shade_hits(samples, hits, job, counts, profile)
+
+    #argwhere and boolean indexing both go in row major order
+    sample_colors = samples.pixels[0].reshape(len(edge_pixels), grid * grid, 3).astype(np.float64)
+    total_colors = sample_colors.sum(axis=1) + tile.pixels[edges]
+    tile.pixels[edges] = (total_colors / (grid * grid + 1)).astype(np.uint8)
+    counts['antialiasing_rays'] += index
+    counts['antialiased_pixels'] += len(edge_pixels)
+    if profile is not None:
+        profile.lap('antialiasing')
+
+def render_tile(job, x0, y0, width, height, counts=None, profile=None, packet_size=None):
+    #renders a width x height tile starting at pixel (x0, y0) and returns it as an (height, width, 3) uint8 array.
+    #the primary rays go pixel by pixel (or in packet_size x packet_size packets, see trace_packet), then the tile's reflections are traced
+    #as one wavefront, then (if it's on) the edges get antialiased.
+    #counts (from new_counts()) gets the number of rays traced added to it.
+    camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing = job
+    if profile is not None:
+        start_time = time.perf_counter()
+        profile.restart()
+    tile = Framebuffer(width, height, x0, y0)
+    #what every pixel hit (index of the object, -1 for the skybox), for the antialiasing's edge detection.
+    #all the faces of a mesh count as the same object, creases between them still get caught by the color threshold
+    object_ids = np.full((height, width), -1, dtype=np.int64)
+    hits = []
+    tile_counts = new_counts()
+    if packet_size:
+        for packet_y in range(y0, y0 + height, packet_size):
+            for packet_x in range(x0, x0 + width, packet_size):
+                packet_width = min(packet_size, x0 + width - packet_x)
+                packet_height = min(packet_size, y0 + height - packet_y)
+                object_ids[packet_y - y0:packet_y - y0 + packet_height, packet_x - x0:packet_x - x0 + packet_width] = trace_packet(
+                    tile, packet_x, packet_y, packet_width, packet_height, camera, bvh, skybox, hits, tile_counts, profile)
+    else:
+        for y in range(y0, y0 + height):
+            for x in range(x0, x0 + width):
+                ray = camera.castRay(x, y)
+                if profile is not None:
+                    profile.lap('camera')
+                if trace_pixel(tile, x, y, ray, bvh, skybox, hits, profile):
+                    object_ids[y - y0, x - x0] = hits[-1][2]
+    shade_hits(tile, hits, job, tile_counts, profile)
+    tile_counts['primary_rays'] = width * height
+    if antialiasing is not None:
+        antialias_tile(tile, object_ids, job, tile_counts, profile)
+    if counts is not None:
+        merge_counts(counts, tile_counts)
+    if profile is not None:
+        profile.count('rays.primary', tile_counts['primary_rays'])
+        profile.count('rays.shadow', tile_counts['shadow_rays'])
+        profile.count('rays.reflection', sum(tile_counts['reflection_rays']))
+        profile.count('rays.antialiasing', tile_counts['antialiasing_rays'])
+        profile.count('antialiasing.pixels', tile_counts['antialiased_pixels'])
+        profile.tiles.append((x0, y0, width, height, time.perf_counter() - start_time))
+    return tile.pixels
+
+def split_tiles(width, height, tile_size):
+    #(x0, y0, width, height) of every tile covering the frame, the last row/column of tiles gets cut to fit
+    return [(x0, y0, min(tile_size, width - x0), min(tile_size, height - y0))
+            for y0 in range(0, height, tile_size)
+            for x0 in range(0, width, tile_size)]
+
+#the job each worker process received when it started. It's only sent once per worker instead of once per tile.
+_worker_job = None
+
+def _init_worker(job):
+    global _worker_job
+    _worker_job = job
+    #workers that don't get forked start out with the default precision, anything they build from plain values should match the scene's
+    precision.set_precision(job[1].dtype)
+
+def _render_worker_tile(x0, y0, width, height, profiling=False, packet_size=None):
+    counts = new_counts()
+    profile = Profile() if profiling else None
+    return x0, y0, render_tile(_worker_job, x0, y0, width, height, counts, profile, packet_size), counts, profile
+
+def render_frame(job, workers=1, tile_size=32, on_tile=None, stats=None, profile=None, packet_size=None):
+    #renders the whole frame into an (H, W, 3) uint8 array.
+    #job is (camera, scene, bvh, lights, skybox, reflection_depth, min_reflection_weight, antialiasing), lights being a list of Light
+    #and antialiasing either None or (grid, threshold): edge pixels get grid x grid extra samples, see antialias_tile.
+    #with workers > 1 the tiles are handed out to a process pool, every tile still goes through render_tile so the
+    #result is pixel identical to the serial path. on_tile(x0, y0, pixels) gets called as tiles finish (in any order).
+    #if stats is a dict it gets the ray counts of the frame (see new_counts), reflection_rays being the number of rays traced at each depth.
+    #if profile is a profiler.Profile, every tile gets profiled (in whichever process renders it) and added to it.
+    #packet_size traces the primary rays in packets of packet_size x packet_size pixels instead of one by one, see trace_packet.
+    camera = job[0]
+    frame = Framebuffer(camera.screenWidth, camera.screenHeight)
+    tiles = split_tiles(camera.screenWidth, camera.screenHeight, tile_size)
+    frame_counts = new_counts()
+
+    def store(x0, y0, pixels, counts, tile_profile):
+        frame.pixels[y0:y0 + pixels.shape[0], x0:x0 + pixels.shape[1]] = pixels
+        merge_counts(frame_counts, counts)
+        if tile_profile is not None:
+            profile.merge(tile_profile)
+        if on_tile is not None:
+            on_tile(x0, y0, pixels)
+
+    if workers <= 1:
+        for x0, y0, width, height in tiles:
+            counts = new_counts()
+            tile_profile = None if profile is None else Profile()
+            store(x0, y0, render_tile(job, x0, y0, width, height, counts, tile_profile, packet_size), counts, tile_profile)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(job,)) as executor:
+            futures = [executor.submit(_render_worker_tile, *tile, profile is not None, packet_size) for tile in tiles]
+            for future in as_completed(futures):
+                store(*future.result())
+
+    if stats is not None:
+        stats.update(frame_counts)
+    return frame.pixels
+
+def save_image(pixels, filename):
+    #writes an (H, W, 3) uint8 frame to disk. .ppm is written by hand so it works without any imaging library,
+    #everything else goes through PIL (which we already need for the skybox).
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    if filename.lower().endswith('.ppm'):
+        height, width, _ = pixels.shape
+        with open(filename, 'wb') as file:
+            file.write(f"P6\n{width} {height}\n255\n".encode('ascii'))
+            file.write(pixels.tobytes())
+    else:
+        from PIL import Image
+        Image.fromarray(pixels, 'RGB').save(filename)
@@ -0,0 +1,304 @@
+import numpy as np
+import precision
+from precision import floats
+from objectHandler import Triangle, Sphere, Plane, Mesh, Instance, intersect_triangles, intersect_spheres, intersect_planes, checkerboard
+
+#object type codes used in the packed arrays (and by the BVH)
+TRIANGLE = 0
+SPHERE = 1
+PLANE = 2
+#anything else, falls back to the object's own methods
+OTHER = 3
+#indexed meshes, their faces stay indexed (see Scene.mesh_triangles)
+MESH = 4
+#instances of a mesh, tested as a whole through their own intersect (and the mesh's BVH)
+INSTANCE = 5
+#name of every type code, for reporting
+type_names = ('triangle', 'sphere', 'plane', 'other', 'mesh', 'instance')
+
+#how many (ray, primitive) pairs the brute force queries test at once, rays get split into chunks to stay under it
+pair_budget = 2**20
+
+class Scene():
+    #structure of arrays container for the scene's objects. The geometry is packed by type into contiguous arrays:
+    #   sphere_centers (S, 3), sphere_radii (S,), sphere_radii_squared (S,)
+    #   triangle_v0, triangle_edge1, triangle_edge2, triangle_normals (T, 3)
+    #   mesh_vertices (V, 3) and mesh_faces (F, 3) indices into it, the faces of every Mesh after each other. They aren't unpacked into
+    #   per face corners or edges (that took ~100 bytes a face on top of the mesh's own ~50), the kernels gather them, see mesh_triangles.
+    #   a scene with a single mesh (like the mesh's own BVH) shares the mesh's arrays outright
+    #   plane_heights (P,)
+    #every object is one primitive, except meshes which are one per face. Primitives are numbered in object order and
+    #primitive_objects, primitive_faces (face of the mesh, 0 for everything else), primitive_types (the kernel that tests it,
+    #OTHER for instances) and primitive_rows (row in its type's arrays) describe every one of them.
+    #instances are one primitive each, the face they hit is only known once a ray has gone through them.
+    #sphere_ids, triangle_ids, plane_ids and other_ids are the index in objects of every row and sphere_primitives, triangle_primitives,
+    #mesh_primitives, plane_primitives and other_primitives its primitive (mesh rows go through primitive_objects and primitive_faces).
+    #going the other way, object_types and object_slots give every object's type and (first) row in its type's arrays.
+    #surface properties are per object: colors (O, 2, 3) (the second color is only used by checkered planes), checkered (O,) and reflections (O,).
+    #the objects themselves still work on their own, their vectors just become views into these arrays (meshes keep their own buffers).
+    #the rest (colors, reflections, plane heights and sphere radii) gets written through: setting it on a packed object updates the arrays
+    #too, see update_object. The BVH reads the geometry from here but its boxes don't follow, so it has to be built again after a radius,
+    #a height or a center changes.
+    #an object belongs to the last scene it got packed into.
+    #a Scene can be used like the old list of objects (len, iteration, indexing).
+    #the arrays are in the precision.dtype of when the scene gets built, kept in dtype.
+    def __init__(self, objects):
+        self.objects = list(objects)
+        count = len(self.objects)
+        self.dtype = precision.dtype
+
+        self.object_types = np.full(count, OTHER, dtype=np.int8)
+        for index, object in enumerate(self.objects):
+            if type(object) is Triangle:
+                self.object_types[index] = TRIANGLE
+            elif type(object) is Sphere:
+                self.object_types[index] = SPHERE
+            elif type(object) is Plane:
+                self.object_types[index] = PLANE
+            elif type(object) is Mesh:
+                self.object_types[index] = MESH
+            elif type(object) is Instance:
+                self.object_types[index] = INSTANCE
+
+        face_counts = np.array([len(object.faces) if object_type == MESH else 1 for object, object_type in zip(self.objects, self.object_types)], dtype=np.int64)
+        first_primitives = np.cumsum(face_counts) - face_counts
+        self.primitive_objects = np.repeat(np.arange(count), face_counts)
+        self.primitive_faces = np.arange(len(self.primitive_objects)) - np.repeat(first_primitives, face_counts)
+        kernels = np.where(self.object_types == INSTANCE, OTHER, self.object_types)
+        self.primitive_types = kernels[self.primitive_objects].astype(np.int8)
+
+        self.sphere_primitives = np.flatnonzero(self.primitive_types == SPHERE)
+        self.triangle_primitives = np.flatnonzero(self.primitive_types == TRIANGLE)
+        self.mesh_primitives = np.flatnonzero(self.primitive_types == MESH)
+        self.plane_primitives = np.flatnonzero(self.primitive_types == PLANE)
+        self.other_primitives = np.flatnonzero(self.primitive_types == OTHER)
+        self.primitive_rows = np.zeros(len(self.primitive_objects), dtype=np.int64)
+        for primitives in (self.sphere_primitives, self.triangle_primitives, self.mesh_primitives, self.plane_primitives, self.other_primitives):
+            self.primitive_rows[primitives] = np.arange(len(primitives))
+        self.object_slots = self.primitive_rows[first_primitives] if count else np.zeros(0, dtype=np.int64)
+
+        self.sphere_ids = self.primitive_objects[self.sphere_primitives]
+        self.triangle_ids = self.primitive_objects[self.triangle_primitives]
+        self.plane_ids = self.primitive_objects[self.plane_primitives]
+        self.other_ids = self.primitive_objects[self.other_primitives]
+        self.instance_ids = np.flatnonzero(self.object_types == INSTANCE)
+
+        spheres = [self.objects[index] for index in self.sphere_ids]
+        self.sphere_centers = np.array([sphere.center for sphere in spheres], dtype=self.dtype).reshape(-1, 3)
+        self.sphere_radii = np.array([sphere.radius for sphere in spheres], dtype=self.dtype)
+        self.sphere_radii_squared = self.sphere_radii**2
+
+        triangles = [self.objects[index] for index in self.triangle_ids]
+        self.triangle_v0 = np.array([triangle.v0 for triangle in triangles], dtype=self.dtype).reshape(-1, 3)
+        self.triangle_edge1 = np.array([triangle.edge1 for triangle in triangles], dtype=self.dtype).reshape(-1, 3)
+        self.triangle_edge2 = np.array([triangle.edge2 for triangle in triangles], dtype=self.dtype).reshape(-1, 3)
+        self.triangle_normals = np.array([triangle.normal for triangle in triangles], dtype=self.dtype).reshape(-1, 3)
+
+        #the meshes' faces get shifted by the number of vertices of the meshes before them
+        meshes = [self.objects[index] for index in np.flatnonzero(self.object_types == MESH)]
+        if len(meshes) == 1:
+            self.mesh_vertices = meshes[0].vertices.astype(self.dtype, copy=False)
+            self.mesh_faces = meshes[0].faces
+        else:
+            vertex_counts = np.array([len(mesh.vertices) for mesh in meshes], dtype=np.int64)
+            offsets = (np.cumsum(vertex_counts) - vertex_counts).astype(np.int32)
+            self.mesh_vertices = np.concatenate([mesh.vertices for mesh in meshes] or [np.zeros((0, 3))]).astype(self.dtype)
+            self.mesh_faces = np.concatenate([mesh.faces + offset for mesh, offset in zip(meshes, offsets)] or [np.zeros((0, 3), dtype=np.int32)])
+
+        self.plane_heights = np.array([self.objects[index].yLevel for index in self.plane_ids], dtype=self.dtype)
+
+        self.colors = np.zeros((count, 2, 3), dtype=self.dtype)
+        self.checkered = np.zeros(count, dtype=bool)
+        self.reflections = np.zeros(count, dtype=self.dtype)
+        for index in range(count):
+            self._pack_surface(index)
+
+        self._bind_views()
+
+    def _pack_surface(self, index):
+        object = self.objects[index]
+        #same test as Plane.render: 3 values is a single color, anything else is a pair of checkerboard colors
+        if len(object.color) == 3:
+            self.colors[index] = object.color
+            self.checkered[index] = False
+        else:
+            self.colors[index] = object.color[:2]
+            self.checkered[index] = True
+        self.reflections[index] = object.reflection
+
+    def update_object(self, index, name):
+        #objects[index] just had one of its packed attributes set (see objectHandler.packed_attribute), copy it into the arrays
+        object = self.objects[index]
+        slot = self.object_slots[index]
+        if name in ('color', 'reflection'):
+            self._pack_surface(index)
+        elif name == 'yLevel':
+            self.plane_heights[slot] = object.yLevel
+        elif name == 'radius':
+            self.sphere_radii[slot] = object.radius
+            self.sphere_radii_squared[slot] = self.sphere_radii[slot]**2
+
+    def _bind_views(self):
+        #point the objects' vectors at their rows so there's only one copy of the geometry,
+        #and tell every object where it sits so its packed attributes can write through
+        for index, object in enumerate(self.objects):
+            object.packed = (self, index)
+        for slot, index in enumerate(self.sphere_ids):
+            self.objects[index].center = self.sphere_centers[slot]
+        for slot, index in enumerate(self.triangle_ids):
+            triangle = self.objects[index]
+            triangle.v0 = self.triangle_v0[slot]
+            triangle.edge1 = self.triangle_edge1[slot]
+            triangle.edge2 = self.triangle_edge2[slot]
+            triangle.normal = self.triangle_normals[slot]
+
+    def __setstate__(self, state):
+        #pickling (sending the scene to worker processes) copies every view on its own, link them back up on the other side
+        self.__dict__.update(state)
+        self._bind_views()
+
+    def geometry_key(self):
+        #changes whenever anything that decides what a camera ray sees changes (the packed geometry, instance transforms or the surfaces).
+        #cheap next to tracing, so caches of primary visibility can check it every frame
+        arrays = (self.object_types, self.sphere_centers, self.sphere_radii, self.triangle_v0, self.triangle_edge1, self.triangle_edge2,
+                  self.triangle_normals, self.mesh_vertices, self.mesh_faces, self.plane_heights, self.colors, self.checkered, self.reflections)
+        arrays += tuple(self.objects[index].transform for index in self.instance_ids)
+        return hash(b''.join(np.ascontiguousarray(array).tobytes() for array in arrays))
+
+    def mesh_triangles(self, rows=slice(None)):
+        #v0, edge1 and edge2 of mesh face rows, gathered through mesh_faces. Same arithmetic as Mesh.get_corners and intersect_face,
+        #so the kernels get bit for bit the edges the mesh's own intersect works with
+        faces = self.mesh_faces[rows]
+        v0 = self.mesh_vertices[faces[..., 0]]
+        return v0, self.mesh_vertices[faces[..., 1]] - v0, self.mesh_vertices[faces[..., 2]] - v0
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __getitem__(self, index):
+        return self.objects[index]
+
+    def get_bounds(self):
+        #(P, 3) min and max corners of every primitive's bounding box, nan for the ones without bounds (planes)
+        bounds_min = np.full((len(self.primitive_objects), 3), np.nan)
+        bounds_max = np.full((len(self.primitive_objects), 3), np.nan)
+
+        corners = self.triangle_v0[:, None] + np.stack([np.zeros_like(self.triangle_v0), self.triangle_edge1, self.triangle_edge2], axis=1)
+        bounds_min[self.triangle_primitives] = corners.min(axis=1)
+        bounds_max[self.triangle_primitives] = corners.max(axis=1)
+        corners = self.mesh_vertices[self.mesh_faces]
+        bounds_min[self.mesh_primitives] = corners.min(axis=1)
+        bounds_max[self.mesh_primitives] = corners.max(axis=1)
+        bounds_min[self.sphere_primitives] = self.sphere_centers - self.sphere_radii[:, None]
+        bounds_max[self.sphere_primitives] = self.sphere_centers + self.sphere_radii[:, None]
+        for primitive, index in zip(self.other_primitives, self.other_ids):
+            bounds = self.objects[index].get_bounds()
+            if bounds is not None:
+                bounds_min[primitive], bounds_max[primitive] = bounds
+        return bounds_min, bounds_max
+
+    def intersect_all(self, origins, directions):
+        #(N, P) distance from every ray to every primitive, np.inf for misses and for hits behind the ray
+        t = np.full((len(origins), len(self.primitive_objects)), np.inf, dtype=directions.dtype)
+        pair_origins = origins[:, None]
+        pair_directions = directions[:, None]
+        if len(self.triangle_primitives):
+            t[:, self.triangle_primitives] = intersect_triangles(pair_origins, pair_directions, self.triangle_v0, self.triangle_edge1, self.triangle_edge2)[0]
+        if len(self.mesh_primitives):
+            t[:, self.mesh_primitives] = intersect_triangles(pair_origins, pair_directions, *self.mesh_triangles())[0]
+        if len(self.sphere_primitives):
+            t[:, self.sphere_primitives] = intersect_spheres(pair_origins, pair_directions, self.sphere_centers, self.sphere_radii_squared)[0]
+        if len(self.plane_primitives):
+            t[:, self.plane_primitives] = intersect_planes(pair_origins, pair_directions, self.plane_heights)[0]
+        for primitive, index in zip(self.other_primitives, self.other_ids):
+            t[:, primitive] = self.objects[index].intersect_batch(origins, directions)[0]
+        t[t <= 0] = np.inf
+        return t
+
+    def chunks(self, ray_count):
+        step = max(1, pair_budget // max(1, len(self.primitive_objects)))
+        for start in range(0, ray_count, step):
+            yield slice(start, min(start + step, ray_count))
+
+    def closest_hit_batch(self, origins, directions, return_faces=False):
+        #brute force closest hit, every type is tested against a whole chunk of rays in one broadcast.
+        #returns per ray t and index into objects (-1 on a miss). Only hits in front of the ray count, on a tie the first object wins.
+        #with return_faces the face that got hit comes third (the mesh face, 0 for other objects), get_normals needs it for meshes.
+        origins = floats(origins)
+        directions = floats(directions)
+        closest_t = np.full(len(origins), np.inf, dtype=directions.dtype)
+        closest_primitive = np.full(len(origins), -1)
+        if len(self.primitive_objects):
+            for chunk in self.chunks(len(origins)):
+                t = self.intersect_all(origins[chunk], directions[chunk])
+                primitive = t.argmin(axis=1)
+                chunk_t = t[np.arange(len(primitive)), primitive]
+                closest_t[chunk] = chunk_t
+                closest_primitive[chunk] = np.where(chunk_t < np.inf, primitive, -1)
+        hit = closest_primitive >= 0
+        closest_index = np.full(len(origins), -1)
+        closest_index[hit] = self.primitive_objects[closest_primitive[hit]]
+        if return_faces:
+            closest_face = np.zeros(len(origins), dtype=np.int64)
+            closest_face[hit] = self.primitive_faces[closest_primitive[hit]]
+            #instances only know which face got hit after tracing through them, so they're asked again for their rays
+            instances = np.flatnonzero(hit & np.isin(closest_index, self.instance_ids))
+            for index in np.unique(closest_index[instances]):
+                rays = instances[closest_index[instances] == index]
+                closest_face[rays] = self.objects[index].closest_hit_batch(origins[rays], directions[rays], return_faces=True)[2]
+            return closest_t, closest_index, closest_face
+        return closest_t, closest_index
+
+    def any_hit_batch(self, origins, directions, max_distance=np.inf):
+        #brute force occlusion query, mask of the rays that hit anything closer than max_distance (a number or one per ray)
+        origins = floats(origins)
+        directions = floats(directions)
+        max_distance = np.broadcast_to(floats(max_distance), (len(origins),))
+        blocked = np.zeros(len(origins), dtype=bool)
+        for chunk in self.chunks(len(origins)):
+            t = self.intersect_all(origins[chunk], directions[chunk])
+            blocked[chunk] = (t < max_distance[chunk, None]).any(axis=1)
+        return blocked
+
+    def get_normals(self, object_ids, points, faces=None):
+        #(N, 3) normals at points, point i being on objects[object_ids[i]] (and on face faces[i] of it, only needed for meshes and instances)
+        points = floats(points)
+        normals = np.empty((len(points), 3), dtype=points.dtype)
+        types = self.object_types[object_ids]
+        slots = self.object_slots[object_ids]
+
+        spheres = types == SPHERE
+        vectors = points[spheres] - self.sphere_centers[slots[spheres]]
+        normals[spheres] = vectors / np.linalg.norm(vectors, axis=1)[:, None]
+        triangles = types == TRIANGLE
+        normals[triangles] = self.triangle_normals[slots[triangles]]
+        normals[types == PLANE] = (0, 1, 0)
+
+        meshes = np.flatnonzero((types == MESH) | (types == INSTANCE))
+        for index in np.unique(object_ids[meshes]):
+            members = meshes[object_ids[meshes] == index]
+            normals[members] = self.objects[index].get_normal_batch(points[members], np.asarray(faces)[members])
+
+        others = np.flatnonzero(types == OTHER)
+        for index in np.unique(object_ids[others]):
+            members = others[object_ids[others] == index]
+            normals[members] = self.objects[index].get_normal_batch(points[members])
+        return normals
+
+    def get_colors(self, object_ids, points):
+        #(N, 3) base colors at points, with the checkerboard pattern on checkered planes
+        points = floats(points)
+        colors = self.colors[object_ids, 0].astype(points.dtype)
+        checkered = self.checkered[object_ids]
+        if checkered.any():
+            pairs = self.colors[object_ids[checkered]]
+            colors[checkered] = checkerboard(points[checkered], pairs[:, 0], pairs[:, 1])
+
+        others = np.flatnonzero(self.object_types[object_ids] == OTHER)
+        for index in np.unique(object_ids[others]):
+            members = others[object_ids[others] == index]
+            colors[members] = self.objects[index].get_color_batch(points[members])
+        return colors
@@ -0,0 +1,28 @@
+import numpy as np
+from objectHandler import shadowMultiplier, dot_rows
+
+#batched shading: the lighting the objects' render() does pixel by pixel, done for every hit at once.
+#surfaces come in as arrays (base colors, normals, whether they can be shadowed) and the lights as (point, light) pairs,
+#like the ones light.cull_lights picks. The objects' render() stays around as the per pixel reference (parity.py draws with it), shade() gives the same colors.
+
+def receives_shadow(scene, object_ids, points):
+    #mask of the points that get darkened when in shadow. Plane.render never darkened the checkerboard's yellow center tile, keep it that way
+    x = points[:, 0]
+    z = points[:, 2]
+    center_tile = (x < 0.5) & (x > -0.5) & (z < 0.5) & (z > -0.5)
+    return ~(scene.checkered[object_ids] & center_tile)
+
+def shade(colors, normals, receives_shadow, lights, pair_points, pair_lights, light_directions, attenuations, shadowed):
+    #(N, 3) lit colors of N surfaces. Every (point, light) pair adds what render() would draw for it:
+    #max(0, normal . light direction) * strength (faded by the attenuation) * base color * light color, times shadowMultiplier
+    #if it's shadowed (and the surface can be), clipped to 0-255 on its own. The sum gets clipped again, points without any pair are black.
+    #the operations go in the same order as render() so the results match bit for bit. Everything is worked out in the colors' precision.
+    light_colors = np.array([light.color for light in lights], dtype=colors.dtype).reshape(-1, 3)
+    strengths = np.array([light.strength for light in lights], dtype=colors.dtype)
+    intensity = np.maximum(0, dot_rows(normals[pair_points], light_directions)) * (strengths[pair_lights] * attenuations)
+    pair_colors = colors[pair_points] * intensity[:, None] * light_colors[pair_lights]
+    pair_colors[shadowed & receives_shadow[pair_points]] *= shadowMultiplier
+    #np.add.at adds in pair order, which is light by light like render_lights did
+    final_colors = np.zeros((len(colors), 3), dtype=colors.dtype)
+    np.add.at(final_colors, pair_points, np.clip(pair_colors, 0, 255))
+    return np.clip(final_colors, 0, 255)
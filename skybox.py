@@ -1,11 +1,41 @@
+import numpy as np
 from PIL import Image
 from numpy import array
 from math import atan2, asin, pi
+from cache import cache_key, load_array, save_array
+from precision import floats
 
 class Skybox():
-    def __init__(self, image):
-        self.skybox_image = Image.open(image)
-        self.skybox_array = array(self.skybox_image)
+    #cubemap_size: if set, the equirectangular image gets resampled once into 6 cubemap faces of that size
+    #and every lookup goes through them, which only needs a few divisions instead of atan2/asin.
+    def __init__(self, image, cubemap_size=None, use_cache=True):
+        #the decoded image gets cached so we don't go through PIL on every startup
+        self.skybox_image = None
+        key = cache_key(image) if use_cache else None
+        self.skybox_array = None if key is None else load_array(key + ".npy")
+        if self.skybox_array is None:
+            self.skybox_image = Image.open(image)
+            self.skybox_array = array(self.skybox_image)
+            if key is not None:
+                save_array(key + ".npy", self.skybox_array)
+
+        #the shape doesn't change so we read it once instead of on every lookup
+        self.height, self.width, _ = self.skybox_array.shape
+
+        self.cubemap = None
+        if cubemap_size is not None:
+            cubemap_file = None if key is None else f"{key}-cube{cubemap_size}.npy"
+            self.cubemap = None if cubemap_file is None else load_array(cubemap_file)
+            if self.cubemap is None:
+                self.cubemap = self.build_cubemap(cubemap_size)
+                if cubemap_file is not None:
+                    save_array(cubemap_file, self.cubemap)
+
+    def __getstate__(self):
+        #only the pixel array is needed after loading, so don't drag the PIL image along when the skybox gets sent to worker processes
+        state = self.__dict__.copy()
+        state['skybox_image'] = None
+        return state
 
     #source: https://en.wikipedia.org/wiki/UV_mapping
     #this is what handles turning a simple image into something of a sphere around the area (panoramic)
@@ -13,12 +43,77 @@ class Skybox():
         u = 0.5 + atan2(direction[2], direction[0]) / (2 * pi)
         v = 0.5 - asin(direction[1]) / pi
         return (u, v)
-    
+
     def get_skybox_pixel(self, direction):
+        if self.cubemap is not None:
+            return self.get_skybox_pixels(np.array([direction], dtype=np.float64))[0]
         u, v = self.map_UV(direction)
-        height, width, _ = self.skybox_array.shape
         #u and v are normalized between 0 and 1. Multiply by width and height to get pixel position.
         #we use modulo to handle wrapping around
-        x = int(u * width) % width
-        y = int(v * height) % height
-        return self.skybox_array[y, x]
\ No newline at end of file
+        x = int(u * self.width) % self.width
+        y = int(v * self.height) % self.height
+        return self.skybox_array[y, x]
+
+    def get_skybox_pixels(self, directions):
+        #batched lookup, (N, 3) unit directions to (N, 3) RGB colors
+        directions = floats(directions)
+        if self.cubemap is not None:
+            face, s, t = cube_coordinates(directions)
+            size = self.cubemap.shape[1]
+            column = np.minimum((s * size).astype(np.int64), size - 1)
+            row = np.minimum((t * size).astype(np.int64), size - 1)
+            return self.cubemap[face, row, column]
+        return self.sample_equirectangular(directions)
+
+    def sample_equirectangular(self, directions):
+        #same math as map_UV + get_skybox_pixel on whole arrays
+        u = 0.5 + np.arctan2(directions[:, 2], directions[:, 0]) / (2 * pi)
+        v = 0.5 - np.arcsin(np.clip(directions[:, 1], -1, 1)) / pi
+        #astype truncates toward zero like int() does
+        x = (u * self.width).astype(np.int64) % self.width
+        y = (v * self.height).astype(np.int64) % self.height
+        return self.skybox_array[y, x, :3]
+
+    def build_cubemap(self, size):
+        #sample the equirectangular image at the center of every texel of the 6 faces
+        texel_centers = (np.arange(size) + 0.5) / size * 2 - 1
+        tc, sc = np.meshgrid(texel_centers, texel_centers, indexing='ij')
+        cubemap = np.empty((6, size, size, 3), dtype=np.uint8)
+        for face in range(6):
+            directions = cube_direction(face, sc.ravel(), tc.ravel())
+            directions /= np.linalg.norm(directions, axis=1)[:, None]
+            cubemap[face] = self.sample_equirectangular(directions).reshape(size, size, 3)
+        return cubemap
+
+#cubemap faces follow the usual +X, -X, +Y, -Y, +Z, -Z order.
+#for every face: which axis is the major one and how the two in-face coordinates (sc, tc) map to the other two axes
+def cube_direction(face, sc, tc):
+    ones = np.ones_like(sc)
+    if face == 0:
+        return np.stack([ones, -tc, -sc], axis=1)
+    if face == 1:
+        return np.stack([-ones, -tc, sc], axis=1)
+    if face == 2:
+        return np.stack([sc, ones, tc], axis=1)
+    if face == 3:
+        return np.stack([sc, -ones, -tc], axis=1)
+    if face == 4:
+        return np.stack([sc, -tc, ones], axis=1)
+    return np.stack([-sc, -tc, -ones], axis=1)
+
+#per face: the axis and sign of sc and tc, so cube_coordinates can gather them without branching
+face_sc_axis = np.array([2, 2, 0, 0, 0, 0])
+face_sc_sign = np.array([-1, 1, 1, 1, 1, -1])
+face_tc_axis = np.array([1, 1, 2, 2, 1, 1])
+face_tc_sign = np.array([-1, -1, 1, -1, -1, -1])
+
+def cube_coordinates(directions):
+    #inverse of cube_direction: face index and in-face coordinates s, t in [0, 1] of every direction
+    rows = np.arange(len(directions))
+    major_axis = np.abs(directions).argmax(axis=1)
+    major = directions[rows, major_axis]
+    face = major_axis * 2 + (major < 0)
+    major = np.abs(major)
+    sc = directions[rows, face_sc_axis[face]] * face_sc_sign[face]
+    tc = directions[rows, face_tc_axis[face]] * face_tc_sign[face]
+    return face, (sc / major + 1) / 2, (tc / major + 1) / 2
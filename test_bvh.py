@@ -0,0 +1,78 @@
+import numpy as np
+from objectHandler import Triangle, Sphere, Plane, Mesh, Instance, make_transform
+from scene import Scene
+from bvh import BVH
+from ray import Ray
+
+cube_vertices = [(x, y, z) for x in (-0.5, 0.5) for y in (-0.5, 0.5) for z in (-0.5, 0.5)]
+cube_faces = [(0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1), (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3)]
+
+def build_scene(seed=0):
+    #a bit of everything: spheres, loose triangles, two meshes (their faces get shifted in the scene's index buffer), instances and a plane
+    generator = np.random.default_rng(seed)
+    objects = [Sphere(center, radius, (200, 50, 50)) for center, radius in zip(generator.uniform(-5, 5, (20, 3)), generator.uniform(0.2, 1, 20))]
+    for corner in generator.uniform(-5, 5, (20, 3)):
+        objects.append(Triangle(corner, corner + generator.uniform(-1, 1, 3), corner + generator.uniform(-1, 1, 3), (50, 200, 50), (0, 1, 0)))
+    cube = Mesh(cube_vertices, cube_faces, (50, 50, 200))
+    objects.append(Mesh(np.array(cube_vertices) * 2 + (3, 1, -2), cube_faces, (200, 200, 50)))
+    objects.append(cube)
+    for position, rotation in zip(generator.uniform(-5, 5, (10, 3)), generator.uniform(0, 360, (10, 3))):
+        objects.append(Instance(cube, make_transform(position, generator.uniform(0.5, 2, 3), rotation)))
+    objects.append(Plane(-6, (100, 100, 100)))
+    return Scene(objects)
+
+def random_rays(count, seed=1):
+    generator = np.random.default_rng(seed)
+    directions = generator.normal(size=(count, 3))
+    return generator.uniform(-8, 8, (count, 3)), directions / np.linalg.norm(directions, axis=1)[:, None]
+
+def test_closest_hit_batch_matches_brute_force():
+    scene = build_scene()
+    origins, directions = random_rays(2000)
+    brute_t, brute_index, brute_face = scene.closest_hit_batch(origins, directions, return_faces=True)
+    t, index, face = BVH(scene).closest_hit_batch(origins, directions, return_faces=True)
+    assert (brute_index >= 0).sum() > 1000
+    assert np.array_equal(index, brute_index)
+    assert np.array_equal(face, brute_face)
+    assert np.allclose(t, brute_t)
+
+def test_closest_hit_matches_brute_force():
+    scene = build_scene()
+    bvh = BVH(scene)
+    origins, directions = random_rays(300)
+    brute_t, brute_index, brute_face = scene.closest_hit_batch(origins, directions, return_faces=True)
+    for origin, direction, expected_t, expected_index, expected_face in zip(origins, directions, brute_t, brute_index, brute_face):
+        object, intersection_point, t, index, face = bvh.closest_hit(Ray(origin, direction), return_index=True)
+        assert index == expected_index
+        if index >= 0:
+            assert face == expected_face
+            assert np.isclose(t, expected_t)
+            assert np.allclose(intersection_point, origin + direction * expected_t)
+        else:
+            assert object is None
+
+def test_closest_hit_packet_matches_brute_force():
+    #packets are coherent camera rays sharing an origin
+    scene = build_scene()
+    bvh = BVH(scene)
+    generator = np.random.default_rng(2)
+    for origin in generator.uniform(-8, 8, (10, 3)):
+        directions = (-origin / np.linalg.norm(origin)) + generator.uniform(-0.3, 0.3, (64, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        origins = np.broadcast_to(origin, directions.shape).copy()
+        brute_t, brute_index, brute_face = scene.closest_hit_batch(origins, directions, return_faces=True)
+        t, index, face = bvh.closest_hit_packet(origins, directions)[:3]
+        assert np.array_equal(index, brute_index)
+        assert np.array_equal(face, brute_face)
+        assert np.allclose(t, brute_t)
+
+def test_any_hit_matches_brute_force():
+    scene = build_scene()
+    bvh = BVH(scene)
+    origins, directions = random_rays(2000)
+    max_distances = np.random.default_rng(3).uniform(0.1, 10, len(origins))
+    blocked = scene.any_hit_batch(origins, directions, max_distances)
+    assert 0 < blocked.sum() < len(blocked)
+    assert np.array_equal(bvh.any_hit_batch(origins, directions, max_distances), blocked)
+    for origin, direction, max_distance, expected in list(zip(origins, directions, max_distances, blocked))[:300]:
+        assert bvh.any_hit(Ray(origin, direction), max_distance) == expected
@@ -0,0 +1,129 @@
+import numpy as np
+from objectHandler import parse_obj, parse_corners, intersect_triangle, intersect_triangles, intersect_spheres, intersect_planes
+from objectHandler import Sphere, Plane, Mesh, Instance, make_transform
+from ray import Ray
+from test_bvh import cube_vertices, cube_faces, random_rays
+
+header = """v 0 0 0
+v 1 0 0
+v 0 1 0
+v 0 0 1
+vt 0 0
+vt 1 0
+vt 0 1
+vn 0 0 1
+vn 0 1 0
+vn 1 0 0
+"""
+
+def write_obj(tmp_path, faces):
+    filename = tmp_path / "mixed.obj"
+    filename.write_text(header + faces)
+    return str(filename)
+
+def test_parse_obj_mixed_corner_forms(tmp_path):
+    #the counts add up (2 + 2 + 2 and 1 + 3 + 2 numbers for 3 corners of 2 fields each) but the corners don't all have the same form
+    mesh = parse_obj(write_obj(tmp_path, "f 1/1 2/2 3/3\nf 1 2/2/2 3/3\n"))
+    assert mesh['faces'].tolist() == [[0, 1, 2], [0, 1, 2]]
+    assert mesh['face_texcoord_indices'].tolist() == [[0, 1, 2], [-1, 1, 2]]
+    assert mesh['face_normal_indices'].tolist() == [[-1, -1, -1], [-1, 1, -1]]
+
+def test_parse_obj_one_form_per_face(tmp_path):
+    mesh = parse_obj(write_obj(tmp_path, "f 1 2 3\nf 2/1 3/2 4/3\nf 1//1 3//2 4//3\n"))
+    assert mesh['faces'].tolist() == [[0, 1, 2], [1, 2, 3], [0, 2, 3]]
+    assert mesh['face_texcoord_indices'].tolist() == [[-1, -1, -1], [0, 1, 2], [-1, -1, -1]]
+    assert mesh['face_normal_indices'].tolist() == [[-1, -1, -1], [-1, -1, -1], [0, 1, 2]]
+
+def test_parse_corners_same_form_matches_slow_path():
+    #v//vn and v/vt/vn mixed still take the fast path, they both have 3 fields
+    tokens = ["1//3", "2/1/2", "-1//1", "4/2/3"]
+    assert parse_corners(tokens).tolist() == [[1, 0, 3], [2, 1, 2], [-1, 0, 1], [4, 2, 3]]
+
+def test_parse_obj_inline_comments(tmp_path):
+    mesh = parse_obj(write_obj(tmp_path, "f 1 2 3 # first face\nf 2/1 3/2 4/3#no space before this one\n# f 1 2 4\n"))
+    assert mesh['faces'].tolist() == [[0, 1, 2], [1, 2, 3]]
+    assert mesh['face_texcoord_indices'].tolist() == [[-1, -1, -1], [0, 1, 2]]
+
+def test_parse_obj_drops_faces_with_less_than_3_corners(tmp_path):
+    #6 tokens for 2 faces, it looks like two triangles if only the total gets counted
+    mesh = parse_obj(write_obj(tmp_path, "f 1 2 3 4\nf 1 2\n"))
+    assert mesh['faces'].tolist() == [[0, 1, 2], [0, 2, 3]]
+
+def aimed_rays(origins, targets):
+    directions = targets - origins
+    return directions / np.linalg.norm(directions, axis=1)[:, None]
+
+def test_batch_kernels_match_single_ray():
+    #the batched kernels add up their dot products like np.dot, so they give exactly what the single ray versions give.
+    #the rays are aimed at the primitives, about half of them hit
+    generator = np.random.default_rng(0)
+    origins = generator.uniform(-8, 8, (500, 3))
+    v0 = generator.uniform(-3, 3, (500, 3))
+    edge1 = generator.uniform(-3, 3, (500, 3))
+    edge2 = generator.uniform(-3, 3, (500, 3))
+    barycentric = generator.uniform(-0.3, 1, (500, 2))
+    directions = aimed_rays(origins, v0 + barycentric[:, :1] * edge1 + barycentric[:, 1:] * edge2)
+    t, hit = intersect_triangles(origins, directions, v0, edge1, edge2)
+    assert hit.sum() > 10
+    for index, ray in enumerate(Ray(origin, direction) for origin, direction in zip(origins, directions)):
+        intersection_point, single_t = intersect_triangle(ray, v0[index], edge1[index], edge2[index])
+        assert hit[index] == (intersection_point is not None)
+        if hit[index]:
+            assert t[index] == single_t
+
+    spheres = [Sphere(center, radius, (200, 50, 50)) for center, radius in zip(generator.uniform(-3, 3, (500, 3)), generator.uniform(0.5, 3, 500))]
+    directions = aimed_rays(origins, np.array([sphere.center + generator.uniform(-1.5, 1.5, 3) * sphere.radius for sphere in spheres]))
+    t, hit = intersect_spheres(origins, directions, np.array([sphere.center for sphere in spheres]), np.array([sphere.radius_squared for sphere in spheres]))
+    assert hit.sum() > 10
+    for index, sphere in enumerate(spheres):
+        intersection_point, single_t = sphere.intersect(Ray(origins[index], directions[index]))
+        assert hit[index] == (intersection_point is not None)
+        if hit[index]:
+            assert t[index] == single_t
+
+    plane = Plane(-1, (100, 100, 100))
+    t, hit = intersect_planes(origins, directions, plane.yLevel)
+    for index in range(len(origins)):
+        intersection_point, single_t = plane.intersect(Ray(origins[index], directions[index]))
+        assert hit[index] == (intersection_point is not None)
+        if hit[index]:
+            assert t[index] == single_t
+
+def test_mesh_intersect_faces_matches_intersect_face():
+    mesh = Mesh(np.array(cube_vertices) * 4, cube_faces, (50, 50, 200))
+    origins, _ = random_rays(300)
+    directions = aimed_rays(origins, np.random.default_rng(0).uniform(-3, 3, (300, 3)))
+    t, face = mesh.intersect_faces(origins, directions)
+    assert (face >= 0).sum() > 10
+    for index, ray in enumerate(Ray(origin, direction) for origin, direction in zip(origins, directions)):
+        hits = [(mesh.intersect_face(ray, candidate)[1], candidate) for candidate in range(len(mesh.faces))]
+        #on a tie the first face wins in both
+        assert (t[index], face[index]) == min([hit for hit in hits if hit[0] is not None], default=(np.inf, -1))
+
+def test_instance_matches_baked_mesh():
+    #an instance traces in the mesh's object space, it has to see what a mesh with the transformed vertices sees
+    mesh = Mesh(cube_vertices, cube_faces, (50, 50, 200))
+    transform = make_transform((1, 0.5, -2), (2, 0.5, 3), (30, 45, 60))
+    instance = Instance(mesh, transform)
+    baked = Mesh(np.array(cube_vertices) @ transform[:3, :3].T + transform[:3, 3], cube_faces, (50, 50, 200))
+    origins, _ = random_rays(2000)
+    bounds_min, bounds_max = baked.get_bounds()
+    directions = aimed_rays(origins, np.random.default_rng(0).uniform(bounds_min - 1, bounds_max + 1, (2000, 3)))
+    t, index, face = instance.closest_hit_batch(origins, directions, return_faces=True)
+    baked_t, baked_face = baked.intersect_faces(origins, directions)
+    hit = index >= 0
+    assert hit.sum() > 50
+    assert np.array_equal(hit, baked_face >= 0)
+    assert np.array_equal(face[hit], baked_face[hit])
+    assert np.allclose(t[hit], baked_t[hit])
+
+    points = origins[hit] + directions[hit] * t[hit, None]
+    assert np.allclose(instance.get_normal_batch(points, face[hit]), baked.get_normal_batch(points, face[hit]))
+    max_distances = np.random.default_rng(1).uniform(0.1, 10, len(origins))
+    assert np.array_equal(instance.occluded_batch(origins, directions, max_distances), baked.occluded_batch(origins, directions, max_distances))
+    for origin, direction in list(zip(origins, directions))[:200]:
+        hit_face, intersection_point, single_t = instance.closest_hit(Ray(origin, direction))
+        baked_point, baked_single_t = baked.intersect(Ray(origin, direction))
+        assert (hit_face is None) == (baked_point is None)
+        if hit_face is not None:
+            assert np.isclose(single_t, baked_single_t)
@@ -0,0 +1,62 @@
+import numpy as np
+from objectHandler import Triangle, Sphere, Plane, Mesh, Instance, make_transform
+from scene import Scene
+from test_bvh import cube_vertices, cube_faces
+
+def test_update_object_writes_through():
+    sphere = Sphere((0, 0, -5), 1, (200, 50, 50))
+    plane = Plane(-1, ((20, 20, 50), (40, 40, 100)))
+    triangle = Triangle((0, 0, 0), (1, 0, 0), (0, 1, 0), (50, 200, 50), (0, 0, 1))
+    cube = Mesh(np.array(cube_vertices) + (0, 5, 0), cube_faces, (50, 50, 200))
+    instance = Instance(cube, make_transform((3, 0, -5)))
+    scene = Scene([sphere, plane, triangle, cube, instance])
+
+    sphere.radius = 2
+    assert scene.sphere_radii[0] == 2
+    assert scene.sphere_radii_squared[0] == 4
+    #the brute force queries read the arrays, so they see it right away
+    t, index = scene.closest_hit_batch(np.array([[0.0, 0.0, 0.0]]), np.array([[0.0, 0.0, -1.0]]))
+    assert index[0] == 0 and np.isclose(t[0], 3)
+
+    plane.yLevel = -2
+    assert scene.plane_heights[0] == -2
+
+    sphere.color = (10, 20, 30)
+    assert scene.colors[0, 0].tolist() == [10, 20, 30]
+    assert not scene.checkered[0]
+    #a single color plane stops being checkered, and the other way round
+    plane.color = (1, 2, 3)
+    assert scene.colors[1, 0].tolist() == [1, 2, 3]
+    assert not scene.checkered[1]
+    plane.color = ((1, 2, 3), (4, 5, 6))
+    assert scene.colors[1].tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert scene.checkered[1]
+
+    triangle.reflection = 0.5
+    assert scene.reflections[2] == 0.5
+    instance.color = (7, 8, 9)
+    assert scene.colors[4, 0].tolist() == [7, 8, 9]
+    #the mesh is shared, only the instance changes
+    assert scene.colors[3, 0].tolist() == [50, 50, 200]
+
+def test_meshes_share_one_index_buffer():
+    #every mesh's faces point at its own vertices once they're all in mesh_vertices
+    small = Mesh(cube_vertices, cube_faces, (50, 50, 200))
+    big = Mesh(np.array(cube_vertices) * 6 + (0, 0, -10), cube_faces, (200, 50, 50))
+    scene = Scene([small, big])
+    assert scene.mesh_faces.shape == (24, 3)
+    corners = scene.mesh_vertices[scene.mesh_faces]
+    assert np.array_equal(corners[:12], small.vertices[small.faces])
+    assert np.array_equal(corners[12:], big.vertices[big.faces])
+
+    generator = np.random.default_rng(0)
+    directions = generator.normal(size=(500, 3)) * 0.2 + (0, 0, -1)
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    origins = np.zeros((500, 3)) + (0, 0, 5)
+    t, index, face = scene.closest_hit_batch(origins, directions, return_faces=True)
+    small_t, small_face = small.intersect_faces(origins, directions)
+    big_t, big_face = big.intersect_faces(origins, directions)
+    assert np.array_equal(t, np.minimum(small_t, big_t))
+    assert np.array_equal(face[index == 0], small_face[index == 0])
+    assert np.array_equal(face[index == 1], big_face[index == 1])
+    assert (index == 0).any() and (index == 1).any()